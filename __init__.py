@@ -54,11 +54,14 @@ except:
 import re
 from pathlib import Path
 from .decompose import TOptions, Scan
+from .meshcache import MeshCache, CACHE_FOLDER
 from .export_urho import UrhoExportData, UrhoExportOptions, UrhoWriteModel, UrhoWriteAnimation, \
                          UrhoWriteTriggers, UrhoExport
 from .export_scene import SOptions, UrhoScene, UrhoExportScene, UrhoWriteMaterialTrees
+from .export_scene_binary import LoadSceneSchema, MissingSchemaTypes
 from .utils import PathType, FOptions, GetFilepath, CheckFilepath, ErrorsMem, getLodSetWithID,getObjectWithID, execution_queue, \
-                    PingData,set_found_blender_runtime,found_blender_runtime, PingForRuntime, copy_file,CalcNodeHash,export_image
+                    PingData,set_found_blender_runtime,found_blender_runtime, PingForRuntime, copy_file,CalcNodeHash,export_image, \
+                    writeIndex, writerPool, LogWriteStats, CopyFile
 
 from .networking import Start as StartNetwork
 StartNetwork()
@@ -77,9 +80,9 @@ from .addon_blender_connect.BConnectNetwork import Publish,StartNetwork,NetworkR
 from .addon_blender_connect import register as addon_blender_connect_register
 from .addon_blender_connect import unregister as addon_blender_connect_unregister
 import os,traceback
+import copy
 import time
 import sys
-import shutil
 import logging, random, ntpath
 import subprocess
 import json
@@ -1291,7 +1294,19 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
         self.geometrySplit = False
         self.lods = False
         self.strictLods = True
-        self.optimizeIndices = False
+        self.optimizeIndices = True
+        self.vertexCacheSize = 32
+        self.optimizeOverdraw = False
+        self.overdrawThreshold = 1.05
+        self.optimizeVertexFetch = True
+        self.splitLargeGeometries = False
+        self.modelFormat = 'UMDL'
+        self.packNormals = False
+        self.weldTolerance = 0.0
+        self.decomposeWorkers = 0
+        self.writerThreads = 4
+        self.meshCache = False
+        self.meshCacheSize = 1024
 
         self.skeletons = False
         self.onlyKeyedBones = False
@@ -1313,6 +1328,11 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
         self.animationRot = True
         self.animationSca = False
         self.filterSingleKeyFrames = False
+        self.reduceKeyframes = False
+        self.pruneStaticChannels = False
+        self.reducePositionError = 0.001
+        self.reduceRotationError = radians(0.1)
+        self.reduceScaleError = 0.001
 
         self.geometries = True
         self.geometryPos = True
@@ -1336,6 +1356,9 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
         self.individualPrefab = False
         self.collectivePrefab = False
         self.scenePrefab = False
+        self.sceneFormat = 'XML'
+        self.sceneXmlDump = False
+        self.sceneSchemaFile = ""
         self.sceneCreateZone = False
         self.sceneCreateSkybox = False
         self.trasfObjects = False
@@ -1409,6 +1432,11 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             update=PublishRuntimeSettings) 
 
 
+    runtimeIncrementalExport : BoolProperty(
+            name = "Incremental export",
+            description = "Auto export also geometry, material and animation changes, only of the changed objects",
+            default = False)
+
     runtimeAutostart : BoolProperty(
             name = "Autostart Runtime",
             description = "Autostart Runtime after 2secs no ping",
@@ -1717,10 +1745,85 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             default = True)
             
     optimizeIndices : BoolProperty(
-            name = "Optimize indices (slow)",
+            name = "Optimize indices",
             description = "Linear-Speed vertex cache optimisation",
+            default = True)
+
+    vertexCacheSize : IntProperty(
+            name = "Vertex cache size",
+            description = "Number of vertices in the GPU post-transform cache used by the optimisation",
+            min = 4, max = 256,
+            default = 32)
+
+    optimizeOverdraw : BoolProperty(
+            name = "Optimize overdraw",
+            description = "Sort clusters of triangles so that the outer ones are drawn first",
+            default = False)
+
+    overdrawThreshold : FloatProperty(
+            name = "ACMR threshold",
+            description = "How much the vertex cache efficiency (ACMR) can get worse to reduce overdraw",
+            default = 1.05,
+            min = 1.0,
+            max = 3.0,
+            step = 1,
+            precision = 2)
+
+    optimizeVertexFetch : BoolProperty(
+            name = "Optimize vertex fetch",
+            description = "Sort vertices in the vertex buffer by first use in the index buffer",
+            default = True)
+
+    splitLargeGeometries : BoolProperty(
+            name = "Split for 16-bit indices",
+            description = "Split geometries with more than 65535 vertices in spatial parts that can use 16-bit indices "
+                          "(adds geometries to the model: material indices of the split geometries change)",
             default = False)
 
+    modelFormat : EnumProperty(
+            name = "Model format",
+            description = "File format of the models",
+            items=(('UMDL', "UMDL", "Legacy format, float normals and blend weights"),
+                   ('UMD2', "UMD2", "Vertex declarations, blend weights packed in bytes")),
+            default = 'UMDL')
+
+    packNormals : BoolProperty(
+            name = "Pack normals",
+            description = "Pack normals and tangents in bytes, shaders must decode them with n * 2 - 1 (not with morphs)",
+            default = False)
+
+    weldTolerance : FloatProperty(
+            name = "Weld tolerance",
+            description = "Merge vertices whose position, normal and UV differ less than this value (0 = only identical vertices)",
+            default = 0.0,
+            min = 0.0,
+            max = 1.0,
+            step = 1,
+            precision = 5)
+
+    decomposeWorkers : IntProperty(
+            name = "Worker processes",
+            description = "Decompose the meshes in this number of background processes (0 = in Blender)",
+            min = 0, max = 64,
+            default = 0)
+
+    writerThreads : IntProperty(
+            name = "Writer threads",
+            description = "Threads writing the files while the export continues (0 = write on the main thread)",
+            min = 0, max = 32,
+            default = 4)
+
+    meshCache : BoolProperty(
+            name = "Mesh cache",
+            description = "Save the decomposed meshes in the .urho_cache folder of the output path and reuse them if the mesh and the options are the same",
+            default = False)
+
+    meshCacheSize : IntProperty(
+            name = "Cache size (MB)",
+            description = "When the cache is bigger the least recently used meshes are deleted",
+            min = 1, max = 1048576,
+            default = 1024)
+
     # --- Components settings ---
 
     skeletons : BoolProperty(
@@ -1833,6 +1936,45 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             description = "Do not export tracks which contain only one keyframe, useful for layered animations",
             default = False)
 
+    reduceKeyframes : BoolProperty(
+            name = "Reduce keyframes",
+            description = "Remove the keyframes which can be interpolated from their neighbours within the errors below",
+            default = False)
+
+    pruneStaticChannels : BoolProperty(
+            name = "Prune static channels",
+            description = "Remove the position, rotation or scale of a track when it does not change, "
+                          "and the tracks of bones which stay in the bind pose (changes the blending with other animations)",
+            default = False)
+
+    reducePositionError : FloatProperty(
+            name = "Position error",
+            description = "Max position error of a bone chain (world units)",
+            default = 0.001,
+            min = 0.0,
+            max = 1.0,
+            step = 1,
+            precision = 4)
+
+    reduceRotationError : FloatProperty(
+            name = "Rotation error",
+            description = "Max rotation error of a bone",
+            subtype = 'ANGLE',
+            default = radians(0.1),
+            min = 0.0,
+            max = radians(10.0),
+            step = 1,
+            precision = 3)
+
+    reduceScaleError : FloatProperty(
+            name = "Scale error",
+            description = "Max scale error of a bone",
+            default = 0.001,
+            min = 0.0,
+            max = 1.0,
+            step = 1,
+            precision = 4)
+
     geometries : BoolProperty(
             name = "Geometries",
             description = "Export vertex buffers, index buffers, geometries, lods",
@@ -1960,6 +2102,27 @@ class UrhoExportSettings(bpy.types.PropertyGroup):
             default = True,
             update = update_func)
 
+    sceneFormat : EnumProperty(
+            name = "Scene format",
+            description = "File format of the scenes and prefabs",
+            items=(('XML', "XML", "Urho3D XML scenes and prefabs (.xml)"),
+                   ('BINARY', "Binary", "Urho3D binary scenes and prefabs (.bin), faster to load")),
+            default = 'XML')
+
+    sceneXmlDump : BoolProperty(
+            name = "XML dump",
+            description = "Write the XML file next to each binary scene or prefab, for debugging",
+            default = False)
+
+    sceneSchemaFile : StringProperty(
+            name = "Schema",
+            description = "JSON file with the attributes layouts of the components, dumped from the runtime "
+                          "(needed for the lights, physics, animated models and other components written by the exporter, "
+                          "and for custom components)",
+            maxlen = 512,
+            default = "",
+            subtype = 'FILE_PATH')
+
     sceneCreateZone : BoolProperty(
             name = "Create a default Zone",
             description = "Create DefaultZone-Node with -2000|-2000|-2000 2000|2000|2000",
@@ -2414,7 +2577,10 @@ class UrhoExportCommandOperator(bpy.types.Operator):
     bl_label = "Export command"
   
     def execute(self, context):
-        ExecuteAddon(context, silent=True, ignoreGeoAnim=True)
+        if context.scene.urho_exportsettings.runtimeIncrementalExport:
+            ExecuteIncrementalExport(context)
+        else:
+            ExecuteAddon(context, silent=True, ignoreGeoAnim=True)
         return {'FINISHED'}
  
     def invoke(self, context, event):
@@ -2979,6 +3145,7 @@ class UrhoExportRenderPanel(bpy.types.Panel):
         row.separator()
         row.separator()
         row.prop(settings,"runtimeAutoUpdateTransforms",text="Export on transform")
+        row.prop(settings,"runtimeIncrementalExport",text="Incremental")
         row.prop(settings,"showLog")    
 
 
@@ -3142,6 +3309,30 @@ class UrhoExportRenderPanel(bpy.types.Panel):
         #TODO: what and why
         #box.prop(settings, "geometrySplit")
         box.prop(settings, "optimizeIndices")
+        if settings.optimizeIndices:
+            row = box.row()
+            row.separator()
+            row.prop(settings, "vertexCacheSize")
+        box.prop(settings, "optimizeOverdraw")
+        if settings.optimizeOverdraw:
+            row = box.row()
+            row.separator()
+            row.prop(settings, "overdrawThreshold")
+        box.prop(settings, "optimizeVertexFetch")
+        box.prop(settings, "splitLargeGeometries")
+        box.prop(settings, "modelFormat")
+        if settings.modelFormat == 'UMD2':
+            row = box.row()
+            row.separator()
+            row.prop(settings, "packNormals")
+        box.prop(settings, "weldTolerance")
+        box.prop(settings, "decomposeWorkers")
+        box.prop(settings, "writerThreads")
+        box.prop(settings, "meshCache")
+        if settings.meshCache:
+            row = box.row()
+            row.separator()
+            row.prop(settings, "meshCacheSize")
         box.prop(settings, "lods")
         if settings.lods:
             row = box.row()
@@ -3194,6 +3385,15 @@ class UrhoExportRenderPanel(bpy.types.Panel):
             row.prop(settings, "animationRot")
             row.prop(settings, "animationSca")
             column.prop(settings, "filterSingleKeyFrames")
+            column.prop(settings, "reduceKeyframes")
+            column.prop(settings, "pruneStaticChannels")
+            if settings.reduceKeyframes or settings.pruneStaticChannels:
+                row = column.row()
+                row.separator()
+                col = row.column()
+                col.prop(settings, "reducePositionError")
+                col.prop(settings, "reduceRotationError")
+                col.prop(settings, "reduceScaleError")
         
         row = box.row()
         row.prop(settings, "geometries")
@@ -3282,6 +3482,19 @@ class UrhoExportRenderPanel(bpy.types.Panel):
             row.prop(settings, "scenePrefab")
             row.label(text="", icon='WORLD')
 
+            row = box.row()
+            row.separator()
+            row.prop(settings, "sceneFormat")
+            if settings.sceneFormat == 'BINARY':
+                row = box.row()
+                row.separator()
+                row.separator()
+                row.prop(settings, "sceneXmlDump")
+                row = box.row()
+                row.separator()
+                row.separator()
+                row.prop(settings, "sceneSchemaFile")
+
             # if settings.scenePrefab:
             #     row = box.row()
             #     row.prop(settings,"sceneCreateZone")
@@ -3905,11 +4118,48 @@ def has_non_objectmode_parent(obj):
         current_parent = current_parent.parent
     return False
 
+# Kinds of changes of an updated ID, saved in UpdateCheck.dirty
+def GetUpdateKinds(update):
+    id = update.id.original
+    kinds = set()
+    if isinstance(id, bpy.types.NodeTree):
+        # The trees embedded in materials update their material too
+        if not getattr(id, "is_embedded_data", False) and id.bl_idname in NODETREE_DIRTY_KINDS:
+            kinds.add(NODETREE_DIRTY_KINDS[id.bl_idname])
+    elif isinstance(id, bpy.types.Material):
+        kinds.add(DIRTY_SHADING)
+    elif isinstance(id, bpy.types.Action):
+        kinds.add(DIRTY_ANIMATION)
+    else:
+        if update.is_updated_transform:
+            kinds.add(DIRTY_TRANSFORM)
+        if update.is_updated_geometry:
+            kinds.add(DIRTY_GEOMETRY)
+        if update.is_updated_shading:
+            kinds.add(DIRTY_SHADING)
+    return kinds
+
 @persistent
 def on_depsgraph_update_post(self):
+    # Ignore the changes made by the export itself
+    if UpdateCheck.saving:
+        return
+
     # Recache
     depsgraph = bpy.context.evaluated_depsgraph_get()
 
+    # Save every updated ID for the incremental export
+    for update in depsgraph.updates:
+        try:
+            kinds = GetUpdateKinds(update)
+            if kinds:
+                UpdateCheck.AddDirty(update.id.original, kinds)
+                # Export geometries and materials changes only when out of edit modes
+                if (kinds - {DIRTY_TRANSFORM}) and bpy.context.mode == "OBJECT":
+                    UpdateCheck.request_export = True
+        except:
+            pass
+
     if len(depsgraph.updates)>0:
         for update in depsgraph.updates:
             try:
@@ -3978,6 +4228,22 @@ def callback_after_nodetreecreation():
 
 JSONNodetreeUtils.AfterNodeTreeCreationCallback=callback_after_nodetreecreation
 
+# Kinds of changes in the dirty set
+DIRTY_TRANSFORM = "TRANSFORM"
+DIRTY_GEOMETRY = "GEOMETRY"
+DIRTY_MATERIAL = "MATERIAL"
+DIRTY_SHADING = "SHADING"
+DIRTY_ANIMATION = "ANIMATION"
+DIRTY_COMPONENTS = "COMPONENTS"
+
+# Kind of change of a node tree by its type, the changes go to its users
+NODETREE_DIRTY_KINDS = {
+    "urho3dmaterials": DIRTY_MATERIAL,
+    "urho3dcomponents": DIRTY_COMPONENTS,
+    "GeometryNodeTree": DIRTY_GEOMETRY,
+    "ShaderNodeTree": DIRTY_SHADING
+}
+
 class UpdateCheck:
     last_pos = None
     last_rot = None
@@ -3985,14 +4251,44 @@ class UpdateCheck:
     last_obj = None
 
     request_save_scene = False
+    # A change that is not a transform needs an export (only incremental export)
+    request_export = False
     pos=None
     rot=None
     scale=None
     modified_obj=None  
     timer = 1.0 
 
+    # An export is running or its changes are not yet evaluated, the updates are ignored
     saving = False 
 
+    # IDs changed since the last export: (ID type, name) to set of DIRTY_ kinds
+    dirty = {}
+
+    # Key of an ID in the dirty set, node trees of all the types have the same ID type
+    @staticmethod
+    def Key(id):
+        if isinstance(id, bpy.types.NodeTree):
+            return ("NodeTree", id.name)
+        return (type(id).__name__, id.name)
+
+    @staticmethod
+    def AddDirty(id, kinds):
+        UpdateCheck.dirty.setdefault(UpdateCheck.Key(id), set()).update(kinds)
+
+    @staticmethod
+    def TakeDirty():
+        dirty = UpdateCheck.dirty
+        UpdateCheck.dirty = {}
+        return dirty
+
+# Timer callback to stop ignoring the updates after an export: the changes made by the
+# export (shape keys, modes, temporary objects) are evaluated after the export operator,
+# before the timers of the next events loop
+def EndSaving():
+    UpdateCheck.saving = False
+    return None
+
 # timer callback
 #if 'call_execution_queue' not in globals():
 def call_execution_queue():
@@ -4010,6 +4306,9 @@ def call_execution_queue():
             #print("PingData.auto_timer %s" % PingData.ping_auto_timer)
 
         settings = bpy.context.scene.urho_exportsettings
+        if UpdateCheck.request_export and settings.runtimeIncrementalExport:
+            UpdateCheck.request_save_scene = True
+            UpdateCheck.request_export = False
         if UpdateCheck.request_save_scene and settings.outputPath:
             UpdateCheck.timer-=tick
             #print("Check[%s]: %s=%s %s=%s %s=%s " %(UpdateCheck.timer,UpdateCheck.last_pos,UpdateCheck.pos,UpdateCheck.last_rot,UpdateCheck.rot,UpdateCheck.last_scale,UpdateCheck.scale))
@@ -4579,7 +4878,8 @@ def selectErrors(context, errorsMem, errorName):
 #-------------------------------------------------------------------------
 # Export materials only
 #-------------------------------------------------------------------------
-def ExecuteUrhoExportMaterialsOnly(context):
+# Write the material nodetrees, only the ones named in 'materialTrees' if not None
+def ExecuteUrhoExportMaterialsOnly(context, materialTrees=None):
     global logList
 
     # Check Blender version
@@ -4609,7 +4909,13 @@ def ExecuteUrhoExportMaterialsOnly(context):
     fOptions.paths[PathType.OBJECTS] = settings.objectsPath
     fOptions.paths[PathType.SCENES] = settings.scenesPath
 
-    UrhoWriteMaterialTrees(fOptions,True)
+    writeIndex.Reset(bpy.path.abspath(settings.outputPath))
+    writerPool.Start(settings.writerThreads)
+    try:
+        UrhoWriteMaterialTrees(fOptions,True,materialTrees)
+    finally:
+        writerPool.Finish()
+    LogWriteStats()
 
 
 #-------------------------------------------------------------------------
@@ -4617,7 +4923,8 @@ def ExecuteUrhoExportMaterialsOnly(context):
 #-------------------------------------------------------------------------
 
 
-def ExecuteUrhoExport(context):
+# 'prefabObjects', 'materialTrees': see SOptions (incremental export)
+def ExecuteUrhoExport(context, prefabObjects=None, materialTrees=None):
     global logList
 
     # Check Blender version
@@ -4682,6 +4989,10 @@ def ExecuteUrhoExport(context):
     tOptions.doAnimationRot = settings.animationRot
     tOptions.doAnimationSca = settings.animationSca
     tOptions.filterSingleKeyFrames = settings.filterSingleKeyFrames
+    tOptions.doReduceKeyframes = settings.reduceKeyframes
+    tOptions.reducePositionError = settings.reducePositionError
+    tOptions.reduceRotationError = settings.reduceRotationError
+    tOptions.reduceScaleError = settings.reduceScaleError
     tOptions.doGeometries = settings.geometries
     tOptions.doGeometryPos = settings.geometryPos
     tOptions.doGeometryNor = settings.geometryNor
@@ -4696,6 +5007,9 @@ def ExecuteUrhoExport(context):
     tOptions.doMorphTan = settings.morphTan
     tOptions.doMorphUV = settings.morphTan
     tOptions.doOptimizeIndices = settings.optimizeIndices
+    tOptions.vertexCacheSize = settings.vertexCacheSize
+    tOptions.weldTolerance = settings.weldTolerance
+    tOptions.decomposeWorkers = settings.decomposeWorkers
     tOptions.doMaterials = settings.materials or settings.textures
     tOptions.bonesGlobalOrigin = settings.bonesGlobalOrigin
     tOptions.actionsGlobalOrigin = settings.actionsGlobalOrigin
@@ -4740,6 +5054,22 @@ def ExecuteUrhoExport(context):
     sOptions.globalOrigin = tOptions.globalOrigin
     sOptions.orientation = tOptions.orientation
     sOptions.objectsPath = settings.objectsPath
+    sOptions.sceneFormat = settings.sceneFormat
+    sOptions.sceneXmlDump = settings.sceneXmlDump
+    sOptions.prefabObjects = prefabObjects
+    sOptions.materialTrees = materialTrees
+    if settings.sceneFormat == 'BINARY':
+        sOptions.sceneSchema = LoadSceneSchema(bpy.path.abspath(settings.sceneSchemaFile))
+        if settings.exportLangType == "cs":
+            log.error("Binary scenes cannot contain C# components, use the XML format")
+            return False
+        missingTypes = MissingSchemaTypes(sOptions.sceneSchema)
+        if missingTypes:
+            log.error("Binary scenes need the layouts of {:s} in the scene schema file"
+                      .format(", ".join(missingTypes)))
+            return False
+        fOptions.exts[PathType.OBJECTS] = "bin"
+        fOptions.exts[PathType.SCENES] = "bin"
 
     fOptions.useSubDirs = settings.useSubDirs
     fOptions.fileOverwrite = settings.fileOverwrite
@@ -4824,13 +5154,23 @@ def ExecuteUrhoExport(context):
             bpy.context.scene.collection.objects.link(new_obj)
             print ("LODSET:%s" % lodset.name)
 
+    if settings.meshCache:
+        cachePath = os.path.join(bpy.path.abspath(settings.outputPath), CACHE_FOLDER)
+        tOptions.meshCache = MeshCache(cachePath, settings.meshCacheSize * 1048576)
+
     # Decompose
     if DEBUG: ttt = time.time() #!TIME
     Scan(context, tDataList, settings.errorsMem, tOptions)
     if DEBUG: print("[TIME] Decompose in {:.4f} sec".format(time.time() - ttt) ) #!TIME
 
+    if tOptions.meshCache:
+        log.info("Mesh cache: {:d} hits, {:d} misses".format(tOptions.meshCache.hits, tOptions.meshCache.misses))
+        tOptions.meshCache.Evict()
+
     # keep track of all meshes that we processed and avoid multiple handling
     processedMeshes = []
+    # UrhoExportData of each exported TData, by id, for the objects sharing its mesh
+    exportedData = {}
 
     # Export each decomposed object
     for tData in tDataList:
@@ -4844,13 +5184,37 @@ def ExecuteUrhoExport(context):
         uExportOptions = UrhoExportOptions()
         uExportOptions.splitSubMeshes = settings.geometrySplit
         uExportOptions.useStrictLods = settings.strictLods
+        uExportOptions.vertexCacheSize = settings.vertexCacheSize
+        uExportOptions.optimizeOverdraw = settings.optimizeOverdraw
+        uExportOptions.overdrawThreshold = settings.overdrawThreshold
+        uExportOptions.optimizeVertexFetch = settings.optimizeVertexFetch
+        uExportOptions.splitLargeGeometries = settings.splitLargeGeometries
+        uExportOptions.modelFormat = settings.modelFormat
+        uExportOptions.packNormals = settings.packNormals
         uExportOptions.useRatioTriggers = settings.animationRatioTriggers
+        uExportOptions.pruneStaticChannels = settings.pruneStaticChannels
+        uExportOptions.prunePositionError = settings.reducePositionError
+        uExportOptions.pruneRotationError = settings.reduceRotationError
+        uExportOptions.pruneScaleError = settings.reduceScaleError
         uExportOptions.bonesPerGeometry = addonPrefs.bonesPerGeometry
         uExportOptions.bonesPerVertex = addonPrefs.bonesPerVertex
         uExportOptions.clampBoundingBox = settings.clampBoundingBox
 
         if DEBUG: ttt = time.time() #!TIME
-        UrhoExport(tData, uExportOptions, uExportData, settings.errorsMem)
+        sharedExportData = None
+        if tData.sharedTData:
+            sharedExportData = exportedData.get(id(tData.sharedTData))
+        if sharedExportData:
+            # Same mesh of a previous object: reuse its models with this object name and
+            # its model files, its animations are already written
+            for uSharedModel in sharedExportData.models:
+                uModel = copy.copy(uSharedModel)
+                uModel.name = tData.objectName
+                uExportData.models.append(uModel)
+            uExportData.materials = sharedExportData.materials
+        else:
+            UrhoExport(tData, uExportOptions, uExportData, settings.errorsMem)
+        exportedData[id(tData)] = uExportData
         if DEBUG: print("[TIME] Export in {:.4f} sec".format(time.time() - ttt) ) #!TIME
         if DEBUG: ttt = time.time() #!TIME
 
@@ -4862,6 +5226,10 @@ def ExecuteUrhoExport(context):
                 uModel.isEmpty=obj.type=="EMPTY" or (sOptions.wiredAsEmpty and obj.display_type=="WIRE")
                 if uModel.isEmpty:
                     uModel.meshName=obj.name
+                elif sharedExportData:
+                    # Same mesh of a previous object: keep the model file of that object
+                    # (meshName of the copied model), it is written only once
+                    pass
                 else:
                     if obj.lodsetID>0:
                         lodset = getLodSetWithID(obj.lodsetID)
@@ -4893,7 +5261,7 @@ def ExecuteUrhoExport(context):
                 if uModel.geometries:
                     if CheckFilepath(filepath[0], fOptions):
                         log.info( "Creating model {:s}".format(filepath[1]) )
-                        UrhoWriteModel(uModel, filepath[0])
+                        UrhoWriteModel(uModel, filepath[0], uExportOptions.modelFormat, uExportOptions.packNormals)
                         # mark this mesh to be processed and avoid another export
                         processedMeshes.append(uModel.meshName)
             
@@ -4946,11 +5314,8 @@ def ExecuteUrhoExport(context):
                     elif not os.path.exists(srcFilename):
                         log.error( "Missing source texture {:s}".format(srcFilename) )
                     else:
-                        try:
-                            log.info( "Copying texture {:s}".format(filepath[1]) )
-                            shutil.copyfile(src = srcFilename, dst = filepath[0])
-                        except:
-                            log.error( "Cannot copy texture to {:s}".format(filepath[0]) )
+                        log.info( "Copying texture {:s}".format(filepath[1]) )
+                        CopyFile(srcFilename, filepath[0])
 
 
                     
@@ -4976,7 +5341,95 @@ def ExecuteUrhoExport(context):
     return True
 
 
-def ExecuteAddon(context, silent=False, ignoreGeoAnim=False, onlySelectedMesh=False):
+# What to export again for the changes in the dirty set. Returns the mesh objects to
+# decompose again (changed geometry, mesh, shading, materials, geometry nodes, action
+# or armature), the names of the objects whose prefabs change (with their parents, the
+# prefabs of the root objects have the children) and the names of the changed material
+# nodetrees.
+def GetIncrementalChanges(scene, dirty):
+    def IsDirty(id, kinds=None):
+        if id is None:
+            return False
+        idKinds = dirty.get(UpdateCheck.Key(id))
+        return bool(idKinds) and (kinds is None or not idKinds.isdisjoint(kinds))
+
+    def HasDirtyAction(obj):
+        return obj and obj.animation_data and obj.animation_data.action and IsDirty(obj.animation_data.action)
+
+    def HasDirtyGeometryNodes(obj):
+        return any(modifier.type == 'NODES' and IsDirty(modifier.node_group) for modifier in obj.modifiers)
+
+    # Materials changed or using a changed shader node group
+    dirtyMaterials = set()
+    hasShading = any(DIRTY_SHADING in kinds for kinds in dirty.values())
+    for material in (bpy.data.materials if hasShading else ()):
+        if IsDirty(material) or (material.node_tree and any(node.type == 'GROUP' and IsDirty(node.node_tree)
+                                                            for node in material.node_tree.nodes)):
+            dirtyMaterials.add(material.name)
+
+    def HasDirtyMaterial(obj):
+        return any(slot.material and slot.material.name in dirtyMaterials for slot in obj.material_slots)
+
+    # Nodetrees of the components and of the materials (a predefined material changes the
+    # material of the nodes)
+    def HasDirtyNodetrees(obj):
+        slots = list(getattr(obj, "nodetrees", ()))
+        if obj.type == 'MESH' and obj.data:
+            slots += list(getattr(obj.data, "materialNodetrees", ()))
+        return any(IsDirty(slot.nodetreePointer, (DIRTY_COMPONENTS, DIRTY_MATERIAL)) for slot in slots)
+
+    objects = []
+    prefabObjects = set()
+    for obj in scene.objects:
+        if obj.type == 'MESH' and (IsDirty(obj, (DIRTY_GEOMETRY, DIRTY_SHADING)) or IsDirty(obj.data) or
+                HasDirtyAction(obj) or HasDirtyGeometryNodes(obj) or HasDirtyMaterial(obj) or
+                (obj.parent and obj.parent.type == 'ARMATURE' and
+                (IsDirty(obj.parent, (DIRTY_GEOMETRY,)) or HasDirtyAction(obj.parent)))):
+            objects.append(obj)
+        elif not IsDirty(obj) and not HasDirtyNodetrees(obj):
+            continue
+        parent = obj
+        while parent and parent.name not in prefabObjects:
+            prefabObjects.add(parent.name)
+            parent = parent.parent
+
+    materialTrees = set(name for (typeName, name), kinds in dirty.items()
+                        if typeName == "NodeTree" and DIRTY_MATERIAL in kinds)
+    return objects, prefabObjects, materialTrees
+
+# Export only what changed since the last export: the changed material nodetrees, the
+# changed objects, then the scene without geometries with only the prefabs of the
+# changed objects
+def ExecuteIncrementalExport(context):
+    dirty = UpdateCheck.TakeDirty()
+    objects, prefabObjects, materialTrees = GetIncrementalChanges(context.scene, dirty)
+
+    if materialTrees:
+        log.info("Incremental export: materials {:s}".format(", ".join(sorted(materialTrees))))
+        ExecuteUrhoExportMaterialsOnly(context, materialTrees)
+
+    if not objects:
+        ExecuteAddon(context, silent=True, ignoreGeoAnim=True,
+                     prefabObjects=prefabObjects, materialTrees=set())
+    else:
+        log.info("Incremental export: {:s}".format(", ".join(obj.name for obj in objects)))
+        selectedObjects = context.selected_objects
+        activeObject = context.view_layer.objects.active
+        bpy.ops.object.select_all(action='DESELECT')
+        for obj in objects:
+            obj.select_set(True)
+        try:
+            ExecuteAddon(context, silent=True, onlySelectedMesh=True,
+                         prefabObjects=prefabObjects, materialTrees=set())
+        finally:
+            bpy.ops.object.select_all(action='DESELECT')
+            for obj in selectedObjects:
+                obj.select_set(True)
+            context.view_layer.objects.active = activeObject
+
+# 'prefabObjects', 'materialTrees': see SOptions (incremental export)
+def ExecuteAddon(context, silent=False, ignoreGeoAnim=False, onlySelectedMesh=False,
+                 prefabObjects=None, materialTrees=None):
     UpdateCheck.saving = True
 
     if len(bpy.data.worlds)==0:
@@ -5020,7 +5473,13 @@ def ExecuteAddon(context, silent=False, ignoreGeoAnim=False, onlySelectedMesh=Fa
 
     startTime = time.time()
     print("----------------------Urho export start----------------------")    
-    ExecuteUrhoExport(context)
+    writeIndex.Reset(bpy.path.abspath(settings.outputPath))
+    writerPool.Start(settings.writerThreads)
+    try:
+        ExecuteUrhoExport(context, prefabObjects, materialTrees)
+    finally:
+        writerPool.Finish()
+    LogWriteStats()
 
     log.setLevel(logging.DEBUG)
 
@@ -5050,7 +5509,7 @@ def ExecuteAddon(context, silent=False, ignoreGeoAnim=False, onlySelectedMesh=Fa
     settings.scenePrefab = True
     
     if export_no_geo_afterwards:
-        ExecuteAddon(context, True, True, False)
+        ExecuteAddon(context, True, True, False, prefabObjects, materialTrees)
 
 
     log.info("Export ended in {:.4f} sec".format(time.time() - startTime) )
@@ -5058,7 +5517,7 @@ def ExecuteAddon(context, silent=False, ignoreGeoAnim=False, onlySelectedMesh=Fa
     if not silent:
         bpy.ops.urho.report('INVOKE_DEFAULT')
 
-    UpdateCheck.saving = False
+    bpy.app.timers.register(EndSaving, first_interval=tick)
 
 
             
@@ -0,0 +1,231 @@
+#
+# This script is licensed as public domain.
+#
+
+# Animation curves evaluation and transforms on NumPy arrays.
+# This module must not import bpy or mathutils: it is also used outside Blender.
+
+import numpy as np
+
+#--------------------
+# F-curves evaluation
+#--------------------
+
+# Keyframe interpolations (Blender eBezTriple_Interpolation), the others (easings) are
+# not evaluated here
+IPO_CONSTANT = 0
+IPO_LINEAR   = 1
+IPO_BEZIER   = 2
+
+# Keyframes closer than this to a frame give their value (BEZT_BINARYSEARCH_THRESH)
+KEY_THRESHOLD = 0.01
+
+# Iterations of the bisection which finds the Bezier parameter of a frame
+BEZIER_ITERATIONS = 40
+
+# Check if the keyframes interpolations can be evaluated by EvaluateKeyframes
+def CanEvaluateKeyframes(interpolations):
+    return bool(np.all((interpolations >= IPO_CONSTANT) & (interpolations <= IPO_BEZIER)))
+
+# Bezier of the segments: fit the handles in the segments like Blender does
+# (BKE_fcurve_correct_bezpart), so the curve time is monotonic
+def CorrectBezierHandles(p0, p1, p2, p3):
+    h1 = p0 - p1
+    h2 = p3 - p2
+    len1 = np.abs(h1[:, 0])
+    len2 = np.abs(h2[:, 0])
+    length = p3[:, 0] - p0[:, 0]
+    total = len1 + len2
+    fac = np.ones(len(p0))
+    over = (total > length) & (total > 0.0)
+    fac[over] = length[over] / total[over]
+    return p0 - h1 * fac[:, None], p3 - h2 * fac[:, None]
+
+def Bezier(a, b, c, d, u):
+    v = 1.0 - u
+    return v * v * v * a + 3.0 * v * v * u * b + 3.0 * v * u * u * c + u * u * u * d
+
+# Evaluate a F-curve at the frames, like Blender does without modifiers.
+# 'co', 'handleLeft', 'handleRight' are (keys x 2) arrays sorted by time, 'interpolations'
+# the keys interpolation (only IPO_CONSTANT, IPO_LINEAR, IPO_BEZIER), 'linear' True if
+# the curve extrapolation is linear.
+def EvaluateKeyframes(co, handleLeft, handleRight, interpolations, linear, frames):
+    co = np.asarray(co, dtype=np.float64)
+    handleLeft = np.asarray(handleLeft, dtype=np.float64)
+    handleRight = np.asarray(handleRight, dtype=np.float64)
+    frames = np.asarray(frames, dtype=np.float64)
+    count = len(co)
+    times = co[:, 0]
+    values = np.empty(len(frames))
+
+    # Before the first keyframe
+    first = co[0]
+    before = frames <= first[0]
+    values[before] = first[1]
+    if linear and interpolations[0] != IPO_CONSTANT:
+        if interpolations[0] == IPO_LINEAR:
+            # Slope to the next keyframe
+            dx = co[1, 0] - first[0] if count > 1 else 0.0
+            dy = co[1, 1] - first[1] if count > 1 else 0.0
+        else:
+            # Slope of the left handle
+            dx = first[0] - handleLeft[0, 0]
+            dy = first[1] - handleLeft[0, 1]
+        if dx:
+            values[before] = first[1] - dy / dx * (first[0] - frames[before])
+
+    # After the last keyframe
+    last = co[-1]
+    after = (frames >= last[0]) & ~before
+    values[after] = last[1]
+    if linear and interpolations[-1] != IPO_CONSTANT:
+        if interpolations[-1] == IPO_LINEAR:
+            # Slope from the previous keyframe
+            dx = last[0] - co[-2, 0] if count > 1 else 0.0
+            dy = last[1] - co[-2, 1] if count > 1 else 0.0
+        else:
+            # Slope of the right handle
+            dx = handleRight[-1, 0] - last[0]
+            dy = handleRight[-1, 1] - last[1]
+        if dx:
+            values[after] = last[1] + dy / dx * (frames[after] - last[0])
+
+    inside = ~(before | after)
+    if not inside.any():
+        return values
+
+    # Frames on a keyframe take its value
+    insideFrames = frames[inside]
+    insideValues = np.empty(len(insideFrames))
+    nearest = np.clip(np.searchsorted(times, insideFrames), 1, count - 1)
+    nearest = np.where(np.abs(times[nearest - 1] - insideFrames) <= np.abs(times[nearest] - insideFrames),
+                       nearest - 1, nearest)
+    exact = np.abs(times[nearest] - insideFrames) < KEY_THRESHOLD
+    insideValues[exact] = co[nearest[exact], 1]
+
+    # Segment of the other frames, its interpolation is the one of its start keyframe
+    segment = np.clip(np.searchsorted(times, insideFrames, side='right') - 1, 0, count - 2)
+    todo = ~exact
+    t = insideFrames[todo]
+    start = segment[todo]
+    end = start + 1
+    p0 = co[start]
+    p3 = co[end]
+    ipo = interpolations[start]
+    result = np.empty(len(t))
+
+    constant = (ipo == IPO_CONSTANT)
+    result[constant] = p0[constant, 1]
+
+    lin = (ipo == IPO_LINEAR)
+    dx = p3[lin, 0] - p0[lin, 0]
+    fac = np.divide(t[lin] - p0[lin, 0], dx, out=np.zeros(len(dx)), where=(dx != 0.0))
+    result[lin] = p0[lin, 1] + fac * (p3[lin, 1] - p0[lin, 1])
+
+    bez = (ipo == IPO_BEZIER)
+    if bez.any():
+        b0 = p0[bez]
+        b3 = p3[bez]
+        b1 = handleRight[start[bez]]
+        b2 = handleLeft[end[bez]]
+        tb = t[bez]
+        # Flat segment
+        flat = (b1[:, 1] == b0[:, 1]) & (b2[:, 1] == b3[:, 1]) & (b0[:, 1] == b3[:, 1])
+        b1, b2 = CorrectBezierHandles(b0, b1, b2, b3)
+        # Find the curve parameter of the frame, the curve time is monotonic
+        low = np.zeros(len(tb))
+        high = np.ones(len(tb))
+        for i in range(BEZIER_ITERATIONS):
+            u = (low + high) * 0.5
+            early = Bezier(b0[:, 0], b1[:, 0], b2[:, 0], b3[:, 0], u) < tb
+            low = np.where(early, u, low)
+            high = np.where(early, high, u)
+        u = (low + high) * 0.5
+        bezValues = Bezier(b0[:, 1], b1[:, 1], b2[:, 1], b3[:, 1], u)
+        result[bez] = np.where(flat, b0[:, 1], bezValues)
+
+    insideValues[todo] = result
+    values[inside] = insideValues
+    return values
+
+#--------------------
+# Transforms
+#--------------------
+
+# Quaternions (w, x, y, z) product
+def QuaternionsMultiply(a, b):
+    aw, ax, ay, az = a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+    bw, bx, by, bz = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    return np.stack((aw * bw - ax * bx - ay * by - az * bz,
+                     aw * bx + ax * bw + ay * bz - az * by,
+                     aw * by - ax * bz + ay * bw + az * bx,
+                     aw * bz + ax * by - ay * bx + az * bw), axis=1)
+
+# Quaternions of the rotations of angles (n) around an axis (n x 3), a zero axis is no rotation
+def AxisAnglesToQuaternions(axes, angles):
+    length = np.linalg.norm(axes, axis=1)
+    valid = length > 0.0
+    half = np.where(valid, angles, 0.0) * 0.5
+    axes = np.divide(axes, length[:, None], out=np.zeros_like(axes), where=valid[:, None])
+    return np.concatenate((np.cos(half)[:, None], axes * np.sin(half)[:, None]), axis=1)
+
+# Quaternions of Euler angles (n x 3) with the rotation order ('XYZ': X then Y then Z)
+def EulersToQuaternions(eulers, order):
+    result = None
+    for axisName in order:
+        axis = "XYZ".index(axisName)
+        axes = np.zeros((len(eulers), 3))
+        axes[:, axis] = 1.0
+        q = AxisAnglesToQuaternions(axes, eulers[:, axis])
+        result = q if result is None else QuaternionsMultiply(q, result)
+    return result
+
+# Transform matrices (n x 4 x 4) of translations, quaternions and scales (location, rotation,
+# scale like Blender)
+def ComposeMatrices(translations, quaternions, scales):
+    length = np.linalg.norm(quaternions, axis=1)
+    q = np.divide(quaternions, length[:, None], out=np.tile([1.0, 0.0, 0.0, 0.0], (len(quaternions), 1)),
+                  where=(length > 0.0)[:, None])
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    matrices = np.zeros((len(q), 4, 4))
+    matrices[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    matrices[:, 0, 1] = 2.0 * (x * y - w * z)
+    matrices[:, 0, 2] = 2.0 * (x * z + w * y)
+    matrices[:, 1, 0] = 2.0 * (x * y + w * z)
+    matrices[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    matrices[:, 1, 2] = 2.0 * (y * z - w * x)
+    matrices[:, 2, 0] = 2.0 * (x * z - w * y)
+    matrices[:, 2, 1] = 2.0 * (y * z + w * x)
+    matrices[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    matrices[:, :3, :3] *= scales[:, None, :]
+    matrices[:, :3, 3] = translations
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+# Translations, quaternions (w >= 0) and scales of transform matrices (n x 4 x 4), like
+# Matrix.to_translation, to_quaternion, to_scale
+def DecomposeMatrices(matrices):
+    translations = matrices[:, :3, 3].copy()
+    scales = np.linalg.norm(matrices[:, :3, :3], axis=1)
+    m = np.divide(matrices[:, :3, :3], scales[:, None, :], out=np.zeros((len(matrices), 3, 3)),
+                  where=(scales > 0.0)[:, None, :])
+    m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+    q = np.empty((len(m), 4))
+    # Largest of w, x, y, z first, for precision
+    trace = 1.0 + m00 + m11 + m22
+    cases = np.argmax(np.stack((trace, 1.0 + m00 - m11 - m22, 1.0 - m00 + m11 - m22, 1.0 - m00 - m11 + m22), axis=1), axis=1)
+    c = cases == 0
+    s = 2.0 * np.sqrt(np.maximum(trace[c], 0.0))
+    q[c] = np.stack((0.25 * s, (m[c, 2, 1] - m[c, 1, 2]) / s, (m[c, 0, 2] - m[c, 2, 0]) / s, (m[c, 1, 0] - m[c, 0, 1]) / s), axis=1)
+    c = cases == 1
+    s = 2.0 * np.sqrt(np.maximum(1.0 + m00[c] - m11[c] - m22[c], 0.0))
+    q[c] = np.stack(((m[c, 2, 1] - m[c, 1, 2]) / s, 0.25 * s, (m[c, 0, 1] + m[c, 1, 0]) / s, (m[c, 0, 2] + m[c, 2, 0]) / s), axis=1)
+    c = cases == 2
+    s = 2.0 * np.sqrt(np.maximum(1.0 - m00[c] + m11[c] - m22[c], 0.0))
+    q[c] = np.stack(((m[c, 0, 2] - m[c, 2, 0]) / s, (m[c, 0, 1] + m[c, 1, 0]) / s, 0.25 * s, (m[c, 1, 2] + m[c, 2, 1]) / s), axis=1)
+    c = cases == 3
+    s = 2.0 * np.sqrt(np.maximum(1.0 - m00[c] - m11[c] + m22[c], 0.0))
+    q[c] = np.stack(((m[c, 1, 0] - m[c, 0, 1]) / s, (m[c, 0, 2] + m[c, 2, 0]) / s, (m[c, 1, 2] + m[c, 2, 1]) / s, 0.25 * s), axis=1)
+    q /= np.linalg.norm(q, axis=1)[:, None]
+    q[q[:, 0] < 0.0] *= -1.0
+    return translations, q, scales
@@ -46,99 +46,32 @@ import bpy
 import bmesh
 import math
 import time as ostime
-from mathutils import Vector, Matrix, Quaternion, Euler, Color
+from mathutils import Vector, Matrix, Quaternion, Color
 from collections import OrderedDict
 import os
 import operator
-import heapq
 import logging
 import re
+import site
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from .meshops import TransformArray, VertexStore, VERTEX_CACHE_SIZE, WeightsMatrix, \
+    RecordMeshJob, VertexStoreFromArrays, ShareArrays, WorkerFunction, shared_memory
+from .animops import CanEvaluateKeyframes, EvaluateKeyframes, AxisAnglesToQuaternions, EulersToQuaternions, \
+    ComposeMatrices, DecomposeMatrices
 
 log = logging.getLogger("ExportLogger")
+# Set of the animation objects already decomposed
 decomposedActions = None
+# Map of the actions channels: action to the tuple (set of the bones names in the F-curves
+# data paths, True if some F-curves are not of bones), filled once per export
+actionsChannels = None
+
 #------------------
 # Geometry classes
 #------------------
 
-# Vertex class
-class TVertex:
-    def __init__(self):
-        # Index of the vertex in the Blender buffer
-        self.blenderIndex = None
-        # Position of the vertex: Vector((0.0, 0.0, 0.0))
-        self.pos = None
-        # Normal of the vertex: Vector((0.0, 0.0, 0.0))
-        self.normal = None
-        # Color of the vertex: (0, 0, 0, 0)...(255, 255, 255, 255)
-        self.color = None
-        # UV coordinates of the vertex: Vector((0.0, 0.0))..Vector((1.0, 1.0))
-        self.uv = None
-        # UV2 coordinates of the vertex: Vector((0.0, 0.0))..Vector((1.0, 1.0))
-        self.uv2 = None
-        # Tangent of the vertex: Vector((0.0, 0.0, 0.0, 0.0))
-        self.tangent = None
-        # Bitangent of the vertex: Vector((0.0, 0.0, 0.0))
-        self.bitangent = None
-        # Bones weights: list of tuple(boneIndex, weight)
-        self.weights = None
-
-    # returns True is this vertex is a changed morph of vertex 'other'
-    def isMorphed(self, other):
-        # TODO: compare floats with a epsilon margin?
-        if other.pos is None:
-            return True
-        if self.pos and self.pos != other.pos:
-            return True
-        if self.normal and self.normal != other.normal:
-            return True
-        # We cannot use tangent, it is not calculated yet
-        if self.uv and self.uv != other.uv:
-            return True
-        return False
-
-    # used by the function index() of lists
-    def __eq__(self, other):
-        # TODO: can we do without weights?
-        # TODO: compare floats with a epsilon margin?
-        #return (self.__dict__ == other.__dict__)
-        return (self.pos == other.pos and 
-                self.normal == other.normal and 
-                self.uv == other.uv and
-				self.color == other.color)
-
-    def isEqual(self, other):
-        # TODO: compare floats with a epsilon margin?
-        return self == other
-                
-    def __hash__(self):
-        hashValue = 0
-        if self.pos:
-            hashValue ^= hash(self.pos.x) ^ hash(self.pos.y) ^ hash(self.pos.z)
-        if self.normal:
-            hashValue ^= hash(self.normal.x) ^ hash(self.normal.y) ^ hash(self.normal.z)
-        if self.uv:
-            hashValue ^= hash(self.uv.x) ^ hash(self.uv.y)
-        if self.color:
-            hashValue ^= hash((self.color[3] << 24) | (self.color[2] << 16) | (self.color[1] << 8) | self.color[0])
-        return hashValue
-    
-    def __str__(self):
-        s  = "  coords: {: .3f} {: .3f} {: .3f}".format(self.pos.x, self.pos.y, self.pos.z)
-        s += "\n normals: {: .3f} {: .3f} {: .3f}".format(self.normal.x, self.normal.y, self.normal.z)
-        if self.color:
-            s += "\n   color: {:3d} {:3d} {:3d} {:3d}".format(self.color[0], self.color[1], self.color[2], self.color[3])
-        if self.uv:
-            s += "\n      uv: {: .3f} {: .3f}".format(self.uv[0], self.uv[1])
-        if self.uv2:
-            s += "\n     uv2: {: .3f} {: .3f}".format(self.uv2[0], self.uv2[1])
-        if self.tangent:
-            s += "\n tangent: {: .3f} {: .3f} {: .3f}".format(self.tangent.x, self.tangent.y, self.tangent.z)
-        if self.weights:
-            s += "\n weights: "
-            for w in self.weights:
-                s += "{:d} {:.3f}  ".format(w[0],w[1])
-        return s
-
 # Geometry LOD level class
 class TLodLevel:
     def __init__(self):
@@ -183,15 +116,17 @@ class TMorph:
         self.indexSet = set()
         # List of triangles of the morph (triples of vertex indices)
         self.triangleList = []
-        # Maps vertex index to morphed TVertex
-        self.vertexMap = {}
+        # Array of the vertex indices affected by the morph (in the order they were added)
+        self.indices = np.zeros(0, dtype=np.int64)
+        # VertexStore of the morphed vertices, same order of 'indices'
+        self.vertices = VertexStore()
 
     def __str__(self):  
         s = " name: {:s}\n".format(self.name)
         s += " Vertices: "
-        for k, v in sorted(self.vertices.items()):
+        for k, v in sorted(zip(self.indices.tolist(), self.vertices), key=operator.itemgetter(0)):
             s += "\n  index: {:d}".format(k)
-            s += "\n" + str(v)
+            s += "\n  coords: {: .3f} {: .3f} {: .3f}".format(*v.pos)
         return s
 
 #-------------------
@@ -317,8 +252,8 @@ class TData:
     def __init__(self):
         self.objectName = None
         self.blenderObjectName = None
-        # List of all the TVertex of all the geometries
-        self.verticesList = []
+        # VertexStore of all the vertices of all the geometries
+        self.vertices = VertexStore()
         # List of TGeometry, they contains triangles, triangles are made of vertex indices
         self.geometriesList = []
         # List of TMorph: a subset of the vertices list with modified position
@@ -334,6 +269,9 @@ class TData:
         # Common TAnimation, one track per object
         self.commonAnimation = None
         self.hasLODs = False
+        # TData of a previous object with the same mesh and settings, this object uses
+        # its decomposed data (and this TData stays empty)
+        self.sharedTData = None
 
 class TOptions:
     def __init__(self):
@@ -376,6 +314,12 @@ class TOptions:
         self.doAnimationRot = True
         self.doAnimationSca = True
         self.filterSingleKeyFrames = False
+        # Remove the keyframes which can be interpolated from their neighbours within these
+        # errors (position in world units, rotation in radians, scale as a ratio)
+        self.doReduceKeyframes = False
+        self.reducePositionError = 0.001
+        self.reduceRotationError = math.radians(0.1)
+        self.reduceScaleError = 0.001
         self.doGeometries = True
         self.doGeometryPos = True
         self.doGeometryNor = True
@@ -390,411 +334,15 @@ class TOptions:
         self.doMorphTan = True
         self.doMorphUV = True
         self.doOptimizeIndices = True
+        self.vertexCacheSize = VERTEX_CACHE_SIZE
+        self.weldTolerance = 0.0
+        self.decomposeWorkers = 0
+        # MeshCache of the decomposed meshes, None to disable
+        self.meshCache = None
         self.doMaterials = True
         self.meshNameDerivedBy = None
         
 
-#--------------------
-# “Computing Tangent Space Basis Vectors for an Arbitrary Mesh” by Lengyel, Eric. 
-# Terathon Software 3D Graphics Library, 2001.
-# http://www.terathon.com/code/tangent.html
-#--------------------
-        
-def GenerateTangents(tLodLevels, tVertexList, errorsMem):
-
-    if not tVertexList:
-        log.warning("No vertices, tangent generation cancelled.")
-        return
-
-    nullUvIndices = None
-    incompleteUvIndices = None
-    if errorsMem:
-        nullUvIndices = errorsMem.Get("null UV area", set() )
-        incompleteUvIndices = errorsMem.Get("incomplete UV", set() )
-
-    # Init the values
-    tangentOverwritten = 0    
-    for tLodLevel in reversed(tLodLevels):
-        if not tLodLevel.indexSet or not tLodLevel.triangleList:
-            log.warning("Empty LOD, tangent generation skipped.")
-            tLodLevels.remove(tLodLevel)
-            continue
-        
-        for vertexIndex in tLodLevel.indexSet:
-            vertex = tVertexList[vertexIndex]
-            
-            # Check if the tangent was already calculated (4 components) for this vertex and we're overwriting it
-            if vertex.tangent and len(vertex.tangent) == 4:
-                tangentOverwritten += 1
-                
-            # Check if we have all the needed data to do the calculations
-            if vertex.pos is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing position on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            if vertex.normal is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing normal on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            if vertex.uv is None:
-                if incompleteUvIndices is not None:
-                    incompleteUvIndices.add(vertex.blenderIndex)
-                log.warning("Missing UV on vertex {:d}, tangent generation cancelled.".format(vertex.blenderIndex[1]))
-                return
-            
-            # Init tangent (3 components) and bitangent vectors
-            vertex.tangent = Vector((0.0, 0.0, 0.0))
-            vertex.bitangent = Vector((0.0, 0.0, 0.0))
-
-    if tangentOverwritten:
-        log.warning("Overwriting {:d} tangents".format(tangentOverwritten))
-
-    # Calculate tangent and bitangent
-    invalidUV = False
-    for tLodLevel in tLodLevels:
-        for i, triangle in enumerate(tLodLevel.triangleList):
-            # For each triangle, we have 3 vertices vertex1, vertex2, vertex3, each of the have their UV coordinates, we want to 
-            # find two unit orthogonal vectors (tangent and bitangent) such as we can express each vertex position as a function
-            # of the vertex UV: 
-            #  VertexPosition = Tangent * f'(VertexUV) + BiTangent * f"(VertexUV)
-            # Actually we are going to express them relatively to a vertex chosen as origin (vertex1):
-            #  vertex - vertex1 = Tangent * (vertex.u - vertex1.u) + BiTangent * (vertex.v - vertex1.v)
-            # We have two equations, one for vertex2-vertex1 and one for vertex3-vertex1, if we put them in a system and solve it
-            # we can obtain Tangent and BiTangent:
-            #  [T; B] = [u1, v1; u2, v2]^-1 * [V2-V1; V3-V1]
-            
-            vertex1 = tVertexList[triangle[0]]
-            vertex2 = tVertexList[triangle[1]]
-            vertex3 = tVertexList[triangle[2]]
-
-            # First equation: [x1, y1, z1] = Tangent * u1 + BiTangent * v1
-            x1 = vertex2.pos.x - vertex1.pos.x
-            y1 = vertex2.pos.y - vertex1.pos.y
-            z1 = vertex2.pos.z - vertex1.pos.z
-
-            u1 = vertex2.uv.x - vertex1.uv.x
-            v1 = vertex2.uv.y - vertex1.uv.y
-
-            # Second equation: [x2, y2, z2] = Tangent * u2 + BiTangent * v2
-            x2 = vertex3.pos.x - vertex1.pos.x
-            y2 = vertex3.pos.y - vertex1.pos.y
-            z2 = vertex3.pos.z - vertex1.pos.z
-
-            u2 = vertex3.uv.x - vertex1.uv.x
-            v2 = vertex3.uv.y - vertex1.uv.y
-
-            # Determinant of the matrix [u1 v1; u2 v2]
-            d = u1 * v2 - u2 * v1
-            
-            # If the determinant is zero then the points (0,0), (u1,v1), (u2,v2) are in line, this means
-            # the area on the UV map of this triangle is null. This is an error, we must skip this triangle.
-            if d == 0:
-                if nullUvIndices is not None:
-                    nullUvIndices.add(vertex1.blenderIndex)
-                    nullUvIndices.add(vertex2.blenderIndex)
-                    nullUvIndices.add(vertex3.blenderIndex)
-                invalidUV = True
-                continue
-
-            t = Vector( ((v2 * x1 - v1 * x2) / d, (v2 * y1 - v1 * y2) / d, (v2 * z1 - v1 * z2) / d) )
-            b = Vector( ((u1 * x2 - u2 * x1) / d, (u1 * y2 - u2 * y1) / d, (u1 * z2 - u2 * z1) / d) )
-            
-            vertex1.tangent += t;
-            vertex2.tangent += t;
-            vertex3.tangent += t;
-            
-            vertex1.bitangent += b;
-            vertex2.bitangent += b;
-            vertex3.bitangent += b;
-
-    if invalidUV:
-        log.error("Invalid UV, the area in the UV map is too small.")
-
-    # Gram-Schmidt orthogonalize normal, tangent and bitangent
-    for tLodLevel in tLodLevels:
-        for vertexIndex in tLodLevel.indexSet:
-            vertex = tVertexList[vertexIndex]
-            # Skip already calculated vertices
-            if len(vertex.tangent) == 4:
-                continue
-                
-            # Unit vector perpendicular to normal and in the same plane of normal and tangent
-            tOrtho = ( vertex.tangent - vertex.normal * vertex.normal.dot(vertex.tangent) ).normalized()
-            # Unit vector perpendicular to the plane of normal and tangent
-            bOrtho = vertex.normal.cross(vertex.tangent).normalized()
-
-            # Calculate handedness: if bOrtho and bitangent have the different directions, save the verse
-            # in tangent.w, so we can reconstruct bitangent by: tangent.w * normal.cross(tangent)
-            w = 1.0 if bOrtho.dot(vertex.bitangent) >= 0.0 else -1.0
-            
-            vertex.bitangent = bOrtho
-            vertex.tangent = Vector((tOrtho.x, tOrtho.y, tOrtho.z, w))
-
-
-        
-#--------------------
-# Linear-Speed Vertex Cache Optimisation algorithm by Tom Forsyth
-#  https://home.comcast.net/~tom_forsyth/papers/fast_vert_cache_opt.html
-#--------------------
-
-# This is an optimized version, but it is still slow.
-# (on an average pc, 5 minutes for 30K smooth vertices)
-
-#  We try to sort triangles in the index buffer so that we gain an optimal use
-#  of the hardware vertices cache.
-#  We assign a score to each triangle, we find the best and save it in a new 
-#  ordered list.
-#  The score of each triangle is the sum of the score of its vertices, and the
-#  score of a vertex is higher if it is:
-#  - used recently (it is still in the cache) but we also try to avoid the last
-#    triangle added (n this way we get better result),
-#  - lonely isolated vertices (otherwise the will be keep for last and drawing
-#    them will require an higher cost)
-#  The order of vertices in the triangle does not matter.
-#  We'll apply this optimization to each lod of each geometry.
-
-# These are the constants used in the algorithm:
-VERTEX_CACHE_SIZE = 32
-CACHE_DECAY_POWER = 1.5
-LAST_TRI_SCORE = 0.75
-VALENCE_BOOST_SCALE = 2.0
-VALENCE_BOOST_POWER = 0.5
-
-def CalculateScore(rank):
-
-    if rank.useCount == 0:
-        rank.score = -1.0
-        return
-
-    score = 0.0
-    cachePosition = rank.cachePosition
-    
-    if cachePosition < 0:
-        # Vertex is not in FIFO cache - no score
-        pass
-    elif cachePosition < 3:
-        # This vertex was used in the last triangle,
-        # so it has a fixed score, whichever of the three
-        # it's in. Otherwise, you can get very different
-        # answers depending on whether you add
-        # the triangle 1,2,3 or 3,1,2 - which is silly.
-        score = LAST_TRI_SCORE
-    else:
-        # Points for being high in the cache
-        score = 1.0 - float(rank.cachePosition - 3) / (VERTEX_CACHE_SIZE - 3)
-        score = pow(score, CACHE_DECAY_POWER)
-
-    # Bonus points for having a low number of tris still to
-    # use the vert, so we get rid of lone verts quickly
-    valenceBoost = VALENCE_BOOST_SCALE * pow(rank.useCount, -VALENCE_BOOST_POWER);
-    rank.score = score + valenceBoost;
-
-# Triangles score list sizes
-TRIANGLERANK_SIZE = 500
-TRIANGLERANK_MAX_SIZE = 505
-
-def OptimizeIndices(lodLevel):
-    
-    # Ranks are used to store data for each vertex
-    class Rank:
-        def __init__(self):
-            self.score = 0.0
-            self.useCount = 1
-            self.cachePosition = -1
-    
-    # Create a map: vertex index to its corresponding Rank
-    ranking = {}
-    
-    # This list contains the original triangles (not in optimal order), we'll move them 
-    # one by one in a new list following the optimal order
-    oldTriangles = lodLevel.triangleList
-
-    # For each vertex index of each triangle increment the use counter
-    # (we can find the same vertex index more than once)
-    for triangle in oldTriangles:
-        for index in triangle:
-            try:
-                ranking[index].useCount += 1
-            except KeyError:
-                ranking[index] = Rank()
-
-    # Calculate the first round of scores
-    # (Rank is mutable, so CalculateScore will be able to modify it)
-    for rank in ranking.values():        
-        CalculateScore(rank)
-
-    # Ths list will contain the triangles sorted in optimal order
-    newTriangles = []
-
-    # Cache of vertex indices
-    vertexCache = []
-    
-    # The original algorithm was:
-    # - scan all the old triangles and find the one with the best score;
-    # - move it to the new triangles;
-    # - move its vertices in the cache;
-    # - recalculate the score on all the vertices on the cache.
-    # The slowest part is the first step, scanning all the old triangles,
-    # but in the last step we update only a little subset of these triangles,
-    # and it is a waste to recalculate the triangle score of each old triangle.
-    # So we do this:
-    # - create a map 'trianglesMap': vertex index to triangles;
-    # - keep a list 'trianglesRanking' of the best triangles;
-    # - at first this list is empty, we start adding triangles; we add tuples like
-    #   (score, triangle) and we keep track of the min score, we don't add triangles
-    #   with score lower than the min; for now we add triangles without bothering
-    #   about order; if the triangle is already present in the list we only update
-    #   its score (even if it is lower);
-    # - when the list is a little too big (TRIANGLERANK_MAX_SIZE), we sort the list 
-    #   by score and we only keep the best TRIANGLERANK_SIZE triangles, we update 
-    #   the min score;
-    # - after scanning all the old triangles, we take out from the list the best
-    #   triangle;
-    # - move it to the new triangles and remove it from the map;
-    # - move its vertices in the cache;
-    # - recalculate the score on all the vertices in the cache, if the score of one
-    #   vertex is changed, we use the map to find what triangles are affected and
-    #   we add them to the list (unordered and only if their score is > min);
-    # - now when we repeat we have the list already populated, so we don't need to
-    #   recalculate all old triangles scores, we only need to sort the list and take
-    #   out the best triangle.
-
-        
-    # Vertex index to triangle indices list map
-    trianglesMap = {}
-    # Populate the map
-    for triangle in oldTriangles:
-        for vertexIndex in triangle:
-            try:
-                triangleList = trianglesMap[vertexIndex]
-            except KeyError:
-                triangleList = []
-                trianglesMap[vertexIndex] = triangleList
-            triangleList.append(triangle)
-
-    class TrianglesRanking:
-        def __init__(self):
-            self.ranklist = []
-            self.min = None
-            self.isSorted = True
-    
-        def update(self, triangle):            
-            # Sum the score of all its vertex. 
-            # >> This is the slowest part of the algorithm <<
-            triangleScore = ranking[triangle[0]].score + ranking[triangle[1]].score + ranking[triangle[2]].score
-            # If needed, add it to the list
-            if not self.ranklist:
-                self.ranklist.append( (triangleScore, triangle) )
-                self.min = triangleScore
-            else:
-                # We add only triangles with score > min
-                if triangleScore > self.min:
-                    found = False
-                    # Search of the triangle is already present in the list
-                    for i, rank in enumerate(self.ranklist):
-                        if triangle == rank[1]:
-                            if triangleScore != rank[0]:
-                                self.ranklist[i] = (triangleScore, triangle)
-                                self.isSorted = False
-                            found = True
-                            break
-                    # It is a new triangle
-                    if not found:
-                        self.ranklist.append( (triangleScore, triangle) )
-                        self.isSorted = False
-
-        def sort(self):
-            if self.isSorted:
-                return
-            #self.ranklist = sorted(self.ranklist, key=operator.itemgetter(0), reverse=True)[:TRIANGLERANK_SIZE]
-            self.ranklist = heapq.nlargest(TRIANGLERANK_SIZE, self.ranklist, key = operator.itemgetter(0))
-            self.min = self.ranklist[-1][0]
-            self.isSorted = True
-        
-        def popBest(self):
-            bestTriangle = self.ranklist[0][1]
-            del self.ranklist[0]
-            return bestTriangle
-
-    trianglesRanking = TrianglesRanking()
-
-    # Progress counter
-    progressCur = 0
-    progressTot = 0.01 * len(oldTriangles)
-
-    if DEBUG: ttt = ostime.time() #!TIME
-
-    # While there still are unsorted triangles
-    while oldTriangles:
-        # Print progress
-        if (progressCur & 0x7F) == 0:
-            print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-        progressCur += 1
-        
-        # When the list is empty, we need to scan all the old triangles
-        if not trianglesRanking.ranklist:
-            for triangle in oldTriangles:
-                # We add the triangle but we don't search for the best one
-                trianglesRanking.update(triangle)
-                # If the list is too big, sort and truncate it
-                if len(trianglesRanking.ranklist) > TRIANGLERANK_MAX_SIZE:
-                    trianglesRanking.sort()
-
-        if trianglesRanking:
-            # Only if needed, we sort and truncate
-            trianglesRanking.sort()
-            # We take the best triangles out of the list
-            bestTriangle = trianglesRanking.popBest()
-        else:
-            log.error("Could not find next triangle")
-            return        
-        
-        # Move the best triangle to the output list
-        oldTriangles.remove(bestTriangle)
-        newTriangles.append(bestTriangle)
-            
-        # Model the LRU cache behaviour
-        # Recreate the cache removing the vertices of the best triangle
-        vertexCache = [i for i in vertexCache if i not in bestTriangle]
-        
-        for vertexIndex in bestTriangle:
-            # Then push them to the front
-            vertexCache.insert(0, vertexIndex)
-            # Decrement the use counter of its vertices
-            ranking[vertexIndex].useCount -= 1
-            # Remove best triangle from the map
-            triangleList = trianglesMap[vertexIndex]
-            triangleList.remove(bestTriangle)
-
-        # Update positions & scores of all vertices in the cache
-        # Give position -1 if vertex is going to be erased
-        for i, vertexIndex in enumerate(vertexCache):
-            rank = ranking[vertexIndex]
-            if (i > VERTEX_CACHE_SIZE):
-                rank.cachePosition = -1
-            else:
-                rank.cachePosition = i
-            # Calculate the new score
-            oldScore = rank.score
-            CalculateScore(rank)
-            # If the score is changed
-            if oldScore != rank.score:
-                # Add to the list all the triangles affected
-                triangleList = trianglesMap[vertexIndex]
-                for triangle in triangleList:   
-                    trianglesRanking.update(triangle)
-                
-        # Finally erase the extra vertices
-        vertexCache[:] = vertexCache[:VERTEX_CACHE_SIZE]
-
-    if DEBUG: print("[TIME2] {:.4f}".format(ostime.time() - ttt) ) #!TIME
-
-    # Rewrite the index data now
-    lodLevel.triangleList = newTriangles
-
-
 #--------------------
 # Decompose armatures
 #--------------------
@@ -1214,10 +762,350 @@ def DecomposeArmature(scene, armatureObj, meshObj, tData, tOptions):
 # then swap the second and third columns to get the left hand matrix.
 
 
+#--------------------
+# Reduce keyframes
+#--------------------
+
+# Smallest error used for the tolerances, a zero tolerance removes only the keyframes which
+# are (almost) exactly interpolated
+MIN_REDUCE_ERROR = 1e-7
+
+# Positions and scales between the keyframes 'a' and 'b' at the times ratios 't' (lerp like Urho)
+def LerpKeys(values, a, b, t):
+    return values[a] + (values[b] - values[a]) * t[:, None]
+
+# Rotations (w, x, y, z) between the keyframes 'a' and 'b' at the times ratios 't' (slerp like Urho)
+def SlerpKeys(rotations, a, b, t):
+    qa = rotations[a]
+    qb = rotations[b]
+    dot = np.dot(qa, qb)
+    # Take the shortest path
+    if dot < 0.0:
+        qb = -qb
+        dot = -dot
+    if dot > 0.9995:
+        # Almost the same rotation, normalized lerp
+        q = qa + (qb - qa) * t[:, None]
+        return q / np.linalg.norm(q, axis=1)[:, None]
+    angle = math.acos(min(dot, 1.0))
+    sinAngle = math.sin(angle)
+    wa = np.sin((1.0 - t) * angle) / sinAngle
+    wb = np.sin(t * angle) / sinAngle
+    return qa * wa[:, None] + qb * wb[:, None]
+
+# Remove from a track the keyframes that can be interpolated from the remaining ones within
+# the errors. The errors are measured in the space of the bone chain: 'reach' is the distance
+# from the bone to its farthest descendant, so a rotation or scale error is also checked
+# against the position error of the chain end, 'parentScale' scales the bone local space.
+def ReduceTrackKeyframes(tTrack, reach, parentScale, tOptions):
+    frames = tTrack.frames
+    count = len(frames)
+    if count <= 2:
+        return
+
+    positionError = max(tOptions.reducePositionError, MIN_REDUCE_ERROR)
+    rotationError = max(tOptions.reduceRotationError, MIN_REDUCE_ERROR)
+    scaleError = max(tOptions.reduceScaleError, MIN_REDUCE_ERROR)
+
+    times = np.array([frame.time for frame in frames], dtype=np.float64)
+    positions = None
+    rotations = None
+    scales = None
+    if frames[0].position is not None:
+        positions = np.array([frame.position[:] for frame in frames], dtype=np.float64)
+    if frames[0].rotation is not None:
+        rotations = np.array([frame.rotation[:] for frame in frames], dtype=np.float64)
+    if frames[0].scale is not None:
+        scales = np.array([frame.scale[:] for frame in frames], dtype=np.float64)
+
+    # Split the segments between the kept keyframes at the keyframe with the greatest
+    # error, until all the keyframes are within the errors (the first and the last are
+    # always kept)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, count - 1)]
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2:
+            continue
+        inner = np.arange(a + 1, b)
+        t = (times[inner] - times[a]) / (times[b] - times[a])
+        # Error of each keyframe as a ratio of the allowed error
+        error = np.zeros(len(inner))
+        if positions is not None:
+            delta = np.linalg.norm(LerpKeys(positions, a, b, t) - positions[inner], axis=1)
+            error = np.maximum(error, delta * parentScale / positionError)
+        if rotations is not None:
+            dot = np.abs(np.sum(SlerpKeys(rotations, a, b, t) * rotations[inner], axis=1))
+            angle = 2.0 * np.arccos(np.minimum(dot, 1.0))
+            error = np.maximum(error, angle / rotationError)
+            chainDelta = 2.0 * np.sin(angle * 0.5) * reach * parentScale
+            error = np.maximum(error, chainDelta / positionError)
+        if scales is not None:
+            delta = np.max(np.abs(LerpKeys(scales, a, b, t) - scales[inner]), axis=1)
+            error = np.maximum(error, delta / scaleError)
+            error = np.maximum(error, delta * reach * parentScale / positionError)
+        i = int(np.argmax(error))
+        if error[i] > 1.0:
+            keep[inner[i]] = True
+            segments.append((a, inner[i]))
+            segments.append((inner[i], b))
+
+    tTrack.frames = [frame for frame, kept in zip(frames, keep) if kept]
+
+# Reduce the keyframes of the tracks of an animation, logs the reduction ratio
+def ReduceKeyframes(animationName, tracks, bonesMap, tOptions):
+    tracksMap = {tTrack.name: tTrack for tTrack in tracks}
+    children = {}
+    for name, tBone in bonesMap.items():
+        if tBone.parentName:
+            children.setdefault(tBone.parentName, []).append(name)
+
+    # Distance from the bone origin to its farthest descendant point
+    reachMap = {}
+    def BoneReach(name):
+        reach = reachMap.get(name)
+        if reach is None:
+            reach = bonesMap[name].length
+            for child in children.get(name, []):
+                reach = max(reach, bonesMap[child].bindPosition.length + BoneReach(child))
+            reachMap[name] = reach
+        return reach
+
+    # Greatest scale of the bone in the animation (or its bind scale) by the one of its parents
+    scaleMap = {}
+    def ChainScale(name):
+        scale = scaleMap.get(name)
+        if scale is None:
+            tBone = bonesMap[name]
+            tTrack = tracksMap.get(name)
+            if tTrack and tTrack.frames and tTrack.frames[0].scale is not None:
+                scale = max(max(abs(v) for v in frame.scale) for frame in tTrack.frames)
+            else:
+                scale = max(abs(v) for v in tBone.bindScale)
+            if tBone.parentName in bonesMap:
+                scale *= ChainScale(tBone.parentName)
+            scaleMap[name] = scale
+        return scale
+
+    before = 0
+    after = 0
+    for tTrack in tracks:
+        before += len(tTrack.frames)
+        reach = 0.0
+        parentScale = 1.0
+        tBone = bonesMap.get(tTrack.name)
+        if tBone:
+            reach = BoneReach(tTrack.name)
+            if tBone.parentName in bonesMap:
+                parentScale = ChainScale(tBone.parentName)
+        ReduceTrackKeyframes(tTrack, reach, parentScale, tOptions)
+        after += len(tTrack.frames)
+
+    if after:
+        log.info("Keyframes of {:s} reduced from {:d} to {:d} ({:.1f}x)"
+                 .format(animationName, before, after, before / after))
+
 #--------------------
 # Decompose animations
 #--------------------
 
+# Bone name of a F-curve data path: pose.bones["name"].location
+BONE_PATH_RE = re.compile(r'^pose\.bones\["((?:[^"\\]|\\.)*)"\]')
+
+# Get the channels of an action (see actionsChannels)
+def ActionChannels(action):
+    channels = actionsChannels.get(action)
+    if channels is None:
+        bones = set()
+        hasObjectPaths = False
+        for curve in action.fcurves:
+            match = BONE_PATH_RE.match(curve.data_path)
+            if match:
+                bones.add(match.group(1).replace('\\"', '"').replace('\\\\', '\\'))
+            else:
+                hasObjectPaths = True
+        channels = (bones, hasObjectPaths)
+        actionsChannels[action] = channels
+    return channels
+
+# Check if an action animates an armature (its pose bones or, through drivers, its properties)
+# or an object
+def IsActionRelevant(action, obj):
+    bones, hasObjectPaths = ActionChannels(action)
+    if obj.type == 'ARMATURE':
+        if any(bone in obj.pose.bones for bone in bones):
+            return True
+        return hasObjectPaths and bool(obj.animation_data.drivers)
+    return hasObjectPaths
+
+# Check if the pose of an armature depends only on its Action, so it can be evaluated
+# without updating the scene (Pose.apply_pose_from_action is in Blender 3.0+)
+def CanEvaluatePoseOnly(armatureObj):
+    if not hasattr(bpy.types.Pose, "apply_pose_from_action"):
+        return False
+    # Drivers and constraints need the scene evaluation
+    if armatureObj.animation_data.drivers:
+        return False
+    for poseBone in armatureObj.pose.bones:
+        if poseBone.constraints:
+            return False
+    return True
+
+# Evaluate an Action on the pose of an armature at a frame, returns the bones matrices
+# in armature space (like PoseBone.matrix after a frame change)
+def EvaluatePoseMatrices(armatureObj, action, frameTime):
+    armatureObj.pose.apply_pose_from_action(action, evaluation_time=frameTime)
+    matrices = {}
+
+    def poseMatrix(poseBone):
+        matrix = matrices.get(poseBone.name)
+        if matrix is None:
+            bone = poseBone.bone
+            parent = poseBone.parent
+            if parent:
+                matrix = bone.convert_local_to_pose(poseBone.matrix_basis, bone.matrix_local,
+                            parent_matrix=poseMatrix(parent), parent_matrix_local=parent.bone.matrix_local)
+            else:
+                matrix = bone.convert_local_to_pose(poseBone.matrix_basis, bone.matrix_local)
+            matrices[poseBone.name] = matrix
+        return matrix
+
+    for poseBone in armatureObj.pose.bones:
+        poseMatrix(poseBone)
+    return matrices
+
+# Check if the pose of an armature can be computed from the F-curves of its Action alone:
+# no drivers, no constraints and bones which fully inherit the transform of their parent
+def CanEvaluateFcurves(armatureObj):
+    if armatureObj.animation_data.drivers:
+        return False
+    for poseBone in armatureObj.pose.bones:
+        if poseBone.constraints:
+            return False
+        bone = poseBone.bone
+        if not bone.use_inherit_rotation or not bone.use_local_location or bone.use_relative_parent:
+            return False
+        # Blender 2.81 replaced use_inherit_scale with inherit_scale
+        if not getattr(bone, "use_inherit_scale", True) or getattr(bone, "inherit_scale", 'FULL') != 'FULL':
+            return False
+    return True
+
+# Map of the F-curves of an action which are evaluated by Blender: data path to list of F-curves
+def ActionCurvesMap(action):
+    curvesMap = {}
+    for curve in action.fcurves:
+        if curve.mute or not (curve.keyframe_points or curve.modifiers):
+            continue
+        curvesMap.setdefault(curve.data_path, []).append(curve)
+    return curvesMap
+
+# Evaluate a F-curve at all the frames, the F-curves with modifiers or easing interpolations
+# are evaluated by Blender one frame at a time
+def EvaluateFcurve(curve, frames):
+    points = curve.keyframe_points
+    count = len(points)
+    if count and not curve.modifiers:
+        interpolations = np.empty(count, dtype=np.int32)
+        points.foreach_get("interpolation", interpolations)
+        if CanEvaluateKeyframes(interpolations):
+            co = np.empty(count * 2, dtype=np.float32)
+            handleLeft = np.empty(count * 2, dtype=np.float32)
+            handleRight = np.empty(count * 2, dtype=np.float32)
+            points.foreach_get("co", co)
+            points.foreach_get("handle_left", handleLeft)
+            points.foreach_get("handle_right", handleRight)
+            return EvaluateKeyframes(co.reshape(-1, 2), handleLeft.reshape(-1, 2), handleRight.reshape(-1, 2),
+                                     interpolations, curve.extrapolation == 'LINEAR', frames)
+    return np.array([curve.evaluate(frame) for frame in frames], dtype=np.float64)
+
+# Local transforms (matrix_basis, frames x 4 x 4) of a pose bone or object from the F-curves
+# of an action, the channels without F-curves keep their current values
+def SampleActionTransforms(actionCurves, poseBone, frames):
+
+    def Channel(name):
+        values = np.tile(np.array(getattr(poseBone, name)[:], dtype=np.float64), (len(frames), 1))
+        for curve in actionCurves.get(poseBone.path_from_id(name), []):
+            if curve.array_index < values.shape[1]:
+                values[:, curve.array_index] = EvaluateFcurve(curve, frames)
+        return values
+
+    rot_mode = poseBone.rotation_mode
+    if rot_mode == 'QUATERNION':
+        quaternions = Channel("rotation_quaternion")
+    elif rot_mode == 'AXIS_ANGLE':
+        axisAngles = Channel("rotation_axis_angle")
+        quaternions = AxisAnglesToQuaternions(axisAngles[:, 1:], axisAngles[:, 0])
+    else:
+        quaternions = EulersToQuaternions(Channel("rotation_euler"), rot_mode)
+    return ComposeMatrices(Channel("location"), quaternions, Channel("scale"))
+
+# Float32 values (frames x n) ordered like integers, to compare them with a tolerance of
+# one unit in the last place like mathutils does
+def FloatUlps(values):
+    bits = values.astype(np.float32).view(np.int32).astype(np.int64)
+    return np.where(bits < 0, -(bits & 0x7fffffff), bits)
+
+# Add to a track the frames of the transforms of a bone or object (frames x 4 x 4, relative to
+# its parent), converted like the frames sampled one at a time in DecomposeActions
+def AddTrackFrames(tTrack, matrices, frames, startframe, fps, isRoot, isArmature, originMatrix, tOptions):
+    # Root bone or object with no parent
+    if isRoot:
+        if isArmature:
+            # Root bone matrix relative to the armature
+            if tOptions.orientation:
+                matrices = np.array(tOptions.orientation.to_matrix().to_4x4()) @ matrices
+            matrices = np.array(Matrix.Rotation(math.radians(-90.0), 4, 'X' ) @ originMatrix) @ matrices
+        elif tOptions.orientation:
+            # Object animations: remove the orientation from the object, apply the animation then orient again
+            om = tOptions.orientation.to_matrix().to_4x4()
+            matrices = np.array(om) @ matrices @ np.array(om.inverted())
+
+    if tOptions.scale != 1.0:
+        matrices[:, :3, 3] *= tOptions.scale
+
+    t, q, s = DecomposeMatrices(matrices)
+
+    # Convert position, rotation and scale to left hand
+    if isArmature:
+        # Bone animation
+        tl = t * (1.0, 1.0, -1.0)
+        ql = q * (1.0, -1.0, -1.0, 1.0)
+        sl = s
+    else:
+        # Object animation
+        tl = t[:, (0, 2, 1)]
+        ql = q[:, (0, 1, 3, 2)] * (1.0, -1.0, -1.0, -1.0)
+        sl = s[:, (0, 2, 1)]
+
+    if not tOptions.doAnimationPos:
+        tl = None
+    if not tOptions.doAnimationRot:
+        ql = None
+    if not tOptions.doAnimationSca:
+        sl = None
+
+    # Append the frames only if they are the first, the last or if something moved from the
+    # last appended frame
+    moved = np.zeros(len(frames), dtype=bool)
+    moved[0] = moved[-1] = True
+    channels = [FloatUlps(values) for values in (tl, ql, sl) if values is not None]
+    if channels:
+        values = np.concatenate(channels, axis=1)
+        # Only the frames not equal to the previous one can differ from the last appended
+        changed = np.flatnonzero(np.any(values[1:] != values[:-1], axis=1)) + 1
+        last = values[0]
+        for i in changed.tolist():
+            if np.any(np.abs(values[i] - last) > 1):
+                moved[i] = True
+                last = values[i]
+
+    for i in np.flatnonzero(moved):
+        tTrack.frames.append(TFrame((frames[i] - startframe) / fps,
+                                    None if tl is None else Vector(tl[i]),
+                                    None if ql is None else Quaternion(ql[i]),
+                                    None if sl is None else Vector(sl[i])))
+
 def DecomposeActions(scene, armatureObj, tData, tOptions):
 
     # Class for storing a NlaStrip, its previous strip and its parent track
@@ -1228,6 +1116,15 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             self.previous = previous
             self.track = track
 
+    # Class for storing a bone (or object) to sample and its track
+    class BoneTrack:
+        def __init__(self, name, poseBone, parent):
+            self.poseBone = poseBone
+            self.parent = parent
+            self.tTrack = TTrack(name)
+            # Rest matrix relative to the parent, when evaluating the F-curves
+            self.restMatrix = None
+
     # Check if 'armatureObj' is an armature (skeleton animations) or a mesh (object animations)
     isArmature = (armatureObj.type == 'ARMATURE')
 
@@ -1312,14 +1209,20 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             log.warning('Object {:s} has no animation to export'.format(armatureObj.name))
         return
     
-    global decomposedActions
+    # Number of actions skipped because they do not animate this object
+    skippedActions = 0
 
     for object in animationObjects:
-        if (object in decomposedActions):
+        if object in decomposedActions:
             print("SKIPPING ACTION:%s"%object.name)
             continue
 
-        decomposedActions.append(object)
+        # With all the actions, skip the ones for other armatures or objects (facial, props, cameras)
+        if tOptions.doAllActions and isinstance(object, bpy.types.Action) and not IsActionRelevant(object, armatureObj):
+            skippedActions += 1
+            continue
+
+        decomposedActions.add(object)
 
         tAnimation = commonAnimation or TAnimation(object.name)
     
@@ -1425,11 +1328,12 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             # Object animation: use the object name, one track per object
             bones.append(armatureObj.name)
         elif tOptions.doOnlyKeyedBones:
-            # Get all the names of the bones used by the actions
+            # Get all the names of the bones used by the actions (groups and F-curves)
             boneSet = set()
             for action in actionSet:
                 for group in action.groups:
                     boneSet.add(group.name)
+                boneSet.update(ActionChannels(action)[0])
             # Add the bones name respecting the order of bonesMap
             for bone in bonesMap.keys():
                 if bone in boneSet:
@@ -1454,7 +1358,10 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
         # Progress counter
         progressCur = 0
         progressTot = 0.01 * len(bones) * (endframe-startframe)/scene.frame_step
-    
+
+        # Collect the pose bones and their tracks before sampling, the frames are the outer
+        # loop so each frame is set only once for all the bones
+        boneTracks = []
         for boneName in bones:
             if isArmature:
                 if not boneName in bonesMap:
@@ -1464,7 +1371,7 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
                 if not boneName in armatureObj.pose.bones:
                     log.warning("Pose does not contain bone {:s}".format(boneName))
                     continue
-                            
+
                 # Get the Blender pose bone (bpy.types.PoseBone)
                 poseBone = armatureObj.pose.bones[boneName]
                 parent = poseBone.parent
@@ -1473,160 +1380,151 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
                 poseBone = armatureObj
                 parent = armatureObj.parent
 
-            rot_mode = poseBone.rotation_mode
+            boneTrack = BoneTrack(boneName, poseBone, parent)
 
-            tTrack = TTrack(boneName)
+            if isArmature:
+                # Local rest matrix (relative to the parent)
+                restMatrix = poseBone.bone.matrix_local.copy()
+                if poseBone.parent:
+                    restMatrix = poseBone.parent.bone.matrix_local.inverted() @ restMatrix
+            elif parent:
+                # Object rest matrix (the local matrix is relative to the parent inverse)
+                restMatrix = poseBone.matrix_parent_inverse.copy()
+            else:
+                restMatrix = Matrix()
+            boneTrack.restMatrix = restMatrix
 
-            if actionFcurves:
-                # Fcurves data paths
-                position_path = poseBone.path_from_id("location")
-                scale_path = poseBone.path_from_id("scale")
-                if rot_mode == 'QUATERNION':
-                    rotation_path = poseBone.path_from_id("rotation_quaternion")
-                elif rot_mode == 'AXIS_ANGLE':
-                    rotation_path = poseBone.path_from_id("rotation_axis_angle")
-                else:
-                    rotation_path = poseBone.path_from_id("rotation_euler")
-                # Find the Fcurves of the current bone
-                position_curves = []
-                rotation_curves = []
-                scale_curves = []
-                for curve in actionFcurves:
-                    if curve.data_path == position_path:
-                        position_curves.append(curve)
-                    elif curve.data_path == rotation_path:
-                        rotation_curves.append(curve)
-                    elif curve.data_path == scale_path:
-                        scale_curves.append(curve)
-
-                if isArmature:
-                    # Local rest matrix (relative to the parent)
-                    restMatrix = poseBone.bone.matrix_local.copy()
-                    if poseBone.parent:
-                        restMatrix = poseBone.parent.bone.matrix_local.inverted() * restMatrix
-                else:
-                    # Object rest matrix
-                    restMatrix = Matrix()
+            boneTracks.append(boneTrack)
 
+        # When decomposing by F-curves, or when the armature plays only an Action and nothing else
+        # can move the bones, we evaluate the F-curves at all the frames without setting them.
+        # Else, if the bones are moved only by the Action, we evaluate the pose from the Action
+        # without updating the whole scene.
+        fcurvesAction = None
+        poseAction = None
+        if isinstance(object, bpy.types.Action):
+            if actionFcurves or (isArmature and CanEvaluateFcurves(armatureObj)):
+                fcurvesAction = object
+            elif isArmature and CanEvaluatePoseOnly(armatureObj):
+                poseAction = object
+                savedSelection = [(poseBone.bone, poseBone.bone.select) for poseBone in armatureObj.pose.bones]
+                # The Action is applied only to the selected bones, or to all if none is selected
+                for bone, select in savedSelection:
+                    bone.select = False
+
+        if fcurvesAction:
+            # All the frames at once for each bone
+            frames = list(range(startframe, endframe, scene.frame_step))
+            actionCurves = ActionCurvesMap(fcurvesAction)
+            for boneTrack in boneTracks:
+                print("{:.3f}%\r".format(progressCur / progressTot), end='' )
+                progressCur += len(frames)
+
+                # Local transforms relative to the parent
+                matrices = np.array(boneTrack.restMatrix) @ SampleActionTransforms(actionCurves, boneTrack.poseBone, frames)
+                AddTrackFrames(boneTrack.tTrack, matrices, frames, startframe, scene.render.fps,
+                               not boneTrack.parent, isArmature, originMatrix, tOptions)
+        else:
             # For each frame
             for frameTime in range(startframe, endframe, scene.frame_step):
-                
-                if (progressCur % 40) == 0:
-                    print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-                progressCur += 1
 
                 # Check if we are at the last frame
                 isLastFrame = (frameTime >= endframe - scene.frame_step)
-                
-                if actionFcurves:
-                    # Evaluate the Fcurves of the current bone at the current time
-
-                    # Evaluate the position
-                    curvePosition = Vector()
-                    for curve in position_curves:
-                        curvePosition[curve.array_index] = curve.evaluate(frameTime)
-
-                    # Evaluate the rotation
-                    curveRotation = Quaternion((1.0, 0.0, 0.0, 0.0))
-                    if rot_mode == 'QUATERNION':
-                        for curve in rotation_curves:
-                            curveRotation[curve.array_index] = curve.evaluate(frameTime)
-                    elif rot_mode == 'AXIS_ANGLE':
-                        angle_axis = Vector.Fill(4)
-                        for curve in rotation_curves:
-                            angle_axis[curve.array_index] = curve.evaluate(frameTime)
-                        curveRotation = Quaternion(angle_axis.yzw, angle_axis.x)
-                    else:
-                        eulerRotation = Euler((0.0, 0.0, 0.0), rot_mode)
-                        for curve in rotation_curves:
-                            eulerRotation[curve.array_index] = curve.evaluate(frameTime)
-                        curveRotation = eulerRotation.to_quaternion()
-                    # Between keyframes the quaternion components curves are interpolated, so the resulting
-                    # quaternion must be normalized (at keyframes the quaternions are already normalized)
-                    curveRotation.normalize()
-
-                    # Evaluate the scale
-                    curveScale = Vector((1.0, 1.0, 1.0))
-                    for curve in scale_curves:
-                        curveScale[curve.array_index] = curve.evaluate(frameTime)
-
-                    # Create the full trasformation matrix
-                    deltaMatrix = curveRotation.to_matrix().to_4x4()
-                    scaleMatrix = Matrix()
-                    for i in range(0, 3):
-                        scaleMatrix[i][i] = curveScale[i]
-                    deltaMatrix *= scaleMatrix
-                    deltaMatrix.translation = curvePosition
-
-                    # The matrix above is the rotation/scale/translation of the bone with respect to its rest
-                    # position relative to its parent. 
-                    # We apply the rest position to obtain the rotation/scale/translation of the bone with
-                    # respect to its parent.
-                    poseMatrix = restMatrix * deltaMatrix
 
+                if poseAction:
+                    poseMatrices = EvaluatePoseMatrices(armatureObj, poseAction, frameTime)
                 else:
-                    # Set frame (TODO: this is very slow, try to advance only the armature)
+                    # Set frame, once for all the bones
                     # (rna_Scene_frame_set, BKE_scene_update_for_newframe, BKE_animsys_evaluate_animdata)
                     scene.frame_set(frameTime)
-                
-                    if isArmature:
-                        # This matrix is referred to the armature (object space)
-                        poseMatrix = poseBone.matrix.copy()
+
+                for boneTrack in boneTracks:
+
+                    if (progressCur % 40) == 0:
+                        print("{:.3f}%\r".format(progressCur / progressTot), end='' )
+                    progressCur += 1
+
+                    poseBone = boneTrack.poseBone
+                    parent = boneTrack.parent
+                    tTrack = boneTrack.tTrack
+
+                    if poseAction:
+                        # Pose evaluated from the Action (armature object space)
+                        poseMatrix = poseMatrices[poseBone.name].copy()
 
                         if parent:
                             # Bone matrix relative to its parent bone
-                            poseMatrix = parent.matrix.inverted() @ poseMatrix
+                            poseMatrix = poseMatrices[parent.name].inverted() @ poseMatrix
                     else:
-                        # Object animations: use the matrix relative to the parent (local matrix)
-                        poseMatrix = poseBone.matrix_local.copy()
-
-                # Root bone or object with no parent
-                if not parent:
+                        if isArmature:
+                            # This matrix is referred to the armature (object space)
+                            poseMatrix = poseBone.matrix.copy()
+
+                            if parent:
+                                # Bone matrix relative to its parent bone
+                                poseMatrix = parent.matrix.inverted() @ poseMatrix
+                        else:
+                            # Object animations: use the matrix relative to the parent (local matrix)
+                            poseMatrix = poseBone.matrix_local.copy()
+
+                    # Root bone or object with no parent
+                    if not parent:
+                        if isArmature:
+                            # Root bone matrix relative to the armature
+                            if tOptions.orientation:
+                                poseMatrix = tOptions.orientation.to_matrix().to_4x4() @ poseMatrix
+                            poseMatrix = Matrix.Rotation(math.radians(-90.0), 4, 'X' ) @ originMatrix @ poseMatrix
+                        else:
+                            # Object animations: reorient the animations
+                            if tOptions.orientation:
+                                # Remove the orientation from the object, apply the animation then orient again
+                                om = tOptions.orientation.to_matrix().to_4x4()
+                                poseMatrix = om @ poseMatrix @ om.inverted()
+
+                    if tOptions.scale != 1.0:
+                        poseMatrix.translation *= tOptions.scale
+
+                    # Extract position and rotation relative to parent in parent space        
+                    t = poseMatrix.to_translation()
+                    q = poseMatrix.to_quaternion()
+                    s = poseMatrix.to_scale()
+                
+                    # Convert position, rotation and scale to left hand:
                     if isArmature:
-                        # Root bone matrix relative to the armature
-                        if tOptions.orientation:
-                            poseMatrix = tOptions.orientation.to_matrix().to_4x4() @ poseMatrix
-                        poseMatrix = Matrix.Rotation(math.radians(-90.0), 4, 'X' ) @ originMatrix @ poseMatrix
+                        # Bone animation
+                        tl = Vector((t.x, t.y, -t.z))
+                        ql = Quaternion((q.w, -q.x, -q.y, q.z))
+                        sl = Vector((s.x, s.y, s.z))
                     else:
-                        # Object animations: reorient the animations
-                        if tOptions.orientation:
-                            # Remove the orientation from the object, apply the animation then orient again
-                            om = tOptions.orientation.to_matrix().to_4x4()
-                            poseMatrix = om @ poseMatrix @ om.inverted()
-
-                if tOptions.scale != 1.0:
-                    poseMatrix.translation *= tOptions.scale
-
-                # Extract position and rotation relative to parent in parent space        
-                t = poseMatrix.to_translation()
-                q = poseMatrix.to_quaternion()
-                s = poseMatrix.to_scale()
-                
-                # Convert position, rotation and scale to left hand:
-                if isArmature:
-                    # Bone animation
-                    tl = Vector((t.x, t.y, -t.z))
-                    ql = Quaternion((q.w, -q.x, -q.y, q.z))
-                    sl = Vector((s.x, s.y, s.z))
-                else:
-                    # Object animation
-                    tl = Vector((t.x, t.z, t.y))
-                    ql = Quaternion((q.w, -q.x, -q.z, -q.y))
-                    sl = Vector((s.x, s.z, s.y))
-                
-                if not tOptions.doAnimationPos:
-                    tl = None
-                if not tOptions.doAnimationRot:
-                    ql = None
-                if not tOptions.doAnimationSca:
-                    sl = None
-
-                tFrame = TFrame((frameTime - startframe) / scene.render.fps, tl, ql, sl)
-
-                # Append the frame to the track only if it is the first, the last or if something moved
-                if not tTrack.frames or isLastFrame or tTrack.frames[-1].hasMoved(tFrame):
-                    tTrack.frames.append(tFrame)
+                        # Object animation
+                        tl = Vector((t.x, t.z, t.y))
+                        ql = Quaternion((q.w, -q.x, -q.z, -q.y))
+                        sl = Vector((s.x, s.z, s.y))
                 
+                    if not tOptions.doAnimationPos:
+                        tl = None
+                    if not tOptions.doAnimationRot:
+                        ql = None
+                    if not tOptions.doAnimationSca:
+                        sl = None
+
+                    tFrame = TFrame((frameTime - startframe) / scene.render.fps, tl, ql, sl)
+
+                    # Append the frame to the track only if it is the first, the last or if something moved
+                    if not tTrack.frames or isLastFrame or tTrack.frames[-1].hasMoved(tFrame):
+                        tTrack.frames.append(tFrame)
+
+        if poseAction:
+            # Restore the bones selection
+            for bone, select in savedSelection:
+                bone.select = select
+
+        # Remove the keyframes which can be interpolated from their neighbours
+        if tOptions.doReduceKeyframes:
+            ReduceKeyframes(object.name, [boneTrack.tTrack for boneTrack in boneTracks], bonesMap, tOptions)
+
+        for boneTrack in boneTracks:
+            tTrack = boneTrack.tTrack
             if tTrack.frames and (not tOptions.filterSingleKeyFrames or len(tTrack.frames) > 1):
                 tAnimation.tracks.append(tTrack)
 
@@ -1713,19 +1611,124 @@ def DecomposeActions(scene, armatureObj, tData, tOptions):
             if object.previous:
                 object.previous.mute = oldStripValue
 
+    if skippedActions:
+        log.info("Skipped {:d} actions which do not animate {:s}".format(skippedActions, armatureObj.name))
+
     # Restore initial action and frame
     armatureObj.animation_data.action = savedAction
     armatureObj.animation_data.use_nla = savedUseNla
     scene.frame_set(savedFrame)
 
 
+#---------------------------------
+# Bulk mesh extraction
+#---------------------------------
+
+# Read an attribute of all the items of a Blender collection in a contiguous array
+def ForeachGet(collection, attribute, width, dtype):
+    array = np.empty(len(collection) * width, dtype=dtype)
+    if array.size:
+        collection.foreach_get(attribute, array)
+    if width > 1:
+        array.shape = (-1, width)
+    return array
+
+# Same for boolean attributes, we pass a list because their raw type changed
+# between Blender versions
+def ForeachGetBool(collection, attribute):
+    values = [False] * len(collection)
+    if values:
+        collection.foreach_get(attribute, values)
+    return np.array(values, dtype=bool)
+
+# Mesh data extracted in arrays, positions and normals are already transformed and
+# with the Urho axes
+class TMeshArrays:
+    def __init__(self):
+        # Vertex positions (vertices x 3)
+        self.positions = None
+        # Vertex normals (vertices x 3)
+        self.normals = None
+        # Triangles Blender vertex indices (triangles x 3)
+        self.triVertices = None
+        # Triangles Blender loop indices (triangles x 3)
+        self.triLoops = None
+        # Triangles material index (triangles)
+        self.triMaterials = None
+        # Triangles with smooth shading (triangles)
+        self.triSmooth = None
+        # Triangles normals (triangles x 3)
+        self.triNormals = None
+        # Triangles with 3 unique vertices (triangles)
+        self.triValid = None
+        # Loops UV coordinates, V flipped (loops x 2)
+        self.uvs = None
+        # Loops UV2 coordinates, V flipped (loops x 2)
+        self.uvs2 = None
+        # Loops colors 0..255, alpha not used (loops x 4)
+        self.colors = None
+
+    # Normals of the triangles corners (triangles x 3 x 3): vertex normal if the
+    # triangle is smooth, otherwise triangle normal
+    def cornerNormals(self, triangles):
+        vertexNormals = self.normals[self.triVertices[triangles]]
+        triNormals = np.broadcast_to(self.triNormals[triangles, None, :], vertexNormals.shape)
+        return np.where(self.triSmooth[triangles, None, None], vertexNormals, triNormals)
+
+# UV layer data to array, flip V like "Vector((uv[0], 1.0 - uv[1]))"
+def UvToArray(uvData):
+    uv = ForeachGet(uvData, "uv", 2, np.float32)
+    uv[:, 1] = 1.0 - uv[:, 1].astype(np.float64)
+    return uv
+
+def ExtractMeshArrays(mesh, posMatrix, normalMatrix, uvs, uvs2, colorsRgb):
+
+    meshArrays = TMeshArrays()
+
+    triangles = mesh.loop_triangles
+    meshArrays.triVertices = ForeachGet(triangles, "vertices", 3, np.int32)
+    meshArrays.triLoops = ForeachGet(triangles, "loops", 3, np.int32)
+    meshArrays.triMaterials = ForeachGet(triangles, "material_index", 1, np.int32)
+    meshArrays.triSmooth = ForeachGetBool(triangles, "use_smooth")
+
+    # Skip triangles with less than 3 unique vertices
+    triVertices = meshArrays.triVertices
+    meshArrays.triValid = ((triVertices[:, 0] != triVertices[:, 1]) &
+                           (triVertices[:, 1] != triVertices[:, 2]) &
+                           (triVertices[:, 0] != triVertices[:, 2]))
+
+    positions = ForeachGet(mesh.vertices, "co", 3, np.float32)
+    meshArrays.positions = TransformArray(posMatrix, positions)
+
+    normals = ForeachGet(mesh.vertices, "normal", 3, np.float32)
+    meshArrays.normals = TransformArray(normalMatrix, normals)
+
+    triNormals = ForeachGet(triangles, "normal", 3, np.float32)
+    meshArrays.triNormals = TransformArray(normalMatrix, triNormals)
+
+    if uvs:
+        meshArrays.uvs = UvToArray(uvs)
+    if uvs2:
+        meshArrays.uvs2 = UvToArray(uvs2)
+
+    if colorsRgb:
+        colors = ForeachGet(colorsRgb, "color", 4, np.float32)
+        # Approx 255*float to the closest int (round half to even, like round())
+        meshArrays.colors = np.empty(colors.shape, dtype=np.int32)
+        meshArrays.colors[:, :3] = np.rint(colors[:, :3].astype(np.float64) * 255.0)
+        meshArrays.colors[:, 3] = 255
+
+    return meshArrays
+
+
 #---------------------------------
 # Decompose geometries and morphs
 #---------------------------------
 
-def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMaterial):
+# Decompose a mesh, if 'pool' is not None the job is sent to a worker process and its
+# TMeshJob is returned, it must be merged later with WaitMeshJob()
+def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMaterial, pool=None):
 
-    verticesList = tData.verticesList
     geometriesList = tData.geometriesList
     materialsList = tData.materialsList
     materialGeometryMap = tData.materialGeometryMap
@@ -1742,7 +1745,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
 
         #init map with all materials
 
-    morphsList = tData.morphsList
     bonesMap = tData.bonesMap
     meshIndex = errorsMem.SecondIndex(meshObj.name)
 
@@ -1757,8 +1759,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
         log.info("something went wrong decomposing:%s! ignoring it[%s]" % (meshObj.name,ex))
         return
 
-    verticesMap = {}
-    
     print("decompose mesh:%s" %meshObj.name)
 
     #Save existing shape key values, and set them to zero
@@ -1827,9 +1827,6 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     if tOptions.scale != 1.0:
         posMatrix = Matrix.Scale(tOptions.scale, 4) @ posMatrix 
 
-    # Vertices map: vertex Blender index to TVertex index
-    faceVertexMap = {}
-
     # Here we store geometriesList indices of geometries with new vertices in its last LOD
     # We use this to create a new LOD only once per geometry and to filter where we have
     # to optimize and recalculate tangents
@@ -1931,121 +1928,41 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
     #     if not mesh.materials:
     #         log.warning("Object {:s} has no materials data".format(meshObj.name))
 
-    # Progress counter
-    progressCur = 0
-    progressTot = 0.01 * len(mesh.loop_triangles)
-
-    for face in mesh.loop_triangles:
-        if (progressCur % 10) == 0:
-            print("{:.3f}%\r".format(progressCur / progressTot), end='' )
-        progressCur += 1
-
-        # Skip if this face has less than 3 unique vertices
-        # (a frozenset is an immutable set of unique elements)
-        if len(frozenset(face.vertices)) < 3: 
-            #blender2.8: not sure how to do this "hiding" in 2.8. But isn't just to continue enough?
-            #face.hide = True
-            continue
-
-        #if face.hide:
-        #   continue
-
-        faceLoops = face.loops
+    # Read positions, normals, UVs, colors, materials and indices of the whole mesh
+    meshArrays = ExtractMeshArrays(mesh, posMatrix, normalMatrix, uvs, uvs2, colorsRgb)
+
+    # Only triangles with 3 unique vertices
+    validTriangles = np.flatnonzero(meshArrays.triValid)
+    # Blender vertex index and loop index of each corner of the valid triangles
+    cornerVertices = meshArrays.triVertices[validTriangles].reshape(-1)
+    cornerLoops = meshArrays.triLoops[validTriangles].reshape(-1)
+    cornersCount = len(cornerVertices)
+
+    # Material of each valid triangle: if for materialIndex no corresponding materialNode exists
+    # take the first material-node. that would be also find for baked-materials
+    slotsNames = ["default_materialtree"]
+    if hasattr(mesh,"materialNodetrees") and len(mesh.materialNodetrees)>0:
+        slotsNames = []
+        for ntSlot in mesh.materialNodetrees:
+            slotsNames.append(ntSlot.nodetreePointer.name if ntSlot.nodetreePointer else "default_materialtree")
+    triSlots = meshArrays.triMaterials[validTriangles]
+    triSlots[triSlots >= len(slotsNames)] = 0
+
+    # Geometry index of each material slot, following the triangles order
+    slotsGeometry = np.zeros(len(slotsNames), dtype=np.int32)
+    usedSlots, firstTriangles = np.unique(triSlots, return_index=True)
+    for materialIndex in usedSlots[np.argsort(firstTriangles)]:
+        materialName = slotsNames[materialIndex]
 
-        ## TODO Multimaterial-Export:
-        ## use this:
-        materialIndex = face.material_index
-
-        # Get face vertices UV, type: MeshTextureFace(bpy_struct)
-        #faceUv = uvs and uvs[face.index]
-        #faceUv2 = uvs2 and uvs2[face.index]
-
-        # Get face 4 vertices colors
-        #fcol = colorsRgb and colorsRgb[face.index]
-        #faceRgbColor = fcol and (fcol.color1, fcol.color2, fcol.color3, fcol.color4)
-        #fcol = colorsAlpha and colorsAlpha[face.index]
-        #faceAlphaColor = fcol and (fcol.color1, fcol.color2, fcol.color3, fcol.color4)
-
-        # Get the face material
-        # If no material is associated then face.material_index is 0 but mesh.materials
-        # is not None
-        #material = None
-        #if mesh.materials and len(mesh.materials):
-        #    material = mesh.materials[face.material_index]
-        
-        # Add the material if it is new
-        #materialName = material and material.name
-        materialName = "default_materialtree"
-        #print("CHECK: %s %s idx:%s" % (hasattr(mesh,"materialNodetrees"), len(mesh.materialNodetrees),materialIndex))
-
-        if hasattr(mesh,"materialNodetrees") and len(mesh.materialNodetrees)>0:
-            ## TODO: What strategie to use for multimaterial-meshes
-            ## Now: if for materialIndex no corresponding materialNode exists take the first material-node. that would be also find for baked-materials
-            if materialIndex >= len(mesh.materialNodetrees):
-                materialIndex = 0
-
-            ntSlot = mesh.materialNodetrees[materialIndex]
-            if ntSlot.nodetreePointer:
-                materialName = ntSlot.nodetreePointer.name
-                print("USING %s" % materialName)
-            #materialName = mesh.materialNodetree.name
-        
         # blender2.8: just set the material-tree-name in the dictionary so we know what material-tree to export
         if tOptions.doMaterials and materialName and (not materialName in materialsList):
             materialsList.append(materialName)
-        
-        
-        #if tOptions.doMaterials and materialName and (not materialName in materialsList):
-        #    tMaterial = TMaterial(materialName)
-        #    materialsList.append(tMaterial)
-
-        #    tMaterial.diffuseColor = material.diffuse_color
-        #     tMaterial.diffuseIntensity = material.diffuse_intensity
-        #     tMaterial.specularColor = material.specular_color
-        #     tMaterial.specularIntensity = material.specular_intensity
-        #     tMaterial.specularHardness = material.specular_hardness
-        #     tMaterial.twoSided = mesh.show_double_sided
-        #     tMaterial.shadeless = material.use_shadeless
-        #     if material.use_transparency:
-        #         tMaterial.opacity = material.alpha
-        #         if material.transparency_method == 'MASK':
-        #             tMaterial.alphaMask = True
-
-        #     # In reverse order so the first slots have precedence
-        #     for texture in reversed(material.texture_slots):
-        #         if texture is None or texture.texture_coords != 'UV':
-        #             continue
-        #         textureData = bpy.data.textures[texture.name]
-        #         if textureData.type != 'IMAGE':
-        #             continue
-        #         if textureData.image is None:
-        #             continue
-        #         # Skip disabled textures
-        #         textureIndex = material.texture_slots.find(texture.name)
-        #         if textureIndex >= 0 and not material.use_textures[textureIndex]:
-        #             continue
-        #         imageName = textureData.image.name
-        #         if texture.use_map_color_diffuse:
-        #             tMaterial.diffuseTexName = imageName
-        #         if texture.use_map_normal:
-        #             tMaterial.normalTexName = imageName
-        #         if texture.use_map_color_spec:
-        #             tMaterial.specularTexName = imageName
-        #         if texture.use_map_emit:
-        #             tMaterial.emitTexName = imageName
-        #             tMaterial.emitColor = Color((1.0, 1.0, 1.0))
-        #             tMaterial.emitIntensity = texture.emit_factor
-        #         if "_LIGHTMAP" in texture.name:
-        #             tMaterial.lightmapTexName = imageName
-        #         if "_AMBIENTLIGHT" in texture.name:
-        #             tMaterial.ambientLightTexName = imageName
-        #         ##tMaterial.imagePath = bpy.path.abspath(faceUv.image.filepath)
-        
-        # # If we are merging and want to have separate materials, add the object name
+
+        # If we are merging and want to have separate materials, add the object name
         mapMaterialName = materialName
         if tOptions.mergeObjects and tOptions.mergeNotMaterials:
             mapMaterialName = str(materialName) + "---" + meshObj.name
-        # From the material name search for the geometry index, or add it to the map if missing            
+        # From the material name search for the geometry index, or add it to the map if missing
         try:
             geometryIndex = materialGeometryMap[mapMaterialName]
         except KeyError:
@@ -2055,11 +1972,10 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             geometriesList.append(newGeometry)
             materialGeometryMap[mapMaterialName] = geometryIndex
             log.info("New Geometry{:d} created for material {!s}".format(geometryIndex, materialName))
+        slotsGeometry[materialIndex] = geometryIndex
 
-        # Get the geometry associated to the material
-        geometry = geometriesList[geometryIndex]
-        
         # Get the last LOD level, or add a new one if requested in the options
+        geometry = geometriesList[geometryIndex]
         lodLevelIndex = len(geometry.lodLevels)
         if not geometry.lodLevels or geometryIndex not in tOptions.lodUpdatedGeometryIndices:
             tLodLevel = TLodLevel()
@@ -2067,191 +1983,101 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             geometry.lodLevels.append(tLodLevel)
             tOptions.lodUpdatedGeometryIndices.add(geometryIndex)
             log.info("New LOD{:d} created for material {!s}".format(lodLevelIndex, materialName))
-        else:
-            tLodLevel = geometry.lodLevels[-1]
 
         # Add the index of the geometry we are going to update
         updatedGeometryIndices.add(geometryIndex)
-
-        indexSet = tLodLevel.indexSet
-        triangleList = tLodLevel.triangleList
-            
-        # Here we store all the indices of the face, then we decompose it into triangles
-        tempList = []
-
-        for i, vertexIndex in enumerate(face.vertices):
-            # i: vertex index in the face (0..2 tris, 0..3 quad)
-            # vertexIndex: vertex index in Blender buffer
-
-            # Blender vertex
-            vertex = mesh.vertices[vertexIndex]
-
-            position = posMatrix @ vertex.co
-
-            #TODO fix use_auto_smooth (I really don't know what that is used for and how)
-            
-            #use_auto_smooth = mesh.use_auto_smooth
-            use_auto_smooth = False
-
-            if use_auto_smooth:
-                # if using Data->Normals->Auto Smooth, use split normal vector
-                normal = Vector(face.split_normals[i])
-            elif face.use_smooth:
-                # if face is smooth, use vertex normal
-                normal = vertex.normal
-            else:
-                # use face normal
-                normal = face.normal
-            normal = normalMatrix @ normal
-            
-            # Create a new vertex
-            tVertex = TVertex()
-            
-            # Set Blender index
-            tVertex.blenderIndex = (meshIndex, vertexIndex)
-
-            # Set Vertex position
-            if mesh.urho_export.export_pos:
-                tVertex.pos = Vector((position.x, position.z, position.y))
-
-            # Set Vertex normal
-            if mesh.urho_export.export_norm:
-                tVertex.normal = Vector((normal.x, normal.z, normal.y))
-                
-            # Set Vertex UV coordinates
-            if mesh.urho_export.export_uv and uvs:
-                if uvs:
-                    idx = faceLoops[i]
-                    uvResult = uvs[idx]
-                    uv = uvResult.uv
-                    tVertex.uv = Vector((uv[0], 1.0 - uv[1]))
-            elif tOptions.doForceElements:
-                tVertex.uv = Vector((0.0, 0.0))
-
-            #blender2.8: todo uv2 (untested).
-            if mesh.urho_export.export_uv and uvs2:
-                if uvs2:
-                    idx = faceLoops[i]
-                    uv2 = uvs2[idx].uv
-                    tVertex.uv2 = Vector((uv2[0], 1.0 - uv2[1]))
-                elif tOptions.doForceElements:
-                    tVertex.uv2 = Vector((0.0, 0.0))
-
-            # Set Vertex color
-            # if tOptions.doGeometryCol or tOptions.doGeometryColAlpha:
-            #     color = [0, 0, 0, 255]
-            #     if faceRgbColor or faceAlphaColor:
-            #         if faceRgbColor:
-            #             # This is an array of 3 floats from 0.0 to 1.0
-            #             rgb = faceRgbColor[i]
-            #             # Approx 255*float to the closest int
-            #             color[:3] = ( int(round(rgb.r * 255.0)), 
-            #                           int(round(rgb.g * 255.0)), 
-            #                           int(round(rgb.b * 255.0)) )
-            #         if faceAlphaColor:
-            #             # For Alpha use Value of HSV
-            #             alpha = faceAlphaColor[i]
-            #             color[3] = int(round(alpha.v * 255.0))
-            #         tVertex.color = tuple(color)
-            #     elif tOptions.doForceElements:
-            #         tVertex.color = tuple(color)
-
-            # Set vertex color 2.8
-            if mesh.urho_export.export_vcol:
-                color = [0,0,0,255]
-                if colorsRgb:
-                    rgb = colorsRgb[faceLoops[i]]
-                    # Approx 255*float to the closest int
-                    color[:3] = ( int(round(rgb.color[0] * 255.0)), 
-                                    int(round(rgb.color[1] * 255.0)), 
-                                    int(round(rgb.color[2] * 255.0)) )                    
-                tVertex.color =tuple(color)
-                
-                    
-            # Set Vertex bones weights
-            if tOptions.doGeometryWei:
-                weights = []
-                # Scan all the vertex groups associated to the vertex, type: VertexGroupElement(bpy_struct)
-                for g in vertex.groups:
-                    # The group name should be the bone name, but it can also be an user made vertex group
-                    try:
-                        boneName = meshVertexGroups[g.group].name
-                        try:
-                            boneIndex = bonesMap[boneName].index
-                            if g.weight > 0.0 or not weights:
-                                weights.append( (boneIndex, g.weight) )
-                        except KeyError:
-                            notBonesGroups.add(boneName)
-                    except IndexError:
-                        missingGroups.add(str(g.group))
-                # If the mesh has a bone for parent use it for a 100% weight skinning
-                if tOptions.skinBoneParent and meshObj.parent_type == 'BONE' and meshObj.parent_bone:
-                    boneName = meshObj.parent_bone
-                    # We shouldn't have any skinning on the vertex
-                    if weights:
-                        overrideBones.add(boneName)
-                    try:
-                        boneIndex = bonesMap[boneName].index
-                        weights.append( (boneIndex, 1.0) )
-                    except KeyError:
-                        missingBones.add(boneName)
-                # If we found no bone weight (not even one with weight zero) leave the list equal to None
-                hasWeight[1] += 1
-                if weights:
-                    hasWeight[0] += 1
-                    tVertex.weights = weights
-                elif tOptions.doForceElements:
-                    tVertex.weights = [(0, 0.0)]
-                
-            # All this code do is "tVertexIndex = verticesMapList.index(tVertex)", but we use
-            # a map to speed up.
-
-            # Get an hash of the vertex (different vertices with the same hash are ok)
-            vertexHash = hash(tVertex)
-            
+    triGeometries = slotsGeometry[triSlots]
+
+    # Vertex elements of each corner, an element is None if not exported
+    cornerPos = None
+    if mesh.urho_export.export_pos:
+        cornerPos = meshArrays.positions[cornerVertices]
+
+    cornerNormal = None
+    if mesh.urho_export.export_norm:
+        cornerNormal = meshArrays.cornerNormals(validTriangles).reshape(-1, 3)
+
+    cornerUv = None
+    if mesh.urho_export.export_uv and meshArrays.uvs is not None:
+        cornerUv = meshArrays.uvs[cornerLoops]
+    elif tOptions.doForceElements:
+        cornerUv = np.zeros((cornersCount, 2), dtype=np.float32)
+
+    #blender2.8: todo uv2 (untested).
+    cornerUv2 = None
+    if mesh.urho_export.export_uv and meshArrays.uvs2 is not None:
+        cornerUv2 = meshArrays.uvs2[cornerLoops]
+
+    # Set vertex color 2.8
+    cornerColor = None
+    if mesh.urho_export.export_vcol:
+        if meshArrays.colors is not None:
+            cornerColor = meshArrays.colors[cornerLoops]
+        else:
+            cornerColor = np.zeros((cornersCount, 4), dtype=np.int32)
+            cornerColor[:, 3] = 255
+
+    # Set Vertex bones weights, once for each Blender vertex: (vertices x slots) matrices
+    # of bone indices and weights, unused slots have bone index -1
+    vertexBones = None
+    vertexBoneWeights = None
+    if tOptions.doGeometryWei:
+        usedVertices = np.unique(cornerVertices).tolist()
+        # Bone index of each vertex group, -1 if the group is not a bone (the group name
+        # should be the bone name, but it can also be an user made vertex group)
+        groupBones = np.full(len(meshVertexGroups), -1, dtype=np.int32)
+        for groupIndex, group in enumerate(meshVertexGroups):
+            bone = bonesMap.get(group.name)
+            if bone is not None:
+                groupBones[groupIndex] = bone.index
+        # All the vertex groups associated to the vertices, type: VertexGroupElement(bpy_struct)
+        meshVertices = mesh.vertices
+        entryVertices = []
+        entryGroups = []
+        entryWeights = []
+        for vertexIndex in usedVertices:
+            for g in meshVertices[vertexIndex].groups:
+                entryVertices.append(vertexIndex)
+                entryGroups.append(g.group)
+                entryWeights.append(g.weight)
+        entryVertices = np.array(entryVertices, dtype=np.int64)
+        entryGroups = np.array(entryGroups, dtype=np.int64)
+        entryWeights = np.array(entryWeights, dtype=np.float64)
+        missing = entryGroups >= len(groupBones)
+        missingGroups.update(str(group) for group in np.unique(entryGroups[missing]).tolist())
+        entryBones = np.full(len(entryGroups), -1, dtype=np.int32)
+        entryBones[~missing] = groupBones[entryGroups[~missing]]
+        isBone = entryBones >= 0
+        notBones = np.unique(entryGroups[~missing & ~isBone]).tolist()
+        notBonesGroups.update(meshVertexGroups[group].name for group in notBones)
+        # Keep the not null weights, and the first bone of a vertex even if null
+        keep = isBone & (entryWeights > 0.0)
+        boneEntries = np.flatnonzero(isBone)
+        _, firstEntries = np.unique(entryVertices[boneEntries], return_index=True)
+        keep[boneEntries[firstEntries]] = True
+        entryVertices = entryVertices[keep]
+        entryBones = entryBones[keep]
+        entryWeights = entryWeights[keep]
+        # If the mesh has a bone for parent use it for a 100% weight skinning
+        if tOptions.skinBoneParent and meshObj.parent_type == 'BONE' and meshObj.parent_bone and usedVertices:
+            boneName = meshObj.parent_bone
+            # We shouldn't have any skinning on the vertex
+            if len(entryVertices):
+                overrideBones.add(boneName)
             try:
-                # Get a list of vertex indices with the same hash
-                verticesMapList = verticesMap[vertexHash]
+                boneIndex = bonesMap[boneName].index
+                parentVertices = np.array(usedVertices, dtype=np.int64)
+                entryVertices = np.concatenate((entryVertices, parentVertices))
+                entryBones = np.concatenate((entryBones, np.full(len(parentVertices), boneIndex, dtype=np.int32)))
+                entryWeights = np.concatenate((entryWeights, np.ones(len(parentVertices))))
             except KeyError:
-                # If the hash is not mapped, create a new list (we should use sets but lists are faster)
-                verticesMapList = []
-                verticesMap[vertexHash] = verticesMapList
-            
-            # For each index in the list, test if it is the same as the current tVertex.
-            # If Position, Normal and UV must be the same get its index.
-            ## tVertexIndex = next((j for j in verticesMapList if verticesList[j] == tVertex), None)
-            tVertexIndex = None
-            for j in verticesMapList:
-                if verticesList[j].isEqual(tVertex):
-                    tVertexIndex = j
-                    break
-
-            # If we cannot find it, the vertex is new, add it to the list, and its index to the map list
-            if tVertexIndex is None:
-                tVertexIndex = len(verticesList)
-                verticesList.append(tVertex)
-                verticesMapList.append(tVertexIndex)
-
-
-            # Add the vertex index to the temp list to create triangles later
-            tempList.append(tVertexIndex)
-                        
-            # Map Blender face index and Blender vertex index to our TVertex index (this is used later by Morphs)
-            faceVertexMap[(face.index, vertexIndex)] = tVertexIndex
-            
-            # Save every unique vertex this LOD is using
-            indexSet.add(tVertexIndex)
-
-            # Create triangles
-            if i == 2:
-                triangle = (tempList[0], tempList[2], tempList[1])
-                triangleList.append(triangle)
-
-            if i == 3:
-                triangle = (tempList[0], tempList[3], tempList[2])
-                triangleList.append(triangle)
-        # end loop vertices
-    # end loop faces
+                missingBones.add(boneName)
+        vertexBones, vertexBoneWeights = WeightsMatrix(entryVertices, entryBones, entryWeights, len(meshVertices))
+        # Weights statistics are per corner, a vertex with no bone weight (not even one
+        # with weight zero) is not skinned
+        hasWeight[1] = cornersCount
+        hasWeight[0] = int(np.count_nonzero(vertexBones[cornerVertices, 0] >= 0))
+
     if not onlyProcessMaterial:
         if notBonesGroups:
             log.info("These groups are not used for bone deforms: {:s}".format( ", ".join(notBonesGroups) ))
@@ -2266,29 +2092,42 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
                 log.warning("Object {:s} is not affected by any bone".format(meshObj.name))
             elif hasWeight[0] != hasWeight[1]:
                 print("Object {:s} is only {:.1f}% skinned".format(meshObj.name, 100.0 * hasWeight[0] / hasWeight[1]))
-        
-        # Generate tangents for the last LOD of every geometry with new vertices
-        if mesh.urho_export.export_tan:
-            lodLevels = []
-            for geometryIndex in updatedGeometryIndices:
-                geometry = geometriesList[geometryIndex]
-                # Only the last LOD was modified (even if it wasn't a new LOD)
-                lodLevel = geometry.lodLevels[-1]
-                log.info("Generating tangents on {:d} indices for {:s} Geometry{:d}"
-                        .format(len(lodLevel.indexSet), meshObj.name, geometryIndex) )
-                lodLevels.append(lodLevel)
-            GenerateTangents(lodLevels, verticesList, errorsMem)
-                
-        # Optimize vertex index buffer for the last LOD of every geometry with new vertices
-        if tOptions.doOptimizeIndices:
-            for geometryIndex in updatedGeometryIndices:
-                geometry = geometriesList[geometryIndex]
-                # Only the last LOD was modified (even if it wasn't a new LOD)
-                lodLevel = geometry.lodLevels[-1]
-                log.info("Optimizing {:d} indices for {:s} Geometry{:d}"
-                        .format(len(lodLevel.indexSet), meshObj.name, geometryIndex) )
-                OptimizeIndices(lodLevel)
-        
+
+    # Job for the welding, tangents, optimization and morphs (see ProcessMeshJob)
+    tMeshJob = TMeshJob()
+    tMeshJob.tData = tData
+    tMeshJob.vertexBones = vertexBones
+    tMeshJob.vertexWeights = vertexBoneWeights
+    tMeshJob.doWeights = tOptions.doGeometryWei
+    tMeshJob.doForceElements = tOptions.doForceElements
+    # Save the LODs now, a later object can add new LODs to the same geometries
+    for geometryIndex in updatedGeometryIndices:
+        tMeshJob.lodLevels[geometryIndex] = geometriesList[geometryIndex].lodLevels[-1]
+
+    arrays = {}
+    arrays["triVertices"] = meshArrays.triVertices[validTriangles]
+    arrays["triLoops"] = meshArrays.triLoops[validTriangles]
+    arrays["triGeometries"] = triGeometries
+    for name, column in (("pos", cornerPos), ("normal", cornerNormal), ("uv", cornerUv),
+                         ("uv2", cornerUv2), ("color", cornerColor)):
+        if column is not None:
+            arrays[name] = column
+
+    job = {}
+    job["objectName"] = meshObj.name
+    job["meshIndex"] = meshIndex
+    job["tolerance"] = tOptions.weldTolerance
+    job["doTangents"] = not onlyProcessMaterial and mesh.urho_export.export_tan
+    job["doOptimize"] = not onlyProcessMaterial and tOptions.doOptimizeIndices
+    job["cacheSize"] = tOptions.vertexCacheSize
+    job["doMorphNor"] = tOptions.doMorphNor
+    job["doMorphUV"] = tOptions.doMorphUV
+    job["doMorphTan"] = tOptions.doMorphTan
+    job["autoSmooth"] = bool(mesh.use_auto_smooth)
+    job["morphs"] = []
+    job["arrays"] = arrays
+
+    if not onlyProcessMaterial:
         # Check if we need and can work on shape keys (morphs)
         shapeKeys = meshObj.data.shape_keys
         keyBlocks = []
@@ -2298,7 +2137,9 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             else:
                 keyBlocks = shapeKeys.key_blocks
 
-        morphHasNewNormals = False
+        # Read the shapes positions and normals, the mesh is not modified
+        keyPositions = []
+        keyNormals = []
         for j, block in enumerate(keyBlocks):
             # Skip 'Basis' shape key
             if j == 0:
@@ -2306,162 +2147,261 @@ def DecomposeMesh(scene, meshObj, tData, tOptions, errorsMem, onlyProcessMateria
             # Skip muted shape keys
             if block.mute:
                 continue
-            
-            tMorph = TMorph(block.name)
-            
-            log.info("Decomposing shape: {:s} ({:d} vertices)".format(block.name, len(block.data)) )
-
-            # Check if vertex counts match
+            key = {"name": block.name, "vertices": len(block.data), "index": -1}
+            job["morphs"].append(key)
             if len(mesh.vertices) != len(block.data):
-                log.error("Vertex count mismatch on shape {:s}.".format(block.name))
                 continue
-            
-            # Probably to use the old code where we set the shape key to 100% on the object, we need
-            # to use: evaluated_depsgraph_get + evaluated_get + to_mesh (exactly like done with mesh)
+            key["index"] = len(keyPositions)
+            keyPositions.append(ForeachGet(block.data, "co", 3, np.float32))
+            if tOptions.doMorphNor:
+                if mesh.use_auto_smooth:
+                    keyNormals.append(np.array(block.normals_split_get(), dtype=np.float32).reshape(-1, 3))
+                else:
+                    keyNormals.append(np.array(block.normals_vertex_get(), dtype=np.float32).reshape(-1, 3))
+
+        if job["morphs"]:
+            # Triangles with less than 3 unique vertices are not in the morphs
+            invalidTriangles = np.flatnonzero(~meshArrays.triValid)
+            arrays["invalidTriangles"] = invalidTriangles
+            arrays["invalidVertices"] = meshArrays.triVertices[invalidTriangles]
+            arrays["validTriangles"] = validTriangles
+            arrays["triSmooth"] = meshArrays.triSmooth[validTriangles]
+            arrays["posMatrix"] = np.array(posMatrix, dtype=np.float32)
+            arrays["normalMatrix"] = np.array(normalMatrix, dtype=np.float32)
+            if keyPositions:
+                arrays["keyPositions"] = np.stack(keyPositions)
+            if keyNormals:
+                arrays["keyNormals"] = np.stack(keyNormals)
 
-            # Apply the shape
-            for i, data in enumerate(block.data):
-                mesh.vertices[i].co = data.co
+        # Restore shape keys
+        for j, oldValue in enumerate(shapeKeysOldValues):
+            shapeKeys.key_blocks[j].value = oldValue
 
-            # Recalculate normals
-            mesh.update(calc_edges = True, calc_edges_loose = True)
+        # Delete the mesh
+        meshObj.to_mesh_clear()
 
-            # Compute local space unit length split normals vectors
-            mesh.calc_normals_split()
-            mesh.calc_loop_triangles()
-            
-            # TODO: if set use 'vertex group' of the shape to filter affected vertices
-            
-            for tri in mesh.loop_triangles:
-                # TODO: add only affected triangles not faces, use morphed as a mask
-                morphed = False
+    tMeshJob.job = job
+    # Search the result in the cache, same job same result
+    if tOptions.meshCache:
+        tMeshJob.meshCache = tOptions.meshCache
+        tMeshJob.cacheKey = tOptions.meshCache.Key(job)
+        result = tOptions.meshCache.Load(tMeshJob.cacheKey)
+        if result is not None:
+            log.info("Mesh {:s} loaded from the cache".format(meshObj.name))
+            LogRecords(result)
+            MergeMeshJob(tMeshJob, result, errorsMem)
+            return None
 
-                # In this list we store vertex index and morphed vertex of each triangle, we'll add them
-                # to the morph only if at least one vertex on the triangle is affected by the morph
-                tempList = []
-                
-                # For each Blender vertex index in the triangle
-                for i, vertexIndex in enumerate(tri.vertices):
-
-                    # Get the Blender morphed vertex
-                    vertex = mesh.vertices[vertexIndex]
-                    
-                    position = posMatrix @ vertex.co
-                    
-                    if mesh.use_auto_smooth:
-                        # if using Data->Normals->Auto Smooth, use split normal vector
-                        normal = Vector(tri.split_normals[i])
-                    elif tri.use_smooth:
-                        # if triangle is smooth, use vertex normal
-                        normal = vertex.normal
-                    else:
-                        # use triangle normal
-                        normal = tri.normal
-                    normal = normalMatrix @ normal
-
-                    # Try to find the TVertex index corresponding to this Blender vertex index
-                    try:
-                        tVertexIndex = faceVertexMap[(tri.index, vertexIndex)]
-                    except KeyError:
-                        log.error("Cannot find vertex {:d} of triangle {:d} of shape {:s}."
-                                .format(vertexIndex, tri.index, block.name) )
-                        continue
+    if pool:
+        SubmitMeshJob(pool, tMeshJob)
+        return tMeshJob
 
-                    # Get the original not morphed TVertex
-                    tVertex = verticesList[tVertexIndex]
-                    
-                    # Create a new morphed vertex
-                    # (note: this vertex stores absolute values, not relative to original values)
-                    tMorphVertex = TVertex()
-
-                    # Set Blender index
-                    tMorphVertex.blenderIndex = (meshIndex, vertexIndex)
-
-                    # Set Vertex position
-                    tMorphVertex.pos = Vector((position.x, position.z, position.y))
-
-                    # Set Vertex normal
-                    if tOptions.doMorphNor:
-                        tMorphVertex.normal = Vector((normal.x, normal.z, normal.y))
-                    
-                    # If we have UV, copy them to the TVertex, we only need them to calculate tangents
-                    if tOptions.doMorphUV:
-                        if tVertex.uv:
-                            tMorphVertex.uv = tVertex.uv
-                        elif tOptions.doForceElements:
-                            tVertex.uv = Vector(0.0, 0.0)
-                    
-                    # Save vertex index and morphed vertex, to be added later if at least one
-                    # vertex in the triangle was morphed
-                    tempList.append((tVertexIndex, tMorphVertex))
-                    
-                    # Check if the morph has effect
-                    if tMorphVertex.isMorphed(tVertex):
-                        morphed = True
-                
-                # If at least one vertex in the triangle was morphed
-                if morphed:
-                    # Add vertices to the morph
-                    for i, (tVertexIndex, tMorphVertex) in enumerate(tempList):
-                        try:
-                            # Check if already present
-                            oldTMorphVertex = tMorph.vertexMap[tVertexIndex]
-                            if tMorphVertex != oldTMorphVertex:
-                                log.error('Different vertex {:d} of triangle {:d} of shape {:s}.'
-                                    .format(vertexIndex, tri.index, block.name) )
-                                if tMorphVertex.normal != oldTMorphVertex.normal:
-                                    morphHasNewNormals = True
-                                continue
-                        except KeyError:
-                            # Add a new morph vertex
-                            tMorph.vertexMap[tVertexIndex] = tMorphVertex
-                            
-                        # Save how many unique vertex this LOD is using (for tangents calculation)
-                        tMorph.indexSet.add(tVertexIndex)
-
-                        # Create triangles (for tangents calculation)
-                        if i == 2:
-                            triangle = (tempList[0][0], tempList[2][0], tempList[1][0])
-                            tMorph.triangleList.append(triangle)
-
-                        if i == 3:
-                            triangle = (tempList[0][0], tempList[3][0], tempList[2][0])
-                            tMorph.triangleList.append(triangle)
-                        
-            if tOptions.doMorphTan:
-                log.info("Generating morph tangents {:s}".format(block.name) )
-                GenerateTangents((tMorph,), tMorph.vertexMap, None)
+    FinishMeshJob(tMeshJob, RecordMeshJob(job), errorsMem)
+    return None
 
-            # If valid add the morph to the model list
-            if tMorph.vertexMap:
-                morphsList.append(tMorph)
-            else:
-                log.warning('Empty shape {:s}.'.format(block.name))
 
-        # We can have "Different vertex" errors when some vertices are merged in the base morph because 
-        # positions and normals are the same, but in other morphs, the normals can diverge and this require 
-        # separated vertices. We could do a prepass on the shapes to find and avoid merging these vertices.
-        if morphHasNewNormals:
-            log.info("To solve the shapes errors try setting the faces to smooth")
+#--------------------
+# Mesh jobs
+#--------------------
 
-        # Restore shape keys
-        for j, oldValue in enumerate(shapeKeysOldValues):
-            shapeKeys.key_blocks[j].value = oldValue
+# Mesh read on the main thread, waiting for the result of its job
+class TMeshJob:
+    def __init__(self):
+        # TData where to merge the result
+        self.tData = None
+        # Job for ProcessMeshJob
+        self.job = None
+        # Geometry index to the LOD where to add the triangles
+        self.lodLevels = {}
+        # Bones weights of each Blender vertex (vertices x slots): bone index (-1 if unused)
+        # and weight
+        self.vertexBones = None
+        self.vertexWeights = None
+        self.doWeights = False
+        self.doForceElements = False
+        # Future of the worker process and shared memory of the job arrays
+        self.future = None
+        self.memory = None
+        # Cache where to save the result and key of the job
+        self.meshCache = None
+        self.cacheKey = None
+
+# Pool of worker processes for the meshes jobs
+def CreateWorkersPool(workers):
+    if shared_memory is None:
+        log.warning("Worker processes need Python 3.8, decomposing in Blender")
+        return None
+    # Blender before 2.91 has its own binary as sys.executable
+    context = multiprocessing.get_context("spawn")
+    pythonPath = getattr(bpy.app, "binary_path_python", None)
+    if pythonPath:
+        context.set_executable(pythonPath)
+    # The workers import meshops.py from the add-on folder
+    addonPath = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                    initializer=site.addsitedir, initargs=(addonPath,))
+    except Exception as ex:
+        log.warning("Cannot start the worker processes ({!s}), decomposing in Blender".format(ex))
+        return None
 
-        # Delete the mesh
-        meshObj.to_mesh_clear()
+def SubmitMeshJob(pool, tMeshJob):
+    job = tMeshJob.job
+    tMeshJob.memory, layout = ShareArrays(job["arrays"])
+    sharedJob = dict(job)
+    del sharedJob["arrays"]
+    tMeshJob.future = pool.submit(WorkerFunction("ProcessSharedMeshJob"), sharedJob, tMeshJob.memory.name, layout)
 
-        return
+# Wait for the job of a worker and merge its result
+def WaitMeshJob(tMeshJob, errorsMem):
+    try:
+        result = tMeshJob.future.result()
+        LogRecords(result)
+    except Exception as ex:
+        log.warning("Worker process failed ({!s}), decomposing {:s} in Blender"
+                .format(ex, tMeshJob.job["objectName"]))
+        result = RecordMeshJob(tMeshJob.job)
+    finally:
+        tMeshJob.memory.close()
+        tMeshJob.memory.unlink()
+        tMeshJob.memory = None
+    FinishMeshJob(tMeshJob, result, errorsMem)
+
+# Log the messages recorded by a job in another process (or saved in the cache)
+def LogRecords(result):
+    for level, message in result["records"]:
+        log.log(level, message)
+
+# Save the result of a job in the cache and merge it
+def FinishMeshJob(tMeshJob, result, errorsMem):
+    if tMeshJob.meshCache:
+        tMeshJob.meshCache.Save(tMeshJob.cacheKey, result)
+    MergeMeshJob(tMeshJob, result, errorsMem)
+
+# Add the vertices, triangles and morphs of a mesh job result to its TData
+def MergeMeshJob(tMeshJob, result, errorsMem):
+    tData = tMeshJob.tData
+    vertices = tData.vertices
+
+    # Add the new vertices to the store
+    start = vertices.append(VertexStoreFromArrays(result["vertices"]))
+
+    # Set Vertex bones weights, each vertex takes the weights of its Blender vertex
+    if tMeshJob.doWeights:
+        firstVertices = result["firstVertices"]
+        bones = tMeshJob.vertexBones[firstVertices]
+        weights = tMeshJob.vertexWeights[firstVertices]
+        hasWeights = bones[:, 0] >= 0
+        if tMeshJob.doForceElements:
+            bones[~hasWeights, 0] = 0
+            hasWeights[:] = True
+        weightsRows = np.flatnonzero(hasWeights)
+        if len(weightsRows):
+            vertices.setWeights(start + weightsRows, bones[weightsRows], weights[weightsRows])
+
+    # Add the triangles of each geometry to its LOD, save every unique vertex the LOD is using
+    # (in corners order, the vertex buffer follows the set order)
+    cornerIndices = (result["cornerIndices"] + start).reshape(-1, 3)
+    triGeometries = tMeshJob.job["arrays"]["triGeometries"]
+    for geometryIndex, triangles in result["geometries"]:
+        tLodLevel = tMeshJob.lodLevels[geometryIndex]
+        tLodLevel.indexSet.update(cornerIndices[triGeometries == geometryIndex].reshape(-1).tolist())
+        tLodLevel.triangleList.extend(map(tuple, (triangles + start).tolist()))
+
+    for morph in result["morphs"]:
+        tMorph = TMorph(morph["name"])
+        tMorph.indices = morph["indices"] + start
+        tMorph.indexSet.update(tMorph.indices.tolist())
+        tMorph.triangleList = list(map(tuple, (morph["triangles"] + start).tolist()))
+        tMorph.vertices = VertexStoreFromArrays(morph["vertices"])
+        tData.morphsList.append(tMorph)
+
+    for name, values in result["errors"].items():
+        errorsMem.Get(name, set()).update(values)
 
 
 #--------------------
 # Scan objects
 #--------------------
 
+# Values of the editable properties of a Blender struct
+def GetStructSignature(struct):
+    return tuple((p.identifier, repr(getattr(struct, p.identifier))) for p in struct.bl_rna.properties
+                 if not p.is_readonly)
+
+# Check if a modifier result depends on the transform of other objects (Boolean,
+# Mirror, Lattice, Curve, Shrinkwrap, Displace with object coordinates...). The Armature
+# modifier of the skeleton is not: we decompose the mesh in the rest pose.
+def ModifierUsesObjects(modifier, armatureObj):
+    for p in modifier.bl_rna.properties:
+        if p.type != 'POINTER' or p.fixed_type.identifier != 'Object':
+            continue
+        pointer = getattr(modifier, p.identifier)
+        if pointer is None:
+            continue
+        if modifier.type == 'ARMATURE' and pointer == armatureObj:
+            continue
+        return True
+    return False
+
+# Key of what we decompose from an object: two objects with the same key have the same
+# decomposed data. None if the data of the object cannot be shared.
+def GetMeshKey(obj, armatureObj, tOptions):
+    if obj.type != 'MESH' or not tOptions.doGeometries:
+        return None
+    # Merged objects, LODs and object animations are not shared
+    if tOptions.mergeObjects or tOptions.useLods or tOptions.doObjAnimations:
+        return None
+    if obj.lodsetID != 0 or "_LOD" in obj.name:
+        return None
+    mesh = obj.data
+    # Full name: meshes of linked libraries can have the same name
+    key = [mesh.name_full, GetStructSignature(mesh.urho_export)]
+    worldSpace = tOptions.globalOrigin
+    if tOptions.applyModifiers:
+        for modifier in obj.modifiers:
+            if ModifierUsesObjects(modifier, armatureObj):
+                return None
+            # Texture coordinates in world space depend on the object transform
+            if getattr(modifier, "texture_coords", None) == 'GLOBAL':
+                worldSpace = True
+        key.append(tuple(GetStructSignature(modifier) for modifier in obj.modifiers))
+    if worldSpace:
+        key.append(tuple(tuple(row) for row in obj.matrix_world))
+    # Weights depend on the object vertex groups and parent bone
+    key.append(armatureObj.name_full if armatureObj else None)
+    key.append(tuple(group.name for group in obj.vertex_groups))
+    if tOptions.skinBoneParent:
+        key.append((obj.parent_type, obj.parent_bone))
+    return tuple(key)
+
 # Scan and decompose objects
 def Scan(context, tDataList, errorsMem, tOptions):
-    global decomposedActions
-    decomposedActions  = []
+
+    # Meshes are read on the main thread, then they are welded, optimized... in worker
+    # processes if requested. Results are merged in the objects order.
+    pool = None
+    if tOptions.doGeometries and tOptions.decomposeWorkers > 1:
+        pool = CreateWorkersPool(tOptions.decomposeWorkers)
+    tMeshJobs = []
+    try:
+        ScanObjects(context, tDataList, errorsMem, tOptions, pool, tMeshJobs)
+        for tMeshJob in tMeshJobs:
+            WaitMeshJob(tMeshJob, errorsMem)
+    finally:
+        # Release the shared memory of the jobs not merged (on errors)
+        for tMeshJob in tMeshJobs:
+            if tMeshJob.memory:
+                tMeshJob.future.cancel()
+                tMeshJob.memory.close()
+                tMeshJob.memory.unlink()
+        if pool:
+            pool.shutdown()
+
+def ScanObjects(context, tDataList, errorsMem, tOptions, pool, tMeshJobs):
+    global decomposedActions, actionsChannels
+    decomposedActions = set()
+    actionsChannels = {}
 
     scene = context.scene
     
@@ -2527,6 +2467,8 @@ def Scan(context, tDataList, errorsMem, tOptions):
     # Decompose objects
     tData = None
     lodCurrentName = None
+    # Mesh key (see GetMeshKey) to the TData of the first object with that key
+    sharedMeshes = {}
     for obj, lodName, lodDistance in meshes:
             
         log.info("---- Decomposing {:s} ----".format(obj.name))
@@ -2604,6 +2546,19 @@ def Scan(context, tDataList, errorsMem, tOptions):
                     if modifier.type == 'ARMATURE' and modifier.object and modifier.object.type == 'ARMATURE':
                         armatureObj = modifier.object
                         break
+
+        # Objects with the same mesh and settings are decomposed only once
+        if createNew:
+            meshKey = GetMeshKey(obj, armatureObj, tOptions)
+            if meshKey is not None:
+                sharedTData = sharedMeshes.get(meshKey)
+                if sharedTData:
+                    log.info("Same mesh of {:s}".format(sharedTData.blenderObjectName))
+                    tData.sharedTData = sharedTData
+                    continue
+                sharedMeshes[meshKey] = tData
+
+        if tOptions.doBones:
             # Decompose armature and animations
             if armatureObj:
                 savedValue = None
@@ -2625,7 +2580,9 @@ def Scan(context, tDataList, errorsMem, tOptions):
         # Decompose geometries
         if tOptions.doGeometries :
             savedValue = SetRestPosePosition(context, armatureObj)
-            DecomposeMesh(scene, obj, tData, tOptions, errorsMem,obj.lodsetID>0)
+            tMeshJob = DecomposeMesh(scene, obj, tData, tOptions, errorsMem,obj.lodsetID>0, pool)
+            if tMeshJob:
+                tMeshJobs.append(tMeshJob)
             RestorePosePosition(armatureObj, savedValue)
 
 #-----------------------------------------------------------------------------
@@ -5,7 +5,7 @@
 
 from .utils import PathType, GetFilepath, CheckFilepath, \
                    FloatToString, Vector3ToString, Vector4ToString, WriteSceneHeaderFileDotNet, \
-                   WriteXmlFile,WriteStringFile, SDBMHash, getLodSetWithID, getObjectWithID,\
+                   WriteXmlFile,WriteStringFile, WriteFileData, SDBMHash, getLodSetWithID, getObjectWithID,\
                    PrepareSceneHeaderFile,PrepareGlobalHeader,WriteSceneHeaderFile
 from xml.etree import ElementTree as ET
 from mathutils import Vector, Quaternion, Matrix
@@ -14,6 +14,7 @@ import os
 import logging,traceback
 import math
 from .export_urho import BoundingBox,UrhoModel
+from .export_scene_binary import SceneToBinary, BinarySceneError
                 
 
 
@@ -66,6 +67,16 @@ class SOptions:
         self.exportGroupsAsObject = True
         self.exportObjectCollectionAsTag = True
         self.objectsPath = "Objects"
+        # XML or BINARY scenes and prefabs
+        self.sceneFormat = 'XML'
+        # With binary scenes, write the XML file too
+        self.sceneXmlDump = False
+        # Attributes layouts for the binary format (see export_scene_binary.py)
+        self.sceneSchema = None
+        # Incremental export: names of the objects whose prefabs are written and names
+        # of the material nodetrees written (None: all)
+        self.prefabObjects = None
+        self.materialTrees = None
 
 
 class UrhoSceneMaterial:
@@ -339,7 +350,8 @@ class UrhoScene:
 #------------------------
 
 
-def UrhoWriteMaterialTrees(fOptions,getUsedMaterials=False):
+# Write the used material nodetrees, only the ones named in 'materialTrees' if not None
+def UrhoWriteMaterialTrees(fOptions,getUsedMaterials=False,materialTrees=None):
     print ("EXPORT MATERIAL-NODETREES")
 
     if getUsedMaterials:
@@ -348,6 +360,8 @@ def UrhoWriteMaterialTrees(fOptions,getUsedMaterials=False):
         SetUsedMaterials()
 
     for materialTree in usedMaterialTrees:
+        if materialTrees is not None and materialTree.name not in materialTrees:
+            continue
         fileFullPath = GetFilepath(PathType.MATERIALS, materialTree.name, fOptions)
         print("Try to export material-nodetree %s" % fileFullPath[0])        
         if os.path.exists(fileFullPath[0]) and not fOptions.fileOverwrite:
@@ -479,19 +493,31 @@ def UrhoWriteMaterialsList(uScene, uModel, filepath):
             file = "null"
         content += file + "\n"
 
-    try:
-        file = open(filepath, "w")
-    except Exception as e:
-        log.error("Cannot open file {:s} {:s}".format(filepath, e))
-        return
-    file.write(content)
-    file.close()
+    WriteStringFile(content, filepath, None)
 
 
 #------------------------
 # Export scene and nodes
 #------------------------
 
+# Write a scene or a prefab. With the binary format 'filepath' has the binary extension,
+# the XML file is only written for debugging (sceneXmlDump).
+def WriteSceneFile(root, filepath, sOptions, fOptions):
+    if sOptions.sceneFormat == 'BINARY':
+        xmlFilepath = os.path.splitext(filepath)[0] + os.path.extsep + "xml"
+        try:
+            data = SceneToBinary(root, sOptions.sceneSchema)
+        except BinarySceneError as e:
+            log.error("Cannot write {:s} in binary format ({!s}), add the type to the scene schema"
+                      .format(filepath, e))
+            return
+        WriteFileData(data, filepath)
+        if sOptions.sceneXmlDump:
+            WriteXmlFile(root, xmlFilepath, fOptions)
+        return
+    WriteXmlFile(root, filepath, fOptions)
+
+
 def CreateNodeTreeXML(treeOwner,xmlroot,nodetree,nodeID,currentModel=None,currentMaterial=None,xmlCurrentModel=None,nodeName=None,collection_root=None):
     print("CreateNodeTreeXML:%s" % nodetree.name)
     exportNodeTree = JSONNodetree.exportNodes(treeOwner,nodetree,True,collection_root)
@@ -661,59 +687,48 @@ def CreateNodeTreeXML(treeOwner,xmlroot,nodetree,nodeID,currentModel=None,curren
 
 
 
-def AddGroupInstanceComponent(a,m,groupFilename,offset,modelNode,is_dotnet=False):
+def AddGroupInstanceComponent(modelElem,groupFilename,offset,is_dotnet=False):
 
-    attribID = m
-    a["{:d}".format(m)] = ET.SubElement(a[modelNode], "component")
-    a["{:d}".format(m)].set("type", "GroupInstance")
-   # a["{:d}".format(m)].set("id", str(m))
+    componentElem = ET.SubElement(modelElem, "component")
+    componentElem.set("type", "GroupInstance")
 
     if is_dotnet:
-        a["{:d}".format(m)].set("SharpTypeName", "GroupInstance, Game, Version=1.0.0.0, Culture=neutral, PublicKeyToken=null")
-        a["{:d}".format(m)].set("groupFilename", groupFilename)            
-
-    m += 1
+        componentElem.set("SharpTypeName", "GroupInstance, Game, Version=1.0.0.0, Culture=neutral, PublicKeyToken=null")
+        componentElem.set("groupFilename", groupFilename)            
 
-    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(attribID)], "attribute")
-    a["{:d}".format(m)].set("name", "groupFilename")
-    a["{:d}".format(m)].set("value", groupFilename)
+    attributeElem = ET.SubElement(componentElem, "attribute")
+    attributeElem.set("name", "groupFilename")
+    attributeElem.set("value", groupFilename)
     
-    # a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(attribID)], "attribute")
-    # a["{:d}".format(m)].set("name", "groupOffset")
+    # attributeElem = ET.SubElement(componentElem, "attribute")
+    # attributeElem.set("name", "groupOffset")
     # off = Vector3ToString(Vector( (offset.y,offset.z,offset.x) ))
     # print("EXPORT-OFFSET: %s : %s" % ( groupFilename,off ))
-    # a["{:d}".format(m)].set("value", off )
-    
-    return m
+    # attributeElem.set("value", off )
 
 ## add userdata-attributes 
-def ExportUserdata(a,m,obj,modelNode,includeCollectionTags=True,fOptions=None):
+def ExportUserdata(modelElem,obj,includeCollectionTags=True,fOptions=None,collectionTags=None):
     print("EXPORT USERDATA")
-    attribID = m
-    a["{:d}".format(m)] = ET.SubElement(a[modelNode], "attribute")
-    a["{:d}".format(m)].set("name", "Variables")
-    m += 1
+    variablesElem = ET.SubElement(modelElem, "attribute")
+    variablesElem.set("name", "Variables")
 
     tags = []
 
     def add_userdata(key,value,type="String"):
-        nonlocal m,a
-        a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(attribID)], "variant")
-        a["{:d}".format(m)].set("hash", str(SDBMHash(key)))
-        a["{:d}".format(m)].set("type", type)
+        variantElem = ET.SubElement(variablesElem, "variant")
+        variantElem.set("hash", str(SDBMHash(key)))
+        variantElem.set("type", type)
         if type == "Color":
-            a["{:d}".format(m)].set("value", "%s %s %s %s" % (value[0],value[1],value[2],value[3])  )
+            variantElem.set("value", "%s %s %s %s" % (value[0],value[1],value[2],value[3])  )
         elif type == "Vector3":
-            a["{:d}".format(m)].set("value", "%s %s %s" % (value[0],value[1],value[2])  )
+            variantElem.set("value", "%s %s %s" % (value[0],value[1],value[2])  )
         elif type == "Bool":
             if value:
-                a["{:d}".format(m)].set("value", 'true')
+                variantElem.set("value", 'true')
             else:
-                a["{:d}".format(m)].set("value", 'false')
+                variantElem.set("value", 'false')
         else:
-            a["{:d}".format(m)].set("value", str(value))
-
-        m += 1
+            variantElem.set("value", str(value))
 
     def process_userdata(user_data):
         for ud in user_data:
@@ -781,26 +796,19 @@ def ExportUserdata(a,m,obj,modelNode,includeCollectionTags=True,fOptions=None):
 
     if includeCollectionTags:
         print("INCLUDE COLTAGS")
-        collectionTags = GetCollectionTags(obj)
+        if collectionTags is None:
+            collectionTags = GetCollectionTags(obj)
         for colTag in collectionTags:
             print("TAG:"+colTag)
             tags.append(colTag)
 
 
     if tags:
-        tagsID = m
-        a["{:d}".format(tagsID)] = ET.SubElement(a[modelNode], "attribute")
-        a["{:d}".format(tagsID)].set("name", "Tags")
-        m += 1
+        tagsElem = ET.SubElement(modelElem, "attribute")
+        tagsElem.set("name", "Tags")
         for tag in tags:
-            a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(tagsID)], "string")
-            a["{:d}".format(m)].set("value", tag.strip())
-            m += 1
-
-
-            
-
-    return m
+            stringElem = ET.SubElement(tagsElem, "string")
+            stringElem.set("value", tag.strip())
 
 # look up userdata in the specific object with the given key. return None if not present
 def GetUserData(obj,key):
@@ -857,6 +865,16 @@ def GetCollectionTags(obj):
             result.append(col.name+"_recursive")
     return result
 
+# GetCollectionTags of all the objects, with one pass over the collections
+def GetCollectionTagsMap():
+    result = {}
+    for col in bpy.data.collections:
+        for obj in col.objects:
+            result.setdefault(obj.name, []).append(col.name)
+        for obj in col.all_objects:
+            result.setdefault(obj.name, []).append(col.name+"_recursive")
+    return result
+
 def GetXMLComponent(a,name):
     for comp in a:
         print(comp.tag)
@@ -867,6 +885,10 @@ def GetXMLComponent(a,name):
 def HasComponent(a,name):
     return GetXMLComponent(a,name) != None    
 
+# Check if the prefab of an object is written (incremental export)
+def IsPrefabObject(name, sOptions):
+    return sOptions.prefabObjects is None or name in sOptions.prefabObjects
+
 # Export scene and nodes
 def UrhoExportScene(context, uScene, sOptions, fOptions):
     usedMaterialTrees.clear()
@@ -890,57 +912,70 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
     k = fileid * 1000000 + scene_hash * 10000
 
 
-    a = {}
     #k = 0x1000000   # node ID
     compoID = k     # component ID
-    m = 0           # internal counter
 
-    def add_attributes(parent,attributes=[]):
-        nonlocal m
+    # Element of each exported node, by (object name, collection root)
+    nodes = {}
+    # Models by name, in export order, to find the parents
+    modelsByName = {}
+    # Files to write at the end of the export: (element, file path, only the node without its children)
+    sceneFiles = []
+
+    def add_attribute(parent,name,value):
+        attributeElem = ET.SubElement(parent, "attribute")
+        attributeElem.set("name", name)
+        attributeElem.set("value", value)
+        return attributeElem
 
+    def add_attributes(parent,attributes=[]):
         for key in attributes:
-            a["{:d}".format(m)] = ET.SubElement(parent, "attribute")
-            a["{:d}".format(m)].set("name", str(key))
-            a["{:d}".format(m)].set("value", str(attributes[key]))
-            m += 1
+            add_attribute(parent, str(key), str(attributes[key]))
 
     def add_component(parent,componentType,attributes=[],is_replicated=False,is_dotnet=False):
         nonlocal compoID
-        nonlocal m
         
         compoID += 1 
 
-        a["{:d}".format(compoID)] = ET.SubElement(parent, "component")
-        a["{:d}".format(compoID)]
-        a["{:d}".format(compoID)].set("type", componentType)
+        componentElem = ET.SubElement(parent, "component")
+        componentElem.set("type", componentType)
         if not is_replicated:
-            a["{:d}".format(compoID)].set("id", "{:d}".format(compoID))
+            componentElem.set("id", "{:d}".format(compoID))
 
         if is_dotnet:
-            a["{:d}".format(compoID)].set("SharpTypeName", "%s, Game, Version=1.0.0.0, Culture=neutral, PublicKeyToken=null" % componentType)
+            componentElem.set("SharpTypeName", "%s, Game, Version=1.0.0.0, Culture=neutral, PublicKeyToken=null" % componentType)
             
 
         if attributes:
-            m += 1
-            for key in attributes:
-                a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compoID)], "attribute")
-                a["{:d}".format(m)].set("name", str(key))
-                a["{:d}".format(m)].set("value", str(attributes[key]))
-                m += 1
+            add_attributes(componentElem, attributes)
             
             if is_dotnet:
                 for key in attributes:
                     value = attributes[key]
                     if type(value)==bool:
                         if value:
-                            a["{:d}".format(compoID)].set(str(key), "true")
+                            componentElem.set(str(key), "true")
                         else:
-                            a["{:d}".format(compoID)].set(str(key), "false")
+                            componentElem.set(str(key), "false")
                     else:
-                        a["{:d}".format(compoID)].set(str(key), str(value))                
+                        componentElem.set(str(key), str(value))                
 
         compoID += 1
 
+    # Element of the parent node: the first model with the parent name, not in an
+    # inlined collection or in the same inlined collection
+    def parent_node(uSceneModel):
+        for usm in modelsByName.get(uSceneModel.parentObjectName, []):
+            if usm.collection_root and not usm.collection_root==uSceneModel.collection_root:
+                continue
+            return nodes.get((usm.name, usm.collection_root))
+        return None
+
+    # Add a scene or prefab file to write
+    def add_scene_file(elem, filepath, withoutChildren=False):
+        if CheckFilepath(filepath[0], fOptions):
+            sceneFiles.append((elem, filepath[0], withoutChildren))
+
     if urho_settings.generateSceneHeader:
         header_data,header_objects = PrepareSceneHeaderFile(bpy.context.scene)
         global_header_data = PrepareGlobalHeader()
@@ -954,10 +989,9 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
         add_component(sceneRoot,"Octree")
         add_component(sceneRoot,"DebugRenderer")
         if not sOptions.noPhysics:
-            a["{:d}".format(m)] = ET.SubElement(sceneRoot, "component")
-            a["{:d}".format(m)].set("type", "PhysicsWorld")
-            a["{:d}".format(m)].set("id", "4")
-            m += 1
+            physicsElem = ET.SubElement(sceneRoot, "component")
+            physicsElem.set("type", "PhysicsWorld")
+            physicsElem.set("id", "4")
 
         # Create Root node
         root = ET.SubElement(sceneRoot, "node")
@@ -966,9 +1000,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
         root = ET.Element('node') 
 
     root.set("id", "{:d}".format(k))
-    a["{:d}".format(m)] = ET.SubElement(root, "attribute")
-    a["{:d}".format(m)].set("name", "Name")
-    a["{:d}".format(m)].set("value", uScene.blenderSceneName)
+    add_attribute(root, "Name", uScene.blenderSceneName)
 
     foundSceneNodeTree = False
     try:
@@ -998,7 +1030,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
         add_component(root,"Zone",zone_attrs)
 
     if urho_settings.sceneCreateSkybox and urho_settings.sceneSkyBoxCubeTexture:
-        skybox = a["__skybox"] = ET.SubElement(root, "node")
+        skybox = ET.SubElement(root, "node")
         
         # <attribute name="Is Enabled" value="true" />
 		# <attribute name="Name" value="Sky" />
@@ -1071,32 +1103,19 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
 
     # Create physics stuff for the root node
     if sOptions.globalPhysics:
-        a["{:d}".format(m)] = ET.SubElement(root, "component")
-        a["{:d}".format(m)].set("type", "RigidBody")
-        a["{:d}".format(m)].set("id", "{:d}".format(compoID))
-
-        a["{:d}".format(m+1)] = ET.SubElement(a["{:d}".format(m)] , "attribute")
-        a["{:d}".format(m+1)].set("name", "Collision Layer")
-        a["{:d}".format(m+1)].set("value", "2")
-
-        a["{:d}".format(m+2)] = ET.SubElement(a["{:d}".format(m)], "attribute")
-        a["{:d}".format(m+2)].set("name", "Use Gravity")
-        a["{:d}".format(m+2)].set("value", "false")
+        bodyElem = ET.SubElement(root, "component")
+        bodyElem.set("type", "RigidBody")
+        bodyElem.set("id", "{:d}".format(compoID))
+        add_attribute(bodyElem, "Collision Layer", "2")
+        add_attribute(bodyElem, "Use Gravity", "false")
 
-        a["{:d}".format(m+3)] = ET.SubElement(root, "component")
-        a["{:d}".format(m+3)].set("type", "CollisionShape")
-        a["{:d}".format(m+3)].set("id", "{:d}".format(compoID+1))
-        m += 3
-
-        a["{:d}".format(m+1)] = ET.SubElement(a["{:d}".format(m)], "attribute")
-        a["{:d}".format(m+1)].set("name", "Shape Type")
-        a["{:d}".format(m+1)].set("value", "TriangleMesh")
+        shapeElem = ET.SubElement(root, "component")
+        shapeElem.set("type", "CollisionShape")
+        shapeElem.set("id", "{:d}".format(compoID+1))
+        add_attribute(shapeElem, "Shape Type", "TriangleMesh")
 
         physicsModelFile = GetFilepath(PathType.MODELS, "Physics", fOptions)[1]
-        a["{:d}".format(m+2)] = ET.SubElement(a["{:d}".format(m)], "attribute")
-        a["{:d}".format(m+2)].set("name", "Model")
-        a["{:d}".format(m+2)].set("value", "Model;" + physicsModelFile)
-        m += 2
+        add_attribute(shapeElem, "Model", "Model;" + physicsModelFile)
         compoID += 2
 
     if sOptions.trasfObjects and sOptions.globalOrigin:
@@ -1181,6 +1200,17 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
 
     # Sort the models by parent-child relationship
     uScene.SortModels()
+    for uSceneModel in uScene.modelsList:
+        modelsByName.setdefault(uSceneModel.name, []).append(uSceneModel)
+
+    # Group node of each collection, with the nodes already added
+    groupNodes = {}
+
+    collectionTagsMap = None
+    if sOptions.exportObjectCollectionAsTag:
+        collectionTagsMap = GetCollectionTagsMap()
+
+    writeMergedScene = False
 
     ## create a mapping to determine in which collection the corressponding object is contained
     for col in instancedCollections:
@@ -1206,7 +1236,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
     for uSceneModel in uScene.modelsList:
         modelNode = uSceneModel.name
         if uSceneModel.collection_root:
-            modelNode = modelNode +"_"+ uSceneModel.collection_root.name #special case for inlined collections. since those have the same object names that would overwrite in the XML-mapping..
+            modelNode = modelNode +"_"+ uSceneModel.collection_root.name #special case for inlined collections, they have the same object names
 
         log.info ("Process %s" % modelNode)
         isEmpty = False
@@ -1237,12 +1267,14 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
             if jsonNodetreeAvailable and obj.data.materialNodetrees:
                 # create materials
                 procMaterials = ProcessNodetreeMaterials(obj.data)
-                # interate over result-names
-                for pMat in procMaterials:
-                    if pMat:
-                        materials += ";"+pMat
-                    else:
-                        materials += ";Materials/DefaultGrey.xml"
+                # material of each slot by the name of its geometries (see DecomposeMesh)
+                slotMaterials = {}
+                for slot, pMat in zip(obj.data.materialNodetrees, procMaterials):
+                    materialName = slot.nodetreePointer.name if slot.nodetreePointer else "default_materialtree"
+                    slotMaterials.setdefault(materialName, pMat or "Materials/DefaultGrey.xml")
+                # one material per geometry, a split geometry has more parts with the same material
+                for uSceneMaterial in uSceneModel.materialsList:
+                    materials += ";" + slotMaterials.get(uSceneMaterial.name, "Materials/DefaultGrey.xml")
             
             if materials == "": # not processed via materialnodes,yet? use the default way
                 for uSceneMaterial in uSceneModel.materialsList:
@@ -1273,38 +1305,24 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
         # Parenting: make sure parented objects are child of this in xml as well
         print ( ("PARENT:%s type:%s") % (str(uSceneModel.parentObjectName),str(uSceneModel.type)))
         
-        if not add_exception and not isEmpty and uSceneModel.parentObjectName and (uSceneModel.parentObjectName in a):
-            for usm in uScene.modelsList:
-                if usm.name == uSceneModel.parentObjectName:
-                    if usm.collection_root and not usm.collection_root==uSceneModel.collection_root:
-                        continue   
-
-                    lookup_name = usm.name
-                    if usm.collection_root:
-                        lookup_name = lookup_name + "_" + usm.collection_root.name
-                    
+        # the parent node of a non empty object is already exported
+        parentExported = not add_exception and not isEmpty and uSceneModel.parentObjectName and (uSceneModel.parentObjectName, None) in nodes
 
-                    a[modelNode] = ET.SubElement(a[lookup_name], "node")
-                    break
+        if not uSceneModel.parentObjectName or add_exception:
+            modelElem = ET.SubElement(root, "node")
+            parentObjects.append({'xml':modelElem,'uSceneModel':uSceneModel})
         else:
-            if not uSceneModel.parentObjectName or add_exception:
-                a[modelNode] = ET.SubElement(root, "node")
-                parentObjects.append({'xml':a[modelNode],'uSceneModel':uSceneModel})
+            parentElem = parent_node(uSceneModel)
+            if parentElem is None:
+                log.warning("Parent {:s} of {:s} not exported, adding it to the root".format(uSceneModel.parentObjectName, modelNode))
+                modelElem = ET.SubElement(root, "node")
+                parentObjects.append({'xml':modelElem,'uSceneModel':uSceneModel})
             else:
-                for usm in uScene.modelsList:
-                    if usm.name == uSceneModel.parentObjectName:
-                        if usm.collection_root and not usm.collection_root==uSceneModel.collection_root:
-                            continue
-                        print("name:%s parentName:%s" % ( uSceneModel.objectName,uSceneModel.parentObjectName ))
-                        
-                        lookup_name = usm.name
-                        if usm.collection_root:
-                            lookup_name = lookup_name + "_" + usm.collection_root.name
-                        
-                        a[modelNode] = ET.SubElement(a[lookup_name], "node")
-                        break                    
+                modelElem = ET.SubElement(parentElem, "node")
+        nodes[(uSceneModel.name, uSceneModel.collection_root)] = modelElem
 
-            is_obj_in_group = ObjInGroup(obj)
+        is_obj_in_group = ObjInGroup(obj)
+        if not parentExported:
             if is_obj_in_group:
                 print("FOUND GROUP OBJ:%s" % obj.name)
                 
@@ -1312,14 +1330,11 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                     groupName = GetGroupName(group.name)
                     
                     # get or create node for the group
-                    if  groupName not in a :
+                    if groupName not in groupNodes:
                         offset = group.instance_offset # Vector((0,0,0)) # no offset in blender 2.8 anymore
 
-                        a[groupName] = ET.Element('node')
-                        # a["{:d}".format(m)] = ET.SubElement(a[groupName], "attribute")
-                        # a["{:d}".format(m)].set("name", "Position")
-                        # a["{:d}".format(m)].set("value", "%s %s %s" % ( offset.y,-offset.z, -offset.x ) )
-                        # m += 1
+                        groupNodes[groupName] = ET.Element('node')
+                        # add_attribute(groupNodes[groupName], "Position", "%s %s %s" % ( offset.y,-offset.z, -offset.x ) )
 
                         
                         # apply group offset
@@ -1333,120 +1348,81 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                         print("NEW Collection Instance POS %s: " % ( colInstPos ))
                         uSceneModel.colInstPosition = colInstPos
 
-                        groups.append({'xml':a[groupName],'obj':obj,'group':group, 'instance_offset_delta' : (offset.y,-offset.z,-offset.x) })
+                        groups.append({'xml':groupNodes[groupName],'obj':obj,'group':group, 'instance_offset_delta' : (offset.y,-offset.z,-offset.x) })
                     
                     # create root for the group object
-                    print("a[%s].append(a[%s]" %(groupName,modelNode))
-                    if modelNode in a and a[modelNode] not in a[groupName]:
-                        if (obj.parent):
-                            print("                        if not %s or groupObjMapping[%s]!=groupObjMapping[%s]:" %(obj.parent,obj.parent.name,obj.name))
-                        if not obj.parent or (obj.parent_type!="BONE" and groupObjMapping.get(obj.parent.name)!=groupObjMapping[obj.name]):
-                            a[groupName].append(a[modelNode])
-                #a[modelNode] = ET.SubElement(a[groupName],'node') 
-
-        # if not is_obj_in_group:
-        #     a[modelNode].set("id", "{:d}".format(k))
-        if not ObjInGroup(obj):
+                    print("%s.append(%s)" %(groupName,modelNode))
+                    if (obj.parent):
+                        print("                        if not %s or groupObjMapping[%s]!=groupObjMapping[%s]:" %(obj.parent,obj.parent.name,obj.name))
+                    if not obj.parent or (obj.parent_type!="BONE" and groupObjMapping.get(obj.parent.name)!=groupObjMapping[obj.name]):
+                        groupNodes[groupName].append(modelElem)
+
+        if not is_obj_in_group:
             if not obj.is_replicated:
-                a[modelNode].set("id", "{:d}".format(k))
+                modelElem.set("id", "{:d}".format(k))
         
         if urho_settings.generateSceneHeader and not is_obj_in_group:
             header_obj_data = header_objects[obj]
             header_obj_data["id"]=k
 
-        a["{:d}".format(m)] = ET.SubElement(a[modelNode], "attribute")
-        a["{:d}".format(m)].set("name", "Name")
-        a["{:d}".format(m)].set("value", uSceneModel.name)
-        m += 1
+        add_attribute(modelElem, "Name", uSceneModel.name)
 
         if sOptions.trasfObjects:
-            a["{:d}".format(m)] = ET.SubElement(a[modelNode], "attribute")
-            a["{:d}".format(m)].set("name", "Position")
-            a["{:d}".format(m)].set("value", Vector3ToString(uSceneModel.position))
-            m += 1
-            a["{:d}".format(m)] = ET.SubElement(a[modelNode], "attribute")
-            a["{:d}".format(m)].set("name", "Rotation")
-            a["{:d}".format(m)].set("value", Vector4ToString(uSceneModel.rotation))
-            m += 1
-            a["{:d}".format(m)] = ET.SubElement(a[modelNode], "attribute")
-            a["{:d}".format(m)].set("name", "Scale")
-            a["{:d}".format(m)].set("value", Vector3ToString(uSceneModel.scale))
-            m += 1
+            add_attribute(modelElem, "Position", Vector3ToString(uSceneModel.position))
+            add_attribute(modelElem, "Rotation", Vector4ToString(uSceneModel.rotation))
+            add_attribute(modelElem, "Scale", Vector3ToString(uSceneModel.scale))
         
         if (sOptions.exportUserdata or sOptions.exportObjectCollectionAsTag) and obj:
-            m = ExportUserdata(a,m,obj,modelNode,sOptions.exportObjectCollectionAsTag,fOptions)
+            collectionTags = None
+            if collectionTagsMap is not None:
+                collectionTags = collectionTagsMap.get(obj.name, [])
+            ExportUserdata(modelElem,obj,sOptions.exportObjectCollectionAsTag,fOptions,collectionTags)
         
         if sOptions.exportGroupsAsObject and obj.instance_type == 'COLLECTION':
             grp = obj.instance_collection
             if obj.inline_collection_instance:
                 grpFilename = ""
             else:
-                grpFilename = sOptions.objectsPath+"/"+GetGroupName(grp.name)+".xml"
+                grpFilename = sOptions.objectsPath+"/"+GetGroupName(grp.name)+"."+fOptions.exts[PathType.OBJECTS]
 
-            m = AddGroupInstanceComponent(a,m,grpFilename,grp.instance_offset,modelNode,urho_settings.exportLangType=="cs")
+            AddGroupInstanceComponent(modelElem,grpFilename,grp.instance_offset,urho_settings.exportLangType=="cs")
 
         xmlCurrentModelNode = None
 
         if not isEmpty:
-            compID = m
-            a["{:d}".format(compID)] = ET.SubElement(a[modelNode], "component")
-            xmlCurrentModelNode = a["{:d}".format(compID)]
-            a["{:d}".format(compID)].set("type", uSceneModel.type)
+            xmlCurrentModelNode = ET.SubElement(modelElem, "component")
+            xmlCurrentModelNode.set("type", uSceneModel.type)
             # TODO: check for node replicated-state
             if not ObjInGroup(obj):
-                a["{:d}".format(compID)].set("id", "{:d}".format(compoID))
-            m += 1
+                xmlCurrentModelNode.set("id", "{:d}".format(compoID))
 
-            a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-            a["{:d}".format(m)].set("name", "Model")
             currentModel = "Model;" + modelFile
-            
-            a["{:d}".format(m)].set("value", currentModel)
-            m += 1
+            add_attribute(xmlCurrentModelNode, "Model", currentModel)
 
             if obj.hide_render:
-                a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                a["{:d}".format(m)].set("name", "Is Enabled")
-                a["{:d}".format(m)].set("value", "false")
-                m += 1
-
+                add_attribute(xmlCurrentModelNode, "Is Enabled", "false")
 
-            a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-            a["{:d}".format(m)].set("name", "Material")
             currentMaterialValue = "Material" + materials
-            a["{:d}".format(m)].set("value", currentMaterialValue)
-            m += 1
+            add_attribute(xmlCurrentModelNode, "Material", currentMaterialValue)
 
             if obj.parent_type=="BONE":
                 attrs={
                     "boneName" : obj.parent_bone
                 }
-                add_component(a[modelNode],"ParentBone",attrs,False,urho_settings.exportLangType=="cs")
+                add_component(modelElem,"ParentBone",attrs,False,urho_settings.exportLangType=="cs")
 
 
             if obj.type=="MESH":
                 if obj.cast_shadow:
-                    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                    a["{:d}".format(m)].set("name", "Cast Shadows")
-                    a["{:d}".format(m)].set("value", "true")
-                    m += 1
+                    add_attribute(xmlCurrentModelNode, "Cast Shadows", "true")
                 else:
-                    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                    a["{:d}".format(m)].set("name", "Cast Shadows")
-                    a["{:d}".format(m)].set("value", "false")
-                    m += 1
+                    add_attribute(xmlCurrentModelNode, "Cast Shadows", "false")
 
 
                 # if obj.receive_shadow:
-                #     a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                #     a["{:d}".format(m)].set("name", "Shadow Mask")
-                #     a["{:d}".format(m)].set("value", "1")
-                #     m += 1                           
+                #     add_attribute(xmlCurrentModelNode, "Shadow Mask", "1")
                 # else:
-                #     a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                #     a["{:d}".format(m)].set("name", "Shadow Mask")
-                #     a["{:d}".format(m)].set("value", "0")
-                #     m += 1                           
+                #     add_attribute(xmlCurrentModelNode, "Shadow Mask", "0")
 
             compoID += 1
 
@@ -1462,7 +1438,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                         for nodetreeSlot in obj.parent.nodetrees:
                             nt = nodetreeSlot.nodetreePointer
                             if (nt not in handledNodetrees):
-                                compoID = CreateNodeTreeXML(obj,a[modelNode],nt,compoID,currentModel,currentMaterialValue,xmlCurrentModelNode,modelNode,uSceneModel.collection_root)
+                                compoID = CreateNodeTreeXML(obj,modelElem,nt,compoID,currentModel,currentMaterialValue,xmlCurrentModelNode,modelNode,uSceneModel.collection_root)
                                 handledNodetrees.append(nt)
                             else:
                                 # we already added this nodetree! nothing more to do
@@ -1472,7 +1448,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                     for nodetreeSlot in obj.nodetrees:
                         nt = nodetreeSlot.nodetreePointer
                         if (nt and nt not in handledNodetrees):
-                            compoID = CreateNodeTreeXML(obj,a[modelNode],nt,compoID,currentModel,currentMaterialValue,xmlCurrentModelNode,modelNode,uSceneModel.collection_root,)
+                            compoID = CreateNodeTreeXML(obj,modelElem,nt,compoID,currentModel,currentMaterialValue,xmlCurrentModelNode,modelNode,uSceneModel.collection_root,)
                             handledNodetrees.append(nt)
                         else:
                             # we already added this nodetree! nothing more to do
@@ -1509,46 +1485,22 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                         shapeOffset.y = bbox.max[1] - shapeSize.y / 2
                         shapeOffset.z = bbox.max[2] - shapeSize.z / 2
 
-                    a["{:d}".format(m)] = ET.SubElement(a[modelNode], "component")
-                    a["{:d}".format(m)].set("type", "RigidBody")
-                    a["{:d}".format(m)].set("id", "{:d}".format(compoID))
-                    m += 1
+                    bodyElem = ET.SubElement(modelElem, "component")
+                    bodyElem.set("type", "RigidBody")
+                    bodyElem.set("id", "{:d}".format(compoID))
+                    add_attribute(bodyElem, "Collision Layer", "2")
+                    add_attribute(bodyElem, "Use Gravity", "false")
 
-                    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-1)], "attribute")
-                    a["{:d}".format(m)].set("name", "Collision Layer")
-                    a["{:d}".format(m)].set("value", "2")
-                    m += 1
-
-                    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-2)], "attribute")
-                    a["{:d}".format(m)].set("name", "Use Gravity")
-                    a["{:d}".format(m)].set("value", "false")
-                    m += 1
-
-                    a["{:d}".format(m)] = ET.SubElement(a[modelNode], "component")
-                    a["{:d}".format(m)].set("type", "CollisionShape")
-                    a["{:d}".format(m)].set("id", "{:d}".format(compoID+1))
-                    m += 1
-
-                    a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-1)] , "attribute")
-                    a["{:d}".format(m)].set("name", "Shape Type")
-                    a["{:d}".format(m)].set("value", shapeType)
-                    m += 1
+                    shapeElem = ET.SubElement(modelElem, "component")
+                    shapeElem.set("type", "CollisionShape")
+                    shapeElem.set("id", "{:d}".format(compoID+1))
+                    add_attribute(shapeElem, "Shape Type", shapeType)
 
                     if shapeType == "TriangleMesh":
-                        a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-2)], "attribute")
-                        a["{:d}".format(m)].set("name", "Model")
-                        a["{:d}".format(m)].set("value", "Model;" + modelFile)
-
+                        add_attribute(shapeElem, "Model", "Model;" + modelFile)
                     else:
-                        a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-2)] , "attribute")
-                        a["{:d}".format(m)].set("name", "Size")
-                        a["{:d}".format(m)].set("value", Vector3ToString(shapeSize))
-                        m += 1
-
-                        a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(m-3)] , "attribute")
-                        a["{:d}".format(m)].set("name", "Offset Position")
-                        a["{:d}".format(m)].set("value", Vector3ToString(shapeOffset))
-                        m += 1
+                        add_attribute(shapeElem, "Size", Vector3ToString(shapeSize))
+                        add_attribute(shapeElem, "Offset Position", Vector3ToString(shapeOffset))
 
                     compoID += 2
         else:
@@ -1558,7 +1510,7 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                 for nodetreeSlot in obj.nodetrees:
                     nt = nodetreeSlot.nodetreePointer
                     if (nt and nt not in handledNodetrees):
-                        compoID = CreateNodeTreeXML(obj,a[modelNode],nt,compoID,None,None,None,modelNode,uSceneModel.collection_root)
+                        compoID = CreateNodeTreeXML(obj,modelElem,nt,compoID,None,None,None,modelNode,uSceneModel.collection_root)
                         handledNodetrees.append(id)
                     else:
                         # we already added this nodetree! nothing more to do
@@ -1568,15 +1520,15 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                 attrs={
                     "boneName" : obj.parent_bone
                 }
-                add_component(a[modelNode],"ParentBone",attrs,False,urho_settings.exportLangType=="cs")
+                add_component(modelElem,"ParentBone",attrs,False,urho_settings.exportLangType=="cs")
 
             if obj.type == "LIGHT": #simple shadow-settings-export. For more control use LightNode
-                if not HasComponent(a[modelNode],"RotationFix"):
-                    add_component(a[modelNode],"RotationFix",None,False,urho_settings.exportLangType=="cs")
+                if not HasComponent(modelElem,"RotationFix"):
+                    add_component(modelElem,"RotationFix",None,False,urho_settings.exportLangType=="cs")
                     # SharpTypeName="TheOne.DotTestComponent, Game, Version=1.0.0.0, Culture=neutral, PublicKeyToken=null"
 
                 # check if
-                if not HasComponent(a[modelNode],"Light"):
+                if not HasComponent(modelElem,"Light"):
                     ldata = obj.data
                     light_attrs={}
                     light_attrs["Is Enabled"]="true"
@@ -1607,28 +1559,26 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                         print("could not determin cast-shadow-value => false")
                         light_attrs["Cast Shadows"]="false"
 
-                    add_component(a[modelNode],"Light",light_attrs)
+                    add_component(modelElem,"Light",light_attrs)
 
 
                     
             # export camera
             if obj.type == "CAMERA":
-                if not HasComponent(a[modelNode],"RotationFix"):
+                if not HasComponent(modelElem,"RotationFix"):
                     # TODO: why is replicated here always false?
-                    add_component(a[modelNode],"RotationFix",None,False,urho_settings.exportLangType=="cs")
+                    add_component(modelElem,"RotationFix",None,False,urho_settings.exportLangType=="cs")
 
                 # check if there is a camera-component already (created by nodetree)
-                if HasComponent(a[modelNode],"Camera"):
+                if HasComponent(modelElem,"Camera"):
                     print("There is a camera-node => ignore camera-object-data")
                 else:                    
                     blender_cam = obj.data
 
                     # compID = m
-                    # a["{:d}".format(compID)] = ET.SubElement(a[modelNode], "component")
-                    # xmlCurrentModelNode = a["{:d}".format(compID)]
-                    # a["{:d}".format(compID)].set("type", "Camera")
-                    # a["{:d}".format(compID)].set("id", "{:d}".format(compoID))
-                    # m += 1
+                    # xmlCurrentModelNode = ET.SubElement(modelElem, "component")
+                    # xmlCurrentModelNode.set("type", "Camera")
+                    # xmlCurrentModelNode.set("id", "{:d}".format(compoID))
 
                     camera_data = {}
                     if blender_cam.type=="PERSP":
@@ -1642,44 +1592,47 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
                     camera_data["Far Clip"]=blender_cam.clip_end
 
 
-                    add_component(a[modelNode],"Camera",camera_data)
+                    add_component(modelElem,"Camera",camera_data)
 
 
                     # for key in camera_data:
-                    #     a["{:d}".format(m)] = ET.SubElement(a["{:d}".format(compID)], "attribute")
-                    #     a["{:d}".format(m)].set("name", str(key))
-                    #     a["{:d}".format(m)].set("value", str(camera_data[key]))
-                    #     m += 1
+                    #     add_attribute(xmlCurrentModelNode, str(key), str(camera_data[key]))
 
 
                     # compoID += 1
 
 
-        # Write individual prefabs
-        if sOptions.doIndividualPrefab and not sOptions.individualPrefab_onlyRootObject:
+        # Write individual prefabs (the node without its children)
+        if sOptions.doIndividualPrefab and not sOptions.individualPrefab_onlyRootObject \
+                and IsPrefabObject(uSceneModel.name, sOptions):
             filepath = GetFilepath(PathType.OBJECTS, uSceneModel.name, fOptions)
-            if CheckFilepath(filepath[0], fOptions):
-                log.info( "Creating prefab {:s}".format(filepath[1]) )
-                WriteXmlFile(a[modelNode], filepath[0], fOptions)
+            log.info( "Creating prefab {:s}".format(filepath[1]) )
+            add_scene_file(modelElem, filepath, True)
 
         # Merging objects equates to an individual export. And collective equates to individual, so we can skip collective
         if sOptions.mergeObjects and sOptions.doScenePrefab: 
-            filepath = GetFilepath(PathType.SCENES, uScene.blenderSceneName, fOptions)
-            if CheckFilepath(filepath[0], fOptions):
-                log.info( "Creating scene prefab {:s}".format(filepath[1]) )
-                WriteXmlFile(sceneRoot, filepath[0], fOptions)
+            writeMergedScene = True
+
+    if writeMergedScene:
+        filepath = GetFilepath(PathType.SCENES, uScene.blenderSceneName, fOptions)
+        log.info( "Creating scene prefab {:s}".format(filepath[1]) )
+        add_scene_file(sceneRoot, filepath)
 
     # Write individual prefabs
     if sOptions.doIndividualPrefab:
         if sOptions.individualPrefab_onlyRootObject:
             for model in parentObjects:
+                if not IsPrefabObject(model["uSceneModel"].name, sOptions):
+                    continue
                 filepath = GetFilepath(PathType.OBJECTS, model["uSceneModel"].name, fOptions)
-                if CheckFilepath(filepath[0], fOptions):
-                    log.info( "!!Creating prefab {:s}".format(filepath[1]) )
-                    WriteXmlFile(model["xml"], filepath[0], fOptions)
+                log.info( "!!Creating prefab {:s}".format(filepath[1]) )
+                add_scene_file(model["xml"], filepath)
 
     if (sOptions.exportGroupsAsObject):
         for grp in groups:
+            if sOptions.prefabObjects is not None and \
+                    not any(obj.name in sOptions.prefabObjects for obj in grp["group"].all_objects):
+                continue
             filepath = GetFilepath(PathType.OBJECTS, GetGroupName(grp["group"].name), fOptions)
             if CheckFilepath(filepath[0], fOptions):
                 log.info( "!!Creating group-prefab {:s}".format(filepath[1]) )
@@ -1700,29 +1653,35 @@ def UrhoExportScene(context, uScene, sOptions, fOptions):
 
                                 idata.attrib["value"]="%s %s %s" % (new_x,new_y,new_z)
 
-                WriteXmlFile(clone_data, filepath[0], fOptions)
+                sceneFiles.append((clone_data, filepath[0], False))
 
     # Write collective and scene prefab files
     if not sOptions.mergeObjects:
 
         if sOptions.doCollectivePrefab:
             filepath = GetFilepath(PathType.OBJECTS, uScene.blenderSceneName, fOptions)
-            if CheckFilepath(filepath[0], fOptions):
-                log.info( "Creating collective prefab {:s}".format(filepath[1]) )
-                WriteXmlFile(root, filepath[0], fOptions)
+            log.info( "Creating collective prefab {:s}".format(filepath[1]) )
+            add_scene_file(root, filepath)
 
         if sOptions.doScenePrefab:
             filepath = GetFilepath(PathType.SCENES, uScene.blenderSceneName, fOptions)
-            if CheckFilepath(filepath[0], fOptions):
-                log.info( "Creating scene prefab {:s}".format(filepath[1]) )
-                WriteXmlFile(sceneRoot, filepath[0], fOptions)
+            log.info( "Creating scene prefab {:s}".format(filepath[1]) )
+            add_scene_file(sceneRoot, filepath)
 
             print("START EXPORTING MATERIALNODETREES")
             print("FILEPATH %s" % filepath[0])
             
             log.info( "Creating material {:s}".format(filepath[1]) )
             
-            UrhoWriteMaterialTrees(fOptions)         
+            UrhoWriteMaterialTrees(fOptions, materialTrees=sOptions.materialTrees)
+
+    # Write the scene and prefab files, now that the tree is complete
+    for elem, filepath, withoutChildren in sceneFiles:
+        if withoutChildren:
+            prefab = ET.Element(elem.tag, elem.attrib)
+            prefab.extend(child for child in elem if child.tag != "node")
+            elem = prefab
+        WriteSceneFile(elem, filepath, sOptions, fOptions)
     
     if urho_settings.generateSceneHeader:
         filename, file_extension = os.path.splitext(urho_settings.sceneHeaderOutputPath)
@@ -0,0 +1,378 @@
+#
+# This script is licensed as public domain.
+#
+
+# Binary Urho3D scene and prefab writer (Scene::Load, Node::Load, Scene::Instantiate).
+# The writer converts the same XML element tree written by export_scene.py.
+# Binary attributes have no names: each object writes the values of all its file
+# attributes, in the order they are registered in the engine. So the writer needs
+# a schema with the attributes layout of every component type in the tree.
+# The built-in schema covers the Scene, the Node and some engine components of
+# Urho3D 1.7. A JSON schema file dumped from the runtime can add custom components
+# or replace the built-in layouts:
+#   { "TypeName": [ ["Attribute Name", "VariantType", "default value"],
+#                   ["Enum Attribute", "Enum", "default name", ["Name0", "Name1"]], ... ] }
+# Values and defaults are strings, as in the XML files.
+
+import json
+import struct
+import logging
+
+log = logging.getLogger("ExportLogger")
+
+# Binary scene file ID
+SCENE_FILE_ID = b"USCN"
+
+# Variant types, the index is the type code
+VARIANT_TYPES = ("None", "Int", "Bool", "Float", "Vector2", "Vector3", "Vector4", "Quaternion",
+                 "Color", "String", "Buffer", "VoidPtr", "ResourceRef", "ResourceRefList",
+                 "VariantVector", "VariantMap", "IntRect", "IntVector2", "Ptr", "Matrix3",
+                 "Matrix3x4", "Matrix4", "Double", "StringVector", "Rect", "IntVector3", "Int64")
+VARIANT_CODES = {name: code for code, name in enumerate(VARIANT_TYPES)}
+
+# Fixed size types: struct format and number of values
+VALUE_FORMATS = {
+    "Int": ("<i", 1),
+    "Float": ("<f", 1),
+    "Vector2": ("<2f", 2),
+    "Vector3": ("<3f", 3),
+    "Vector4": ("<4f", 4),
+    "Quaternion": ("<4f", 4),
+    "IntRect": ("<4i", 4),
+    "IntVector2": ("<2i", 2),
+    "IntVector3": ("<3i", 3),
+    "Rect": ("<4f", 4),
+    "Matrix3": ("<9f", 9),
+    "Matrix3x4": ("<12f", 12),
+    "Matrix4": ("<16f", 16),
+    "Double": ("<d", 1),
+    "Int64": ("<q", 1)
+}
+
+# Raised when the tree cannot be written with the schema
+class BinarySceneError(Exception):
+    pass
+
+#--------------------
+# Built-in schema
+#--------------------
+
+DRAWABLE_ATTRIBUTES = [
+    ["Max Lights", "Int", "0"],
+    ["View Mask", "Int", "-1"],
+    ["Light Mask", "Int", "-1"],
+    ["Shadow Mask", "Int", "-1"],
+    ["Zone Mask", "Int", "-1"]
+]
+
+STATICMODEL_ATTRIBUTES = [
+    ["Is Enabled", "Bool", "true"],
+    ["Model", "ResourceRef", "Model;"],
+    ["Material", "ResourceRefList", "Material;"],
+    ["Is Occluder", "Bool", "false"],
+    ["Can Be Occluded", "Bool", "true"],
+    ["Cast Shadows", "Bool", "false"],
+    ["Draw Distance", "Float", "0"],
+    ["Shadow Distance", "Float", "0"],
+    ["LOD Bias", "Float", "1"]
+] + DRAWABLE_ATTRIBUTES + [
+    ["Occlusion LOD Level", "Int", "-1"]
+]
+
+BUILTIN_SCHEMA = {
+    "Scene": [
+        ["Name", "String", ""],
+        ["Time Scale", "Float", "1"],
+        ["Smoothing Constant", "Float", "50"],
+        ["Snap Threshold", "Float", "5"],
+        ["Elapsed Time", "Float", "0"],
+        ["Next Replicated Node ID", "Int", "1"],
+        ["Next Replicated Component ID", "Int", "1"],
+        ["Next Local Node ID", "Int", "16777216"],
+        ["Next Local Component ID", "Int", "16777216"],
+        ["Variables", "VariantMap", ""],
+        ["Variable Names", "String", ""]
+    ],
+    "Node": [
+        ["Is Enabled", "Bool", "true"],
+        ["Name", "String", ""],
+        ["Tags", "StringVector", ""],
+        ["Position", "Vector3", "0 0 0"],
+        ["Rotation", "Quaternion", "1 0 0 0"],
+        ["Scale", "Vector3", "1 1 1"],
+        ["Variables", "VariantMap", ""]
+    ],
+    "Octree": [
+        ["Bounding Box Min", "Vector3", "-1000 -1000 -1000"],
+        ["Bounding Box Max", "Vector3", "1000 1000 1000"],
+        ["Number of Levels", "Int", "8"]
+    ],
+    "DebugRenderer": [
+        ["Line Antialias", "Bool", "false"]
+    ],
+    "PhysicsWorld": [
+        ["Gravity", "Vector3", "0 -9.81 0"],
+        ["Physics FPS", "Int", "60"],
+        ["Max Substeps", "Int", "0"],
+        ["Solver Iterations", "Int", "10"],
+        ["Net Max Angular Vel.", "Float", "100"],
+        ["Interpolation", "Bool", "true"],
+        ["Internal Edge Utility", "Bool", "true"],
+        ["Split Impulse", "Bool", "false"]
+    ],
+    "StaticModel": STATICMODEL_ATTRIBUTES,
+    "Skybox": STATICMODEL_ATTRIBUTES,
+    "Zone": [
+        ["Is Enabled", "Bool", "true"],
+        ["Bounding Box Min", "Vector3", "-10 -10 -10"],
+        ["Bounding Box Max", "Vector3", "10 10 10"],
+        ["Ambient Color", "Color", "0.1 0.1 0.1 1"],
+        ["Fog Color", "Color", "0 0 0 1"],
+        ["Fog Start", "Float", "250"],
+        ["Fog End", "Float", "1000"],
+        ["Fog Height", "Float", "0"],
+        ["Fog Height Scale", "Float", "0.5"],
+        ["Height Fog Mode", "Bool", "false"],
+        ["Override Mode", "Bool", "false"],
+        ["Ambient Gradient", "Bool", "false"],
+        ["Priority", "Int", "0"],
+        ["Zone Texture", "ResourceRef", "TextureCube;"],
+        ["Light Mask", "Int", "-1"],
+        ["Shadow Mask", "Int", "-1"],
+        ["Zone Mask", "Int", "-1"]
+    ],
+    "Camera": [
+        ["Is Enabled", "Bool", "true"],
+        ["Near Clip", "Float", "0.1"],
+        ["Far Clip", "Float", "1000"],
+        ["FOV", "Float", "45"],
+        ["Aspect Ratio", "Float", "1"],
+        ["Fill Mode", "Enum", "Solid", ["Solid", "Wireframe", "Point"]],
+        ["Auto Aspect Ratio", "Bool", "true"],
+        ["Orthographic", "Bool", "false"],
+        ["Orthographic Size", "Float", "20"],
+        ["Zoom", "Float", "1"],
+        ["LOD Bias", "Float", "1"],
+        ["View Mask", "Int", "-1"],
+        ["View Override Flags", "Int", "0"],
+        ["Projection Offset", "Vector2", "0 0"],
+        ["Reflection Plane", "Vector4", "0 1 0 0"],
+        ["Clip Plane", "Vector4", "0 1 0 0"],
+        ["Use Reflection", "Bool", "false"],
+        ["Use Clipping", "Bool", "false"]
+    ]
+}
+
+# Get the schema: the built-in layouts updated with the layouts in the JSON file 'filepath'
+def LoadSceneSchema(filepath=None):
+    schema = dict(BUILTIN_SCHEMA)
+    if not filepath:
+        return schema
+    try:
+        with open(filepath, "r") as file:
+            fileSchema = json.load(file)
+    except (OSError, ValueError) as e:
+        log.error("Cannot read scene schema {:s}: {!s}".format(filepath, e))
+        return schema
+    for typeName, attributes in fileSchema.items():
+        for attribute in attributes:
+            if attribute[1] != "Enum" and attribute[1] not in VARIANT_CODES:
+                log.error("Scene schema {:s}: unknown type {:s} of {:s}/{:s}".format(filepath, attribute[1], typeName, attribute[0]))
+                break
+        else:
+            schema[typeName] = attributes
+    log.info("Scene schema {:s}: {:d} types".format(filepath, len(fileSchema)))
+    return schema
+
+# Components written by the scene exporter which are not in the built-in schema, the
+# schema file must have their layouts
+EXPORTER_TYPES = ("AnimatedModel", "RenderData", "GroupInstance", "ParentBone", "RotationFix",
+                  "Light", "RigidBody", "CollisionShape")
+
+# Get the exporter components missing in the schema
+def MissingSchemaTypes(schema):
+    return [typeName for typeName in EXPORTER_TYPES if typeName not in schema]
+
+#--------------------
+# Values
+#--------------------
+
+# Like StringHash in Urho3D (case insensitive SDBM hash)
+def StringHash(text):
+    hash = 0
+    for c in text.lower():
+        hash = (ord(c) + (hash << 6) + (hash << 16) - hash) & 0xFFFFFFFF
+    return hash
+
+class BinarySceneWriter:
+    def __init__(self, schema):
+        self.schema = schema
+        self.buffer = bytearray()
+
+    def writeUInt(self, v):
+        self.buffer += struct.pack("<I", v & 0xFFFFFFFF)
+
+    # Variable length encoded unsigned int (Serializer::WriteVLE)
+    def writeVLE(self, v):
+        while v >= 0x80:
+            self.buffer.append((v & 0x7F) | 0x80)
+            v >>= 7
+        self.buffer.append(v)
+
+    # Null terminated UTF-8 string
+    def writeString(self, v):
+        self.buffer += v.encode("utf-8") + b"\0"
+
+    # Write the data of a value from its XML string (Serializer::WriteVariantData)
+    def writeValue(self, typeName, value, elem=None):
+        if typeName == "Bool":
+            # Like ToBool(): true, yes or 1
+            self.buffer.append(1 if value.strip()[:1].lower() in ("t", "y", "1") else 0)
+        elif typeName == "String":
+            self.writeString(value)
+        elif typeName == "Color":
+            values = self.parseNumbers(value, float, typeName)
+            if len(values) == 3:
+                values.append(1.0)
+            if len(values) != 4:
+                raise BinarySceneError("invalid Color '{:s}'".format(value))
+            self.buffer += struct.pack("<4f", *values)
+        elif typeName in VALUE_FORMATS:
+            fmt, count = VALUE_FORMATS[typeName]
+            number = float if fmt[-1] in "fd" else int
+            values = self.parseNumbers(value, number, typeName)
+            if len(values) != count:
+                raise BinarySceneError("invalid {:s} '{:s}'".format(typeName, value))
+            if number is int:
+                # Unsigned masks are stored in signed ints
+                bits = 64 if fmt[-1] == "q" else 32
+                values = [v - (1 << bits) if v >= 1 << (bits - 1) else v for v in values]
+            self.buffer += struct.pack(fmt, *values)
+        elif typeName == "ResourceRef":
+            refType, _, name = value.partition(";")
+            self.writeUInt(StringHash(refType.strip()))
+            self.writeString(name)
+        elif typeName == "ResourceRefList":
+            names = value.split(";")
+            self.writeUInt(StringHash(names[0].strip()))
+            names = names[1:]
+            self.writeVLE(len(names))
+            for name in names:
+                self.writeString(name)
+        elif typeName == "Buffer":
+            data = bytes(self.parseNumbers(value, int, typeName))
+            self.writeVLE(len(data))
+            self.buffer += data
+        elif typeName == "StringVector":
+            strings = [] if elem is None else elem.findall("string")
+            self.writeVLE(len(strings))
+            for item in strings:
+                self.writeString(item.get("value", ""))
+        elif typeName == "VariantVector":
+            variants = [] if elem is None else elem.findall("variant")
+            self.writeVLE(len(variants))
+            for item in variants:
+                self.writeVariant(item)
+        elif typeName == "VariantMap":
+            variants = [] if elem is None else elem.findall("variant")
+            self.writeVLE(len(variants))
+            for item in variants:
+                if item.get("hash") is not None:
+                    self.writeUInt(int(item.get("hash")))
+                else:
+                    self.writeUInt(StringHash(item.get("name", "")))
+                self.writeVariant(item)
+        elif typeName != "None":
+            raise BinarySceneError("type {:s} not supported".format(typeName))
+
+    # Write a <variant> element: type code and data (Serializer::WriteVariant)
+    def writeVariant(self, elem):
+        typeName = elem.get("type", "None")
+        if typeName not in VARIANT_CODES:
+            raise BinarySceneError("unknown variant type {:s}".format(typeName))
+        self.buffer.append(VARIANT_CODES[typeName])
+        self.writeValue(typeName, elem.get("value", ""), elem)
+
+    def parseNumbers(self, value, number, typeName):
+        try:
+            if number is int:
+                return [int(float(v)) for v in value.split()]
+            return [float(v) for v in value.split()]
+        except ValueError:
+            raise BinarySceneError("invalid {:s} '{:s}'".format(typeName, value))
+
+    #--------------------
+    # Objects
+    #--------------------
+
+    # Write the file attributes of the object 'elem' of type 'typeName' (Serializable::Save)
+    def writeAttributes(self, elem, typeName):
+        layout = self.schema.get(typeName)
+        if layout is None:
+            raise BinarySceneError("no schema for type {:s}".format(typeName))
+        if elem.get("SharpTypeName") is not None:
+            raise BinarySceneError("C# component {:s} not supported".format(typeName))
+        attributes = {attribute.get("name"): attribute for attribute in elem.findall("attribute")}
+        unknown = set(attributes) - set(attribute[0] for attribute in layout)
+        if unknown:
+            raise BinarySceneError("{:s} has no attributes {:s}".format(typeName, ", ".join(sorted(unknown))))
+        for attribute in layout:
+            name, attrType, default = attribute[:3]
+            attributeElem = attributes.get(name)
+            value = default if attributeElem is None else attributeElem.get("value", "")
+            try:
+                if attrType == "Enum":
+                    self.writeEnum(attribute, value)
+                else:
+                    self.writeValue(attrType, value, attributeElem)
+            except BinarySceneError as e:
+                raise BinarySceneError("{:s}/{:s}: {!s}".format(typeName, name, e))
+
+    # Enums are written as ints, in XML they have the name of the value
+    def writeEnum(self, attribute, value):
+        names = [name.lower() for name in attribute[3]]
+        value = value.strip()
+        if value.lower() in names:
+            index = names.index(value.lower())
+        else:
+            try:
+                index = int(value)
+            except ValueError:
+                raise BinarySceneError("invalid enum value '{:s}'".format(value))
+        self.buffer += struct.pack("<i", index)
+
+    # Component: type hash, ID and attributes (Component::Save)
+    def writeComponent(self, elem):
+        typeName = elem.get("type", "")
+        self.writeUInt(StringHash(typeName))
+        self.writeUInt(int(elem.get("id", "0")))
+        self.writeAttributes(elem, typeName)
+
+    # Node: ID, attributes, components with their size, child nodes (Node::Save)
+    def writeNode(self, elem, typeName="Node"):
+        self.writeUInt(int(elem.get("id", "0")))
+        self.writeAttributes(elem, typeName)
+
+        components = elem.findall("component")
+        self.writeVLE(len(components))
+        for component in components:
+            # Components are prefixed by their size, so unknown types can be skipped on load
+            writer = BinarySceneWriter(self.schema)
+            writer.writeComponent(component)
+            self.writeVLE(len(writer.buffer))
+            self.buffer += writer.buffer
+
+        children = elem.findall("node")
+        self.writeVLE(len(children))
+        for child in children:
+            self.writeNode(child)
+
+# Convert a <scene> or <node> element tree to binary data
+def SceneToBinary(elem, schema):
+    writer = BinarySceneWriter(schema)
+    if elem.tag == "scene":
+        writer.buffer += SCENE_FILE_ID
+        writer.writeNode(elem, "Scene")
+    else:
+        writer.writeNode(elem)
+    return bytes(writer.buffer)
@@ -5,14 +5,18 @@
 #
 
 from .utils import FloatToString, WriteXmlFile, BinaryFileWriter
+from .meshops import VertexStore, VERTEX_COLUMNS, WeldVertices, TransformPoints, Dot3, \
+    OptimizeOverdraw, OverdrawStatistics, VertexCacheStatistics, VertexFetchOrder, VertexFetchStatistics, \
+    TopWeights, SpatialSplit, MAX_VERTICES_16BIT
 
 from mathutils import Vector, Matrix, Quaternion
-from math import cos, pi
+from math import cos, pi, radians
 from xml.etree import ElementTree as ET
 from collections import defaultdict
 import operator
 import os
 import random
+import numpy as np
 import bpy
 
 import logging
@@ -37,6 +41,36 @@ ELEMENT_BLEND       = 0x0300
 
 MORPH_ELEMENTS      = ELEMENT_POSITION | ELEMENT_NORMAL | ELEMENT_TANGENT
 
+# Size in bytes of each vertex element
+ELEMENT_SIZES = ((ELEMENT_POSITION, 12), (ELEMENT_NORMAL, 12), (ELEMENT_COLOR, 4), (ELEMENT_UV1, 8),
+                 (ELEMENT_UV2, 8), (ELEMENT_CUBE_UV1, 12), (ELEMENT_CUBE_UV2, 12), (ELEMENT_TANGENT, 16),
+                 (ELEMENT_BWEIGHTS, 16), (ELEMENT_BINDICES, 4))
+
+# Vertex element types and semantics of the UMD2 vertex declarations
+TYPE_INT            = 0
+TYPE_FLOAT          = 1
+TYPE_VECTOR2        = 2
+TYPE_VECTOR3        = 3
+TYPE_VECTOR4        = 4
+TYPE_UBYTE4         = 5
+TYPE_UBYTE4_NORM    = 6
+
+TYPE_SIZES = {TYPE_INT: 4, TYPE_FLOAT: 4, TYPE_VECTOR2: 8, TYPE_VECTOR3: 12, TYPE_VECTOR4: 16,
+              TYPE_UBYTE4: 4, TYPE_UBYTE4_NORM: 4}
+
+SEM_POSITION        = 0
+SEM_NORMAL          = 1
+SEM_BINORMAL        = 2
+SEM_TANGENT         = 3
+SEM_TEXCOORD        = 4
+SEM_COLOR           = 5
+SEM_BLENDWEIGHTS    = 6
+SEM_BLENDINDICES    = 7
+
+# Model file formats: legacy with element masks, with vertex declarations
+MODEL_UMDL          = "UMDL"
+MODEL_UMD2          = "UMD2"
+
 BONE_BOUNDING_SPHERE = 0x0001
 BONE_BOUNDING_BOX    = 0x0002
 
@@ -129,6 +163,23 @@ class BoundingBox:
         if point.z > self.max.z:
             self.max.z = point.z
 
+    # Merge an array of points (points x 3), same result of merging them in order
+    def mergeArray(self, points):
+        if not len(points):
+            return
+        # The first minimum and maximum, like merging each point
+        minPoint = points[np.argmin(points, axis=0), [0, 1, 2]].tolist()
+        maxPoint = points[np.argmax(points, axis=0), [0, 1, 2]].tolist()
+        if self.min is None:
+            self.min = Vector(minPoint)
+            self.max = Vector(maxPoint)
+            return
+        for i in range(3):
+            if minPoint[i] < self.min[i]:
+                self.min[i] = minPoint[i]
+            if maxPoint[i] > self.max[i]:
+                self.max[i] = maxPoint[i]
+
 
 # Exception for a vertex with more or less elements than its vertex buffer
 class VertexMaskError(Exception):
@@ -174,98 +225,6 @@ class FrameMaskError(Exception):
 
 # --- Model classes ---
 
-class UrhoVertex:
-    def __init__(self, tVertex):
-        # Bit mask of elements present
-        self.mask = 0
-        # Only used by morphs, original vertex index in the not morphed vertex buffer
-        self.index = None 
-        # Vertex position: Vector((0.0, 0.0, 0.0)) of floats
-        self.pos = tVertex.pos
-        if tVertex.pos:
-            self.mask |= ELEMENT_POSITION
-        # Vertex normal: Vector((0.0, 0.0, 0.0)) of floats
-        self.normal = tVertex.normal
-        if tVertex.normal:
-            self.mask |= ELEMENT_NORMAL
-        # Vertex color: (0, 0, 0, 0) of unsigned bytes
-        self.color = tVertex.color       
-        if tVertex.color:
-            self.mask |= ELEMENT_COLOR
-        # Vertex UV texture coordinate: (0.0, 0.0) of floats
-        self.uv = tVertex.uv
-        if tVertex.uv:
-            self.mask |= ELEMENT_UV1
-        # Vertex UV2 texture coordinate: (0.0, 0.0) of floats
-        self.uv2 = tVertex.uv2
-        if tVertex.uv2:
-            self.mask |= ELEMENT_UV2
-        # Vertex tangent: Vector((0.0, 0.0, 0.0, 0.0)) of floats
-        self.tangent = tVertex.tangent
-        if tVertex.tangent:
-            self.mask |= ELEMENT_TANGENT
-        # List of tuples: blend weight (float), bone index (unsigned byte), mapped bone index (None if the bone is not mapped)
-        self.weights = [(0.0, 0, None)] * BONES_PER_VERTEX
-        if tVertex.weights is not None:
-            # Sort tuples (index, weight) by decreasing weight
-            sortedList = sorted(tVertex.weights, key = operator.itemgetter(1), reverse = True)
-            sortedList = sortedList[:BONES_PER_VERTEX]
-            # Normalize weights and add to the list
-            totalWeight = sum([t[1] for t in sortedList])
-            for i, t in enumerate(sortedList):
-                self.weights[i] = (t[1] / totalWeight, t[0], None)
-            self.mask |= ELEMENT_BLEND
-
-    # used by the function index() of lists
-    def __eq__(self, other):
-        return (self.pos == other.pos and self.normal == other.normal and 
-                self.color == other.color and self.uv == other.uv)
-
-    # compare position, normal, color, UV, UV2 with another vertex, returns True is the error is insignificant
-    def AlmostEqual(self, other):
-        if not FloatListAlmostEqual(self.pos, other.pos):
-            return False
-        if not FloatListAlmostEqual(self.normal, other.normal):
-            return False
-        if self.color != other.color:
-            return False
-        if not FloatListAlmostEqual(self.uv, other.uv):
-            return False
-        if not FloatListAlmostEqual(self.uv2, other.uv2):
-            return False
-        return True
-
-    # compare position, normal, UV with another vertex, returns the error
-    def LodError(self, other):
-        # If the position is not equal, return max error
-        if not FloatListAlmostEqual(self.pos, other.pos):
-            return INFINITY
-        # If the angle between normals is above 30°, return max error (TODO: document this)
-        ncos = VectorDotProduct(self.normal, other.normal)
-        if ncos < cos(30 / 180 * pi):
-            return INFINITY
-        # UV are 0..1 x2, normals -1..1 x1, so this absolute error should be good 
-        return (FloatListEqualError(self.uv, other.uv)  + 1-ncos)
-
-    # not unique id of this vertex based on its position
-    def __hash__(self):
-        hashValue = 0
-        if self.pos:
-            hashValue ^= hash(self.pos.x) ^ hash(self.pos.y) ^ hash(self.pos.z)
-        return hashValue
-            
-    # used by morph vertex calculations (see AnimatedModel::ApplyMorph)
-    def subtract(self, other, mask):
-        if mask & ELEMENT_POSITION:
-            self.pos -= other.pos
-        if mask & ELEMENT_NORMAL:
-            self.normal -= other.normal
-        if mask & ELEMENT_TANGENT:
-            self.tangent -= other.tangent
-            # tangent.w it is not modified by morphs (remember, there we
-            # have saved bitangent direction)
-            self.tangent.w = 0
-            
 class UrhoVertexBuffer:
     def __init__(self):
         # Flags of the elements contained in every vertex of this buffer
@@ -273,8 +232,9 @@ class UrhoVertexBuffer:
         # Morph min index and max index in the list vertices TODO: check
         self.morphMinIndex = None
         self.morphMaxIndex = None
-        # List of UrhoVertex
-        self.vertices = []
+        # VertexStore of the vertices, bones weights are sorted, normalized and
+        # with BONES_PER_VERTEX slots
+        self.vertices = VertexStore()
 
     # Check if a vertex is compatible with this buffer or has different elements
     def updateMask(self, vertexMask):
@@ -288,12 +248,54 @@ class UrhoVertexBuffer:
                 self.elementMask = vertexMask
             raise VertexMaskError(oldMask, vertexMask)
 
+    # Same as calling updateMask for each mask in the array 'vertexMasks'. Returns the
+    # buffer mask after each vertex and a list of tuple(vertex position, VertexMaskError).
+    # Only the vertices with a different mask need to be checked, and the buffer mask can
+    # only grow a few times.
+    def updateMasks(self, vertexMasks):
+        count = len(vertexMasks)
+        bufferMasks = np.empty(count, dtype=np.int64)
+        errors = []
+        start = 0
+        while start < count:
+            if self.elementMask is None:
+                self.elementMask = int(vertexMasks[start])
+            elementMask = self.elementMask
+            end = count
+            for i in (np.flatnonzero(vertexMasks[start:] != elementMask) + start).tolist():
+                try:
+                    self.updateMask(int(vertexMasks[i]))
+                except VertexMaskError as e:
+                    errors.append((i, e))
+                if self.elementMask != elementMask:
+                    end = i
+                    break
+            bufferMasks[start:end] = elementMask
+            if end < count:
+                bufferMasks[end] = self.elementMask
+            start = end + 1
+        return bufferMasks, errors
+
 class UrhoIndexBuffer:
     def __init__(self):
         # Size of each index: 2 for 16 bits, 4 for 32 bits
         self.indexSize = 0
-        # List of triples of indices (in the vertex buffer) to draw triangles
-        self.indexes = []
+        # Arrays of indices (in the vertex buffer) to draw triangles, one for each LOD
+        self.indexesArrays = []
+        # Total number of indices
+        self.indexesCount = 0
+
+    # Add indices at the end of the buffer
+    def append(self, indexes):
+        self.indexesArrays.append(indexes)
+        self.indexesCount += len(indexes)
+
+    # All the indices in one array
+    @property
+    def indexes(self):
+        if len(self.indexesArrays) != 1:
+            self.indexesArrays = [np.concatenate(self.indexesArrays or [np.zeros(0, dtype=np.int64)])]
+        return self.indexesArrays[0]
     
 class UrhoLodLevel:
     def __init__(self):
@@ -515,14 +517,81 @@ class UrhoExportData:
 class UrhoExportOptions:
     def __init__(self):
         self.splitSubMeshes = False
+        self.splitLargeGeometries = False
+        self.modelFormat = MODEL_UMDL
+        self.packNormals = False
         self.useStrictLods = True
+        self.vertexCacheSize = 32
+        self.optimizeOverdraw = False
+        self.overdrawThreshold = 1.05
+        self.optimizeVertexFetch = True
+        # Remove the animation channels which are constant within these errors
+        self.pruneStaticChannels = False
+        self.prunePositionError = 0.001
+        self.pruneRotationError = radians(0.1)
+        self.pruneScaleError = 0.001
 
 
 #--------------------
 # Writers
 #--------------------
     
-def UrhoWriteModel(model, filename):
+# UMD2 vertex declaration of an element mask: list of tuple(type, semantic, index). Blend
+# weights are packed in bytes, normals and tangents too if 'packNormals' is True
+def VertexDeclaration(elementMask, packNormals):
+    elements = []
+    if elementMask & ELEMENT_POSITION:
+        elements.append((TYPE_VECTOR3, SEM_POSITION, 0))
+    if elementMask & ELEMENT_NORMAL:
+        elements.append((TYPE_UBYTE4_NORM if packNormals else TYPE_VECTOR3, SEM_NORMAL, 0))
+    if elementMask & ELEMENT_COLOR:
+        elements.append((TYPE_UBYTE4_NORM, SEM_COLOR, 0))
+    if elementMask & ELEMENT_UV1:
+        elements.append((TYPE_VECTOR2, SEM_TEXCOORD, 0))
+    if elementMask & ELEMENT_UV2:
+        elements.append((TYPE_VECTOR2, SEM_TEXCOORD, 1))
+    if elementMask & ELEMENT_TANGENT:
+        elements.append((TYPE_UBYTE4_NORM if packNormals else TYPE_VECTOR4, SEM_TANGENT, 0))
+    if elementMask & ELEMENT_BWEIGHTS:
+        elements.append((TYPE_UBYTE4_NORM, SEM_BLENDWEIGHTS, 0))
+    if elementMask & ELEMENT_BINDICES:
+        elements.append((TYPE_UBYTE4, SEM_BLENDINDICES, 0))
+    return elements
+
+# Pack direction vectors (n x 3 or n x 4, w = +-1) in normalized bytes: byte = (v * 0.5 + 0.5) * 255,
+# shaders decode them with v * 2 - 1. The directions are normalized before packing.
+# Returns the (n x 4) bytes and the max angle error in degrees.
+def PackUnitVectors(vectors):
+    packed = np.zeros((len(vectors), 4), dtype=np.uint8)
+    if not len(vectors):
+        return packed, 0.0
+    vectors = vectors.astype(np.float64)
+    original = vectors[:, :3]
+    lengths = np.sqrt((original * original).sum(axis=1))
+    vectors[:, :3] = original / np.where(lengths > 0.0, lengths, 1.0)[:, None]
+    packed[:, :vectors.shape[1]] = np.clip(np.floor((vectors * 0.5 + 0.5) * 255.0 + 0.5), 0, 255)
+    decoded = packed[:, :3] / 255.0 * 2.0 - 1.0
+    lengths = np.sqrt((decoded * decoded).sum(axis=1) * (original * original).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosines = np.where(lengths > 0.0, (decoded * original).sum(axis=1) / lengths, 1.0)
+    return packed, float(np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0))).max())
+
+# Pack normalized bones weights (n x slots, sorted by decreasing weight) in 4 bytes, the
+# rounding error is moved to the heavier weight so the sum stays 255. Returns the (n x 4)
+# bytes and the max weight error.
+def PackWeights(weights):
+    weights = weights[:, :4]
+    packed = np.zeros((len(weights), 4), dtype=np.int32)
+    packed[:, :weights.shape[1]] = np.floor(weights * 255.0 + 0.5)
+    sums = packed.sum(axis=1)
+    rows = np.flatnonzero(sums)
+    packed[rows, 0] += 255 - sums[rows]
+    packed = np.clip(packed, 0, 255).astype(np.uint8)
+    if not len(weights):
+        return packed, 0.0
+    return packed, float(np.abs(packed[:, :weights.shape[1]] / 255.0 - weights).max())
+
+def UrhoWriteModel(model, filename, modelFormat=MODEL_UMDL, packNormals=False):
 
     if not model.vertexBuffers or not model.indexBuffers or not model.geometries:
         log.error("No model data to export in {:s}".format(filename))
@@ -539,17 +608,37 @@ def UrhoWriteModel(model, filename):
         return
 
     # File Identifier
-    fw.writeAsciiStr("UMDL")
+    fw.writeAsciiStr(modelFormat)
+
+    # Morphs add their offsets to float normals and tangents, their buffers are not packed
+    morphedBuffers = set(i for morph in model.morphs for i in morph.vertexBufferMap)
+    # UMD2 statistics: vertex data size as UMDL and packed, max errors of the packed elements
+    legacySize = 0
+    packedSize = 0
+    normalsError = None
+    weightsError = None
     
     # Number of vertex buffers
     fw.writeUInt(len(model.vertexBuffers))
     # For each vertex buffer
-    for buffer in model.vertexBuffers:
+    for bufferIndex, buffer in enumerate(model.vertexBuffers):
         # Vertex count
         fw.writeUInt(len(buffer.vertices))
-        # Vertex element mask (determines vertex size)
         mask = buffer.elementMask
-        fw.writeUInt(mask)
+        packedNormals = False
+        if modelFormat == MODEL_UMD2:
+            # Vertex declaration (determines vertex size): number of elements, then type,
+            # semantic and index of each element
+            packedNormals = packNormals and bufferIndex not in morphedBuffers
+            elements = VertexDeclaration(mask, packedNormals)
+            fw.writeUInt(len(elements))
+            for elementType, semantic, index in elements:
+                fw.writeUInt(elementType | (semantic << 8) | (index << 16))
+            legacySize += VertexSize(mask) * len(buffer.vertices)
+            packedSize += sum(TYPE_SIZES[element[0]] for element in elements) * len(buffer.vertices)
+        else:
+            # Vertex element mask (determines vertex size)
+            fw.writeUInt(mask)
         # Morphable vertex range start index
         fw.writeUInt(buffer.morphMinIndex)
         # Morphable vertex count
@@ -557,34 +646,58 @@ def UrhoWriteModel(model, filename):
             fw.writeUInt(buffer.morphMaxIndex - buffer.morphMinIndex + 1)
         else:
             fw.writeUInt(0)
-        # Vertex data (vertex count * vertex size)
-        for vertex in buffer.vertices:
-            if mask & ELEMENT_POSITION:
-                fw.writeVector3(vertex.pos)
-            if mask & ELEMENT_NORMAL:
-                fw.writeVector3(vertex.normal)
-            if mask & ELEMENT_COLOR:
-                for i in range(4):
-                    fw.writeUByte(vertex.color[i])
-            if mask & ELEMENT_UV1:
-                for i in range(2):
-                    fw.writeFloat(vertex.uv[i])
-            if mask & ELEMENT_UV2:
-                for i in range(2):
-                    fw.writeFloat(vertex.uv2[i])
-            if mask & ELEMENT_TANGENT:
-                fw.writeVector3(vertex.tangent)
-                fw.writeFloat(vertex.tangent.w)
-            if mask & ELEMENT_BWEIGHTS:
-                for i in range(BONES_PER_VERTEX):
-                    fw.writeFloat(vertex.weights[i][0])
-            if mask & ELEMENT_BINDICES:
-                for i in range(BONES_PER_VERTEX):
-                    boneIndex = vertex.weights[i][1]
-                    remappedBoneIndex = vertex.weights[i][2]
-                    if remappedBoneIndex is not None:
-                        boneIndex = remappedBoneIndex
-                    fw.writeUByte(boneIndex)
+        # Vertex data (vertex count * vertex size): elements in the order of the mask,
+        # list of tuple(field name, type, values)
+        vertices = buffer.vertices
+        fields = []
+        if mask & ELEMENT_POSITION:
+            fields.append(("pos", "<f4", vertices.pos))
+        if mask & ELEMENT_NORMAL:
+            if packedNormals:
+                packed, error = PackUnitVectors(vertices.normal)
+                normalsError = max(error, normalsError or 0.0)
+                fields.append(("normal", "u1", packed))
+            else:
+                fields.append(("normal", "<f4", vertices.normal))
+        if mask & ELEMENT_COLOR:
+            fields.append(("color", "u1", vertices.color))
+        if mask & ELEMENT_UV1:
+            fields.append(("uv", "<f4", vertices.uv))
+        if mask & ELEMENT_UV2:
+            fields.append(("uv2", "<f4", vertices.uv2))
+        if mask & ELEMENT_TANGENT:
+            if packedNormals:
+                packed, error = PackUnitVectors(vertices.tangent)
+                normalsError = max(error, normalsError or 0.0)
+                fields.append(("tangent", "u1", packed))
+            else:
+                fields.append(("tangent", "<f4", vertices.tangent))
+        if mask & ELEMENT_BLEND:
+            # Use the remapped bone index if present
+            bones = np.where(vertices.remapped >= 0, vertices.remapped, np.maximum(vertices.bones, 0))
+            if modelFormat == MODEL_UMD2:
+                # 4 bones per vertex
+                packedBones = np.zeros((len(bones), 4), dtype=np.int32)
+                packedBones[:, :min(4, bones.shape[1])] = bones[:, :4]
+                bones = packedBones
+        if mask & ELEMENT_BWEIGHTS:
+            if modelFormat == MODEL_UMD2:
+                packed, error = PackWeights(vertices.weights)
+                weightsError = max(error, weightsError or 0.0)
+                fields.append(("weights", "u1", packed))
+            else:
+                fields.append(("weights", "<f4", vertices.weights))
+        if mask & ELEMENT_BINDICES:
+            fields.append(("bones", "u1", bones))
+        fw.writeArray(InterleaveFields(len(vertices), fields))
+
+    if modelFormat == MODEL_UMD2:
+        text = "UMD2 vertex data {:d} -> {:d} bytes".format(legacySize, packedSize)
+        if weightsError is not None:
+            text += ", max weight error {:.5f}".format(weightsError)
+        if normalsError is not None:
+            text += ", max normal error {:.3f}°".format(normalsError)
+        log.info("{:s}: {:s}".format(os.path.basename(filename), text))
 
     # Number of index buffers
     fw.writeUInt(len(model.indexBuffers))
@@ -595,11 +708,7 @@ def UrhoWriteModel(model, filename):
         # Index size (2 for 16-bit indices, 4 for 32-bit indices)
         fw.writeUInt(buffer.indexSize)
         # Index data (index count * index size)
-        for i in buffer.indexes:
-            if buffer.indexSize == 2:
-                fw.writeUShort(i)
-            else:
-                fw.writeUInt(i)
+        fw.writeArray(buffer.indexes, "<u2" if buffer.indexSize == 2 else "<u4")
 
     # Number of geometries
     fw.writeUInt(len(model.geometries))
@@ -645,19 +754,16 @@ def UrhoWriteModel(model, filename):
             fw.writeUInt(mask)
             # Vertex count
             fw.writeUInt(len(morphBuffer.vertices))
-            # For each vertex:
-            for vertex in morphBuffer.vertices:
-                # Moprh vertex index
-                fw.writeUInt(vertex.index)
-                # Moprh vertex Position
-                if mask & ELEMENT_POSITION:
-                    fw.writeVector3(vertex.pos)
-                # Moprh vertex Normal
-                if mask & ELEMENT_NORMAL:
-                    fw.writeVector3(vertex.normal)
-                # Moprh vertex Tangent
-                if mask & ELEMENT_TANGENT:
-                    fw.writeVector3(vertex.tangent)
+            # For each vertex: index, then the elements in the mask
+            vertices = morphBuffer.vertices
+            fields = [("index", "<u4", vertices.index.reshape(-1))]
+            if mask & ELEMENT_POSITION:
+                fields.append(("pos", "<f4", vertices.pos))
+            if mask & ELEMENT_NORMAL:
+                fields.append(("normal", "<f4", vertices.normal))
+            if mask & ELEMENT_TANGENT:
+                fields.append(("tangent", "<f4", vertices.tangent[:, :3]))
+            fw.writeArray(InterleaveFields(len(vertices), fields))
                     
     # Number of bones (may be 0)
     fw.writeUInt(len(model.bones))
@@ -735,19 +841,20 @@ def UrhoWriteAnimation(animation, filename):
         
         # Number of tracks
         fw.writeUInt(len(track.keyframes))
-        # For each keyframe
-        for keyframe in track.keyframes:
-            # Time position in seconds: float
-            fw.writeFloat(keyframe.time)
-            # Keyframe position
-            if mask & TRACK_POSITION:
-                fw.writeVector3(keyframe.position)
-            # Keyframe rotation
-            if mask & TRACK_ROTATION:
-                fw.writeQuaternion(keyframe.rotation)
-            # Keyframe scale
-            if mask & TRACK_SCALE:
-                fw.writeVector3(keyframe.scale)
+        # For each keyframe: time position in seconds, position, rotation (w, x, y, z)
+        # and scale
+        keyframes = track.keyframes
+        fields = [("time", "<f4", np.array([keyframe.time for keyframe in keyframes], dtype=np.float64))]
+        if mask & TRACK_POSITION:
+            positions = [keyframe.position[:] for keyframe in keyframes]
+            fields.append(("position", "<f4", np.array(positions, dtype=np.float64).reshape(-1, 3)))
+        if mask & TRACK_ROTATION:
+            rotations = [(k.rotation.w, k.rotation.x, k.rotation.y, k.rotation.z) for k in keyframes]
+            fields.append(("rotation", "<f4", np.array(rotations, dtype=np.float64).reshape(-1, 4)))
+        if mask & TRACK_SCALE:
+            scales = [keyframe.scale[:] for keyframe in keyframes]
+            fields.append(("scale", "<f4", np.array(scales, dtype=np.float64).reshape(-1, 3)))
+        fw.writeArray(InterleaveFields(len(keyframes), fields))
 
     fw.close()
 
@@ -775,21 +882,265 @@ def UrhoWriteTriggers(triggersList, filename, fOptions):
 # Utils
 #--------------------
 
+# Structured array of 'count' rows with the interleaved values of some fields, 'fields'
+# is a list of tuple(field name, type, array of values with 'count' rows)
+def InterleaveFields(count, fields):
+    data = np.zeros(count, dtype=[(name, fieldType, values.shape[1:]) for name, fieldType, values in fields])
+    for name, fieldType, values in fields:
+        data[name] = values
+    return data
+
+# Size in bytes of a vertex with the elements in the mask
+def VertexSize(elementMask):
+    return sum(size for element, size in ELEMENT_SIZES if elementMask & element)
+
 # Search for the most complete element mask
-def GetMaxElementMask(indices, vertices):
+def GetMaxElementMask(indices, masks):
     maxElementMask = 0
     maxElementMaskCount = 0
     for vertexIndex in indices:
-        tVertex = vertices[vertexIndex]
-        uVertex = UrhoVertex(tVertex)
-        count = bin(uVertex.mask).count("1")
+        mask = int(masks[vertexIndex])
+        count = bin(mask).count("1")
         if maxElementMaskCount < count:
             maxElementMaskCount = count
-            maxElementMask = uVertex.mask
+            maxElementMask = mask
     if maxElementMask:
         return maxElementMask
     return None
 
+#--------------------
+# Vertex buffer helpers
+#--------------------
+
+# Elements compared to merge vertices
+MERGE_ELEMENTS = ELEMENT_POSITION | ELEMENT_NORMAL | ELEMENT_COLOR | ELEMENT_UV1 | ELEMENT_UV2
+
+# Max number of different vertices with the same position to compare in bulk
+MAX_BULK_COMPARE = 32
+
+# Returns the Urho bones weights of some vertices of a store: the heavier BONES_PER_VERTEX
+# weights sorted by decreasing weight and normalized, missing weights are (0, 0.0)
+def UrhoWeights(vertices, rows):
+    bones = np.zeros((len(rows), BONES_PER_VERTEX), dtype=np.int32)
+    weights = np.zeros((len(rows), BONES_PER_VERTEX), dtype=np.float64)
+    if vertices.bones is None or not len(rows):
+        return bones, weights
+    vertexBones = vertices.bones[rows]
+    vertexWeights = vertices.weights[rows]
+    # Heavier weights by decreasing weight, unused slots go last
+    order = TopWeights(vertexBones, vertexWeights, BONES_PER_VERTEX)
+    slots = order.shape[1]
+    sortedBones = np.take_along_axis(vertexBones, order, axis=1)
+    sortedWeights = np.take_along_axis(vertexWeights, order, axis=1)
+    valid = sortedBones >= 0
+    sortedWeights[~valid] = 0.0
+    # Sum in order, like sum()
+    totalWeight = np.zeros(len(rows), dtype=np.float64)
+    for i in range(slots):
+        totalWeight += sortedWeights[:, i]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized = sortedWeights / totalWeight[:, None]
+    bones[:, :slots] = np.where(valid, sortedBones, 0)
+    # Vertices with only null weights keep them null
+    weights[:, :slots] = np.where(valid & (totalWeight[:, None] != 0.0), normalized, 0.0)
+    return bones, weights
+
+# Returns a boolean array, True where vertices 'a' and 'b' have elements almost equal
+# (same as AlmostEqual of two vertices). 'columns' and 'masks' are the vertices elements.
+def AlmostEqualRows(columns, masks, a, b):
+    equal = masks[a] == masks[b]
+    for name in ("pos", "normal", "uv", "uv2"):
+        column = columns[name]
+        if column is not None:
+            diff = np.abs(column[a].astype(np.float64) - column[b].astype(np.float64))
+            equal &= ~np.any(diff > EPSILON, axis=1)
+    if columns["color"] is not None:
+        equal &= np.all(columns["color"][a] == columns["color"][b], axis=1)
+    return equal
+
+# Vertex elements as lists, to compare vertices one at a time
+class VertexElements:
+    def __init__(self, columns, masks, rows):
+        self.mask = masks[rows].tolist()
+        self.values = []
+        for name in ("pos", "normal", "color", "uv", "uv2"):
+            column = columns[name]
+            self.values.append(column[rows].tolist() if column is not None else None)
+
+    def get(self, name, i):
+        element = VERTEX_COLUMNS[name][2]
+        if not (self.mask[i] & element):
+            return None
+        index = ("pos", "normal", "color", "uv", "uv2").index(name)
+        return self.values[index][i]
+
+    # Vertices i and j are almost equal if they have the same elements, almost equal
+    # position, normal and UVs and the same color
+    def almostEqual(self, i, j):
+        if self.mask[i] != self.mask[j]:
+            return False
+        for name in ("pos", "normal", "uv", "uv2"):
+            if not FloatListAlmostEqual(self.get(name, i), self.get(name, j)):
+                return False
+        return self.get("color", i) == self.get("color", j)
+
+    # Error of replacing vertex i with j in a LOD: infinite if the positions differ or the
+    # normals are more than 30° apart, else the UV error plus 1 - cosine of the normals
+    def lodError(self, i, j):
+        # If the position is not equal, return max error
+        if not FloatListAlmostEqual(self.get("pos", i), self.get("pos", j)):
+            return INFINITY
+        # If the angle between normals is above 30°, return max error (TODO: document this)
+        normal1 = self.get("normal", i)
+        normal2 = self.get("normal", j)
+        if normal1 is None or normal2 is None:
+            ncos = VectorDotProduct(normal1, normal2)
+        else:
+            ncos = float(Dot3(np.array(normal1, dtype=np.float32), np.array(normal2, dtype=np.float32)))
+        if ncos < cos(30 / 180 * pi):
+            return INFINITY
+        # UV are 0..1 x2, normals -1..1 x1, so this absolute error should be good
+        return (FloatListEqualError(self.get("uv", i), self.get("uv", j))  + 1-ncos)
+
+# Add to a vertex buffer the vertices 'rows' of a store. Like a linear search, each
+# vertex is merged with the first almost equal vertex in the buffer; if 'bestMatch'
+# is set (LODs after the first) with the vertex with the same position and the
+# smaller lodError. Returns the index in the buffer of each vertex and the mask of
+# the vertices added.
+def AddBufferVertices(vertexBuffer, tVertices, rows, bestMatch):
+    uVertices = vertexBuffer.vertices
+    oldCount = len(uVertices)
+    count = len(rows)
+    total = oldCount + count
+
+    # Elements of the vertices in the buffer followed by the vertices to add
+    masks = np.concatenate((uVertices.masks, tVertices.masks[rows])).astype(np.int64) & MERGE_ELEMENTS
+    columns = {}
+    for name in ("pos", "normal", "color", "uv", "uv2"):
+        uColumn = uVertices.column(name)
+        tColumn = tVertices.column(name)
+        if uColumn is None and tColumn is None:
+            columns[name] = None
+            continue
+        width, dtype, element = VERTEX_COLUMNS[name]
+        column = np.zeros((total, width), dtype=dtype)
+        if uColumn is not None:
+            column[:oldCount] = uColumn
+        if tColumn is not None:
+            column[oldCount:] = tColumn[rows]
+        column[(masks & element) == 0] = 0
+        columns[name] = column
+
+    # Only vertices with the same position can be merged
+    posGroups, unused = WeldVertices((columns["pos"],), (masks & ELEMENT_POSITION,))
+    # Equal vertices, 'target' is the first of them
+    keyGroups, keyFirst = WeldVertices((columns["pos"], columns["normal"], columns["uv"], columns["uv2"]),
+                                       (columns["color"], masks))
+    target = keyFirst[keyGroups]
+
+    # Groups with more different vertices must be checked one vertex at a time, if two
+    # of them are almost equal (or if we search the best match) the first vertex found
+    # is not always an equal one
+    groupsCount = int(posGroups.max()) + 1 if total else 0
+    checkGroups = np.zeros(groupsCount, dtype=bool)
+    if bestMatch:
+        checkGroups = np.bincount(posGroups, minlength=groupsCount) > 1
+    elif groupsCount < len(keyFirst):
+        # Different vertices sorted by position group
+        keyGroup = posGroups[keyFirst]
+        order = np.argsort(keyGroup, kind="stable")
+        sortedGroups = keyGroup[order]
+        sortedVertices = keyFirst[order]
+        keysPerGroup = np.bincount(keyGroup, minlength=groupsCount)
+        checkGroups |= keysPerGroup > MAX_BULK_COMPARE
+        for offset in range(1, min(int(keysPerGroup.max()), MAX_BULK_COMPARE + 1)):
+            a = np.arange(len(sortedGroups) - offset)
+            b = a + offset
+            pairs = sortedGroups[a] == sortedGroups[b]
+            a = a[pairs]
+            b = b[pairs]
+            equal = AlmostEqualRows(columns, masks, sortedVertices[a], sortedVertices[b])
+            checkGroups[sortedGroups[a[equal]]] = True
+
+    checkVertices = np.flatnonzero(checkGroups[posGroups])
+    if len(checkVertices):
+        elements = VertexElements(columns, masks, checkVertices)
+        # For each group, list of the vertices in the buffer (index in checkVertices)
+        groupsLists = defaultdict(list)
+        for i, (vertexIndex, group) in enumerate(zip(checkVertices.tolist(), posGroups[checkVertices].tolist())):
+            groupList = groupsLists[group]
+            if vertexIndex < oldCount:
+                groupList.append(i)
+                continue
+            found = None
+            if not bestMatch:
+                for j in groupList:
+                    if elements.almostEqual(j, i):
+                        found = j
+                        break
+            else:
+                bestLodError = INFINITY
+                for j in groupList:
+                    lodError = elements.lodError(j, i)
+                    if lodError < bestLodError:
+                        bestLodError = lodError
+                        found = j
+            if found is None:
+                target[vertexIndex] = vertexIndex
+                groupList.append(i)
+            else:
+                target[vertexIndex] = checkVertices[found]
+
+    # Number the new vertices and get the buffer index of each vertex
+    target = target[oldCount:]
+    isNew = target == np.arange(oldCount, total)
+    newIndices = oldCount + np.cumsum(isNew) - 1
+    uIndices = np.where(target < oldCount, target, newIndices[np.maximum(target - oldCount, 0)])
+
+    # Add the new vertices
+    newRows = rows[isNew]
+    start = uVertices.append(tVertices, newRows, weights=False)
+    weightsRows = np.flatnonzero(tVertices.masks[newRows] & ELEMENT_BLEND)
+    if len(weightsRows):
+        bones, weights = UrhoWeights(tVertices, newRows[weightsRows])
+        uVertices.setWeights(start + weightsRows, bones, weights)
+
+    return uIndices, isNew
+
+# Remap the bones of some vertices in a buffer to the geometry bone map, add the bones
+# over the limit to 'discardedBones'
+def RemapBones(boneMap, uVertices, vertexIndices, uBones, discardedBones):
+    if not len(vertexIndices):
+        return
+    bones = uVertices.bonesArray[vertexIndices]
+    weights = uVertices.weightsArray[vertexIndices]
+    remapped = uVertices.remappedArray[vertexIndices]
+    used = ~(weights < EPSILON)
+    # Bones in order of use: by vertex then by slot
+    usedBones = bones[used]
+    # New bones in order of first use, the ones that don't fit the map are discarded
+    newBones = usedBones[~np.isin(usedBones, boneMap)]
+    newBones, firstUse = np.unique(newBones, return_index=True)
+    newBones = newBones[np.argsort(firstUse)]
+    freeBones = max(MAX_SKIN_MATRICES - len(boneMap), 0)
+    boneMap.extend(newBones[:freeBones].tolist())
+    # Remapped local bone index of each used weight
+    lookup = np.full(max(int(usedBones.max(initial=0)), max(boneMap, default=0)) + 1, -1, dtype=np.int64)
+    lookup[boneMap] = np.arange(len(boneMap))
+    usedRemapped = lookup[usedBones]
+    discarded = usedRemapped < 0
+    if discarded.any():
+        usedWeights = weights[used]
+        for boneIndex, weight in zip(usedBones[discarded].tolist(), usedWeights[discarded].tolist()):
+            discardedBones[uBones[boneIndex].name] += weight
+        usedWeights[discarded] = 0.0
+        usedRemapped[discarded] = 0
+        weights[used] = usedWeights
+        uVertices.weightsArray[vertexIndices] = weights
+    # Save the remapped local bone index, do not replace the global bone index as
+    # we'll soon use it to compute the bone bounding box
+    remapped[used] = usedRemapped
+    uVertices.remappedArray[vertexIndices] = remapped
 
 #---------------------------------------
 
@@ -812,6 +1163,96 @@ def GetMaxElementMask(indices, vertices):
 # NOTE: if we use index() we must have __EQ__ in the class.
 # NOTE: don't use index(), it's slow.
 
+# Part of a geometry with the same material and LODs distances, its vertices can be
+# addressed with 16 bits indices (it has the fields of TGeometry and TLodLevel used here)
+class SplitGeometry:
+    def __init__(self, materialName):
+        self.materialName = materialName
+        self.lodLevels = []
+
+class SplitLodLevel:
+    def __init__(self, distance, triangleList, indexSet):
+        self.distance = distance
+        self.triangleList = triangleList
+        self.indexSet = indexSet
+
+# Split the geometries whose vertices (with all their LODs) need 32 bits indices in
+# spatial parts with less than 65536 vertices each. Returns the new geometries list.
+def SplitLargeGeometries(tGeometries, tVertices, modelName):
+    uGeometries = []
+    for geomIndex, tGeometry in enumerate(tGeometries):
+        lodsVertices = set()
+        for tLodLevel in tGeometry.lodLevels:
+            lodsVertices.update(tLodLevel.indexSet)
+        if len(lodsVertices) <= MAX_VERTICES_16BIT:
+            uGeometries.append(tGeometry)
+            continue
+
+        lods = [np.array(tLodLevel.triangleList, dtype=np.int64).reshape(-1, 3) for tLodLevel in tGeometry.lodLevels]
+        positions = tVertices.pos
+        if positions is not None and not all((tVertices.masks[triangles] & ELEMENT_POSITION).all() for triangles in lods):
+            positions = None
+        parts = SpatialSplit(lods, positions, MAX_VERTICES_16BIT)
+        log.info("Geometry{:d} of {:s} split in {:d} parts for 16 bits indices ({:d} vertices)"
+                 .format(geomIndex, modelName, len(parts), len(lodsVertices)))
+
+        for part in parts:
+            uGeometry = SplitGeometry(tGeometry.materialName)
+            for tLodLevel, triangles, rows in zip(tGeometry.lodLevels, lods, part):
+                partTriangles = triangles[rows]
+                # Vertices of the part in the same order of the LOD index set
+                partVertices = set(partTriangles.reshape(-1).tolist())
+                indexSet = set(i for i in tLodLevel.indexSet if i in partVertices)
+                triangleList = list(map(tuple, partTriangles.tolist()))
+                uGeometry.lodLevels.append(SplitLodLevel(tLodLevel.distance, triangleList, indexSet))
+            uGeometries.append(uGeometry)
+    return uGeometries
+
+# Remove from a track the channels which are constant within the errors and equal to the
+# bind pose of the bone (Urho resets the bones to their bind pose before applying the
+# animations). If the remaining channels are constant, keep only the first keyframe (a track
+# with one keyframe holds its values). Returns False if no channel is left.
+def PruneStaticChannels(uTrack, tBone, uExportOptions):
+    keyframes = uTrack.keyframes
+    mask = uTrack.elementMask
+    constantMask = 0
+    bindMask = 0
+
+    if mask & TRACK_POSITION:
+        positions = np.array([keyframe.position[:] for keyframe in keyframes], dtype=np.float64)
+        error = uExportOptions.prunePositionError
+        if np.linalg.norm(positions - positions[0], axis=1).max() <= error:
+            constantMask |= TRACK_POSITION
+            if tBone and np.linalg.norm(positions[0] - tBone.bindPosition[:]) <= error:
+                bindMask |= TRACK_POSITION
+
+    if mask & TRACK_ROTATION:
+        rotations = np.array([keyframe.rotation[:] for keyframe in keyframes], dtype=np.float64)
+        error = uExportOptions.pruneRotationError
+        # Angle between each rotation and the first one (q and -q are the same rotation)
+        dots = np.abs(rotations @ rotations[0])
+        if 2.0 * np.arccos(np.minimum(dots, 1.0)).max() <= error:
+            constantMask |= TRACK_ROTATION
+            if tBone:
+                dot = abs(np.dot(rotations[0], tBone.bindRotation[:]))
+                if 2.0 * np.arccos(min(dot, 1.0)) <= error:
+                    bindMask |= TRACK_ROTATION
+
+    if mask & TRACK_SCALE:
+        scales = np.array([keyframe.scale[:] for keyframe in keyframes], dtype=np.float64)
+        error = uExportOptions.pruneScaleError
+        if np.abs(scales - scales[0]).max() <= error:
+            constantMask |= TRACK_SCALE
+            if tBone and np.abs(scales[0] - tBone.bindScale[:]).max() <= error:
+                bindMask |= TRACK_SCALE
+
+    uTrack.elementMask = mask & ~bindMask
+    if not uTrack.elementMask:
+        return False
+    if not (uTrack.elementMask & ~constantMask):
+        del keyframes[1:]
+    return True
+
 #--------------------
 # Urho exporter
 #--------------------
@@ -853,11 +1294,17 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         uBone.derivedPosition = uBone.matrix.to_translation()
         uBone.length = bone.length
     
-    totalVertices = len(tData.verticesList) 
+    tVertices = tData.vertices
+    totalVertices = len(tVertices)
+
+    # Geometries too big for 16 bits indices are split in parts
+    tGeometries = tData.geometriesList
+    if uExportOptions.splitLargeGeometries:
+        tGeometries = SplitLargeGeometries(tGeometries, tVertices, uModel.name)
     
     # Search in geometries for the maximum number of vertices 
     maxLodVertices = 0
-    for tGeometry in tData.geometriesList:
+    for tGeometry in tGeometries:
         for tLodLevel in tGeometry.lodLevels:
             vertexCount = len(tLodLevel.indexSet)
             if vertexCount > maxLodVertices:
@@ -866,18 +1313,18 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
     # If one big buffer needs a 32 bits index but each geometry needs only a 16 bits
     # index then try to use a different buffer for each geometry
     useOneBuffer = True
-    if uExportOptions.splitSubMeshes or (totalVertices > 65535 and maxLodVertices <= 65535):
+    if uExportOptions.splitSubMeshes or (totalVertices > MAX_VERTICES_16BIT and maxLodVertices <= MAX_VERTICES_16BIT):
         useOneBuffer = False
 
     # Urho lod vertex buffer
     vertexBuffer = None
     # Urho lod index buffer
     indexBuffer = None
-    # Maps old vertex index to Urho vertex buffer index and Urho vertex index
-    modelIndexMap = {}
+    # For each Urho vertex buffer index, list of tuple(old vertex indices, Urho vertex indices)
+    lodIndexMaps = defaultdict(list)
     
     # For each geometry
-    for tGeometry in tData.geometriesList:
+    for tGeometry in tGeometries:
         
         uGeometry = UrhoGeometry()
         uModel.geometries.append(uGeometry)
@@ -886,9 +1333,6 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         # Material name (can be None)
         uGeometry.uMaterialName = tGeometry.materialName
         
-        # Start value for geometry center (one for each geometry)
-        center = Vector((0.0, 0.0, 0.0))
-        
         # Set of remapped vertices
         remappedVertices = set()
         
@@ -911,7 +1355,6 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
             if vertexBuffer is None or (lodIndex == 0 and not useOneBuffer):
                 vertexBuffer = UrhoVertexBuffer()
                 uModel.vertexBuffers.append(vertexBuffer)
-                uVerticesMap = {}
 
             # If needed add a new index buffer (only for first LOD of a geometry)
             if indexBuffer is None or (lodIndex == 0 and not useOneBuffer):
@@ -919,7 +1362,7 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
                 uModel.indexBuffers.append(indexBuffer)
                 uLodLevel.startIndex = 0
             else:
-                uLodLevel.startIndex = len(indexBuffer.indexes)    
+                uLodLevel.startIndex = indexBuffer.indexesCount
 
             # Set how many indices the LOD level will use
             uLodLevel.countIndex = len(tLodLevel.triangleList) * 3
@@ -930,115 +1373,99 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
             ##      .format(geomIndex, lodIndex, uLodLevel.vertexBuffer, len(tLodLevel.indexSet),
             ##      uLodLevel.indexBuffer, uLodLevel.countIndex))
             
-            # Maps old vertex index to new vertex index in the new Urho buffer
-            indexMap = {}
-            
-            # Errors helpers
-            warningNewVertices = False
-            
+            # Triangles of the LOD (indices of tVertices)
+            triangles = np.array(tLodLevel.triangleList, dtype=np.int64).reshape(-1, 3)
+
+            # Sort the clusters of triangles to reduce overdraw, the ACMR can get worse
+            # up to the threshold
+            if uExportOptions.optimizeOverdraw and len(triangles) > 1 and tVertices.pos is not None \
+                    and (tVertices.masks[triangles] & ELEMENT_POSITION).all():
+                cacheSize = uExportOptions.vertexCacheSize
+                oldOverdraw = OverdrawStatistics(triangles, tVertices.pos)
+                oldAcmr, unused = VertexCacheStatistics(triangles, cacheSize)
+                newTriangles = triangles[OptimizeOverdraw(triangles, tVertices.pos,
+                                                          uExportOptions.overdrawThreshold, cacheSize)]
+                newOverdraw = OverdrawStatistics(newTriangles, tVertices.pos)
+                newAcmr, unused = VertexCacheStatistics(newTriangles, cacheSize)
+                log.info("Overdraw of {:s} Geometry{:d} LOD{:d}: {:.3f} -> {:.3f}, ACMR {:.3f} -> {:.3f}"
+                         .format(uModel.name, geomIndex, lodIndex, oldOverdraw, newOverdraw, oldAcmr, newAcmr))
+                # The clusters order is only a guess, keep it if it really reduced overdraw
+                if newOverdraw < oldOverdraw:
+                    triangles = newTriangles
+
             # Try to guess the most complete element mask
             randomIndices = random.sample(sorted(tLodLevel.indexSet), min(30, len(tLodLevel.indexSet)) )
-            guessedElementMask = GetMaxElementMask(randomIndices, tData.verticesList)
+            guessedElementMask = GetMaxElementMask(randomIndices, tVertices.masks)
             if vertexBuffer.elementMask is None and guessedElementMask:
                 vertexBuffer.elementMask = guessedElementMask
-                
-            # Add vertices to the vertex buffer
-            for tVertexIndex in tLodLevel.indexSet:
-            
-                tVertex = tData.verticesList[tVertexIndex]
-
-                # Create a Urho vertex
-                uVertex = UrhoVertex(tVertex)
-                try:
-                    vertexBuffer.updateMask(uVertex.mask)
-                except VertexMaskError as e:
-                    if not tVertex.blenderIndex is None:
-                        errorsIndices = errorsMem.Get("element mask " + str(e), set() )
-                        errorsIndices.add(tVertex.blenderIndex)
-                    log.warning("Incompatible vertex elements in object {:s}, {!s}".format(uModel.name, e))
 
-                # All that this code do is "uVertexIndex = vertexBuffer.vertices.index(uVertex)", but we use
-                # a map to speed things up.
-            
-                # Get an hash of the vertex (more vertices can have the same hash)
-                uVertexHash = hash(uVertex)
-            
-                try:
-                    # Get the list of vertices indices with the same hash
-                    uVerticesMapList = uVerticesMap[uVertexHash]
-                except KeyError:
-                    # If the hash is not mapped, create a new list (we could use a set but a list is faster)
-                    uVerticesMapList = []
-                    uVerticesMap[uVertexHash] = uVerticesMapList
-                
-                uVertexIndex = None
-                if lodIndex == 0 or uExportOptions.useStrictLods:
-                    # For each index in the list, get the corresponding vertex and test if it is equal to tVertex.
-                    # If Position, Normal and UV are the same, it must be the same vertex, get its index.
-                    for ivl in uVerticesMapList:
-                        if vertexBuffer.vertices[ivl].AlmostEqual(uVertex):
-                            uVertexIndex = ivl
-                            break
-                else:
-                    # For successive LODs, we are more permissive, the vertex position must be the same, but for
-                    # the normal and UV we will search the best match in the vertices available.
-                    bestLodError = INFINITY
-                    for ivl in uVerticesMapList:
-                        lodError = vertexBuffer.vertices[ivl].LodError(uVertex)
-                        if lodError < bestLodError:
-                            bestLodError = lodError
-                            uVertexIndex = ivl
-
-                # If we cannot find it, the vertex is new, add it to the list, and its index to the map list
-                if uVertexIndex is None:
-                    uVertexIndex = len(vertexBuffer.vertices)
-                    vertexBuffer.vertices.append(uVertex)
-                    uVerticesMapList.append(uVertexIndex)
-                    if lodIndex != 0:
-                        warningNewVertices = True
-
-                # Populate the 'old tVertex index' to 'new uVertex index' map
-                if not tVertexIndex in indexMap:
-                    indexMap[tVertexIndex] = uVertexIndex
-                elif indexMap[tVertexIndex] != uVertexIndex:
-                    log.error("Conflict in vertex index map of object {:s}".format(uModel.name))
-
-                # Update the model bounding box (common to all geometries)
-                if vertexBuffer.elementMask & ELEMENT_POSITION:
-                    uModel.boundingBox.merge(uVertex.pos)
-
-            if warningNewVertices:
+            # Old indices of the vertices used by the LOD
+            lodIndices = np.fromiter(tLodLevel.indexSet, dtype=np.int64, count=len(tLodLevel.indexSet))
+
+            # New vertices are added to the buffer in order of first use by the triangles, so
+            # the GPU reads the vertex buffer almost sequentially
+            if uExportOptions.optimizeVertexFetch and len(triangles):
+                oldIndices = lodIndices
+                fetchOrder = VertexFetchOrder(triangles)
+                lodIndices = np.concatenate((fetchOrder, lodIndices[~np.isin(lodIndices, fetchOrder)]))
+
+            lodMasks = tVertices.masks[lodIndices]
+
+            # Check if the vertices are compatible with the vertex buffer
+            bufferMasks, maskErrors = vertexBuffer.updateMasks(lodMasks)
+            for i, e in maskErrors:
+                if tVertices.blenderIndex is not None:
+                    errorsIndices = errorsMem.Get("element mask " + str(e), set() )
+                    errorsIndices.add(tuple(tVertices.blenderIndex[lodIndices[i]].tolist()))
+                log.warning("Incompatible vertex elements in object {:s}, {!s}".format(uModel.name, e))
+
+            # Add the vertices to the vertex buffer, or find the ones already there. For the
+            # next LODs, we are more permissive, the vertex position must be the same, but
+            # for the normal and UV we will search the best match in the vertices available.
+            bestMatch = (lodIndex != 0 and not uExportOptions.useStrictLods)
+            uIndices, newVertices = AddBufferVertices(vertexBuffer, tVertices, lodIndices, bestMatch)
+
+            if lodIndex != 0 and newVertices.any():
                 log.warning("LOD {:d} of object {:s} Geometry{:d} has new vertices."
                             .format(lodIndex, uModel.name, geomIndex))
-                            
-            # Add the local vertex map to the global map
-            for oldIndex, newIndex in indexMap.items():
-                # We create a map: Map[old index] = Set( Tuple(new buffer index, new vertex index) )
-                # Search if this vertex index was already mapped, get its Set or add a new one.
-                # We need a Set because a vertex can be copied in more than one vertex buffer.
-                try:
-                    vbviSet = modelIndexMap[oldIndex]
-                except KeyError:
-                    vbviSet = set()
-                    modelIndexMap[oldIndex] = vbviSet
-                # Add a tuple to the Set: new buffer index, new vertex index
-                vbvi = (uLodLevel.vertexBuffer, newIndex)
-                vbviSet.add(vbvi)
-                
+
+            # Vertex fetch statistics, with the vertices of the LOD numbered in the old
+            # (index set) order and in the new order
+            if uExportOptions.optimizeVertexFetch and len(triangles):
+                vertexSize = VertexSize(vertexBuffer.elementMask or 0)
+                ranks = np.zeros(len(tVertices), dtype=np.int64)
+                ranks[oldIndices] = np.arange(len(oldIndices))
+                oldOverfetch = VertexFetchStatistics(ranks[triangles], vertexSize)
+                ranks[lodIndices] = np.arange(len(lodIndices))
+                newOverfetch = VertexFetchStatistics(ranks[triangles], vertexSize)
+                log.info("Vertex fetch of {:s} Geometry{:d} LOD{:d}: overfetch {:.3f} -> {:.3f}"
+                         .format(uModel.name, geomIndex, lodIndex, oldOverfetch, newOverfetch))
+
+            # Update the model bounding box (common to all geometries)
+            boundingRows = np.flatnonzero(bufferMasks & lodMasks & ELEMENT_POSITION)
+            if len(boundingRows):
+                uModel.boundingBox.mergeArray(tVertices.pos[lodIndices[boundingRows]])
+
+            # Add the local vertex map to the global map, a vertex can be copied in more
+            # than one vertex buffer
+            lodIndexMaps[uLodLevel.vertexBuffer].append((lodIndices, uIndices))
+
             # Add indices to the index buffer
-            centerCount = 0
-            for triangle in tLodLevel.triangleList:
-                for tVertexIndex in triangle:
-                    uVertexIndex = indexMap[tVertexIndex]
-                    indexBuffer.indexes.append(uVertexIndex)
-                    # Update geometry center (only for the first LOD)
-                    if (lodIndex == 0) and (vertexBuffer.elementMask & ELEMENT_POSITION):
-                        centerCount += 1
-                        center += vertexBuffer.vertices[uVertexIndex].pos;
-
-            # Update geometry center (only for the first LOD)
-            if lodIndex == 0 and centerCount:
-                uGeometry.center = center / centerCount;
+            indexes = np.zeros(0, dtype=np.int64)
+            if len(lodIndices):
+                firstIndex = int(lodIndices.min())
+                indexMap = np.full(int(lodIndices.max()) - firstIndex + 1, -1, dtype=np.int64)
+                indexMap[lodIndices - firstIndex] = uIndices
+                indexes = indexMap[triangles.reshape(-1) - firstIndex]
+            indexBuffer.append(indexes)
+
+            # Update geometry center (only for the first LOD), the positions are summed
+            # in order like adding Vectors
+            if lodIndex == 0 and len(indexes) and (vertexBuffer.elementMask & ELEMENT_POSITION):
+                positions = np.zeros((len(indexes) + 1, 3), dtype=np.float32)
+                positions[1:] = vertexBuffer.vertices.pos[indexes]
+                center = np.cumsum(positions, axis=0, dtype=np.float32)[-1]
+                uGeometry.center = Vector(center.tolist()) / len(indexes)
                         
             # If this geometry has bone weights but the number of total bones is over the limit 
             # then let's hope our geometry uses only a subset of the total bones within the limit.
@@ -1046,32 +1473,13 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
             # limit, to a local, in this geometry, bone index within the limit.
             if len(uModel.bones) > MAX_SKIN_MATRICES and (vertexBuffer.elementMask & ELEMENT_BLEND) == ELEMENT_BLEND:
                 discardedBones = defaultdict(float)
-                # For each vertex in the buffer
-                for uVertexIndex in indexMap.values():
-                    # Be sure to not pass a vertex again once its bones are remapped
-                    if uVertexIndex in remappedVertices:
-                        continue
-                    remappedVertices.add(uVertexIndex)
-                    vertex = vertexBuffer.vertices[uVertexIndex]
-                    for j, (weight, boneIndex, unusedBoneIndex) in enumerate(vertex.weights):
-                        if weight < EPSILON:
-                            continue
-                        # Search if the bone is already present in the map
-                        try:
-                            remappedBoneIndex = uGeometry.boneMap.index(boneIndex)
-                        except ValueError:
-                            # New bone, add it in the map
-                            remappedBoneIndex = len(uGeometry.boneMap)
-                            if remappedBoneIndex < MAX_SKIN_MATRICES:
-                                uGeometry.boneMap.append(boneIndex)
-                            else:
-                                boneName = uModel.bones[boneIndex].name
-                                discardedBones[boneName] += weight
-                                remappedBoneIndex = 0
-                                weight = 0.0
-                        # Save the remapped local bone index (tuple[2]), do not replace the global bone index (tuple[1]) as
-                        # we'll soon use it to compute the bone bounding box
-                        vertex.weights[j] = (weight, boneIndex, remappedBoneIndex)
+                # Vertices of the LOD in order, be sure to not pass a vertex again once its
+                # bones are remapped
+                unused, firstUse = np.unique(uIndices, return_index=True)
+                lodVertices = uIndices[np.sort(firstUse)]
+                lodVertices = lodVertices[~np.isin(lodVertices, list(remappedVertices))]
+                remappedVertices.update(lodVertices.tolist())
+                RemapBones(uGeometry.boneMap, vertexBuffer.vertices, lodVertices, uModel.bones, discardedBones)
                 bonesIn = len(uModel.bones)
                 bonesOut = len(uGeometry.boneMap)
                 bonesFree = MAX_SKIN_MATRICES - bonesOut
@@ -1091,9 +1499,9 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         uModel.boundingBox.max = Vector((0.0, 0.0, 0.0))
         log.warning("Vertices of object {:s} have no position.".format(uModel.name))
 
-    # Set index size for indexes buffers
+    # Set index size for indexes buffers, from the max vertex index
     for uIndexBuffer in uModel.indexBuffers:
-        if len(uIndexBuffer.indexes) > 65535:
+        if uIndexBuffer.indexesCount and int(uIndexBuffer.indexes.max()) > MAX_VERTICES_16BIT:
             # 32 bits indexes
             uIndexBuffer.indexSize = 4
         else:
@@ -1106,27 +1514,35 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         # Skip if the buffer doesn't have bone weights
         if (uVertexBuffer.elementMask & ELEMENT_BLEND) != ELEMENT_BLEND:
             continue
-        # For each vertex in the buffer
-        for uVertex in uVertexBuffer.vertices:
-            vertexPos = uVertex.pos
-            for weight, boneIndex, remappedBoneIndex in uVertex.weights:
-                # The 0.33 threshold check is to avoid including vertices in the bone hitbox 
-                # to which the bone contributes only a little. It is rather arbitrary. (Lasse)
-                if weight > 0.33:
-                    uBone = uModel.bones[boneIndex]
-                    # Bone head position (in model space)
-                    bonePos = uBone.derivedPosition
-                    # Distance between vertex and bone head
-                    distance = (bonePos - vertexPos).length
-                    # Search for the maximum distance
-                    if uBone.radius is None or distance > uBone.radius:
-                        uBone.collisionMask |= BONE_BOUNDING_SPHERE
-                        uBone.radius = distance
-                    # Calculate the vertex position in bone space
-                    boneVertexPos = uBone.inverseMatrix @ vertexPos
-                    # Update the bone boundingBox
-                    uBone.collisionMask |= BONE_BOUNDING_BOX
-                    uBone.boundingBox.merge(boneVertexPos)
+        uVertices = uVertexBuffer.vertices
+        if uVertices.pos is None or uVertices.bones is None:
+            continue
+        # The 0.33 threshold check is to avoid including vertices in the bone hitbox 
+        # to which the bone contributes only a little. It is rather arbitrary. (Lasse)
+        vertexRows, slots = np.nonzero(uVertices.weights > 0.33)
+        vertexBones = uVertices.bones[vertexRows, slots]
+        # Group the vertices by bone, keeping their order
+        order = np.argsort(vertexBones, kind="stable")
+        vertexBones = vertexBones[order]
+        vertexRows = vertexRows[order]
+        bonesList, bonesStart = np.unique(vertexBones, return_index=True)
+        bonesEnd = np.append(bonesStart[1:], len(vertexBones))
+        for boneIndex, start, end in zip(bonesList.tolist(), bonesStart.tolist(), bonesEnd.tolist()):
+            uBone = uModel.bones[boneIndex]
+            vertexPos = uVertices.pos[vertexRows[start:end]]
+            # Bone head position (in model space)
+            bonePos = np.array(uBone.derivedPosition, dtype=np.float32)
+            # Distance between vertex and bone head, search for the maximum distance
+            offsets = bonePos - vertexPos
+            distance = float(np.sqrt(Dot3(offsets, offsets).astype(np.float64)).max())
+            if uBone.radius is None or distance > uBone.radius:
+                uBone.collisionMask |= BONE_BOUNDING_SPHERE
+                uBone.radius = distance
+            # Calculate the vertex position in bone space
+            boneVertexPos = TransformPoints(uBone.inverseMatrix, vertexPos)
+            # Update the bone boundingBox
+            uBone.collisionMask |= BONE_BOUNDING_BOX
+            uBone.boundingBox.mergeArray(boneVertexPos)
 
     # Do not allow bones bounding box to grow beyond head and tail
     if uExportOptions.clampBoundingBox:
@@ -1136,77 +1552,83 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
                 bone.boundingBox.max.y = bone.length
             bone.radius = bone.length
 
+    # Maps old vertex indices to Urho vertex indices in each vertex buffer, a vertex
+    # can have more than one index in the same buffer (only with not strict LODs):
+    # buffer index to tuple(old indices, Urho indices), sorted by old index
+    modelIndexMap = {}
+    for uVertexBufferIndex, indexMaps in lodIndexMaps.items():
+        pairs = np.stack((np.concatenate([m[0] for m in indexMaps]), np.concatenate([m[1] for m in indexMaps])), axis=1)
+        pairs = np.unique(pairs, axis=0)
+        modelIndexMap[uVertexBufferIndex] = (pairs[:, 0], pairs[:, 1])
+
     for tMorph in tData.morphsList:
         uMorph = UrhoVertexMorph()
         uMorph.name = tMorph.name
         uModel.morphs.append(uMorph)
 
+        tMorphVertices = tMorph.vertices
+        morphMasks = tMorphVertices.masks
+        
         # Get 90 random vertices hoping to get some in all the vertex buffers
-        guessingIndices = defaultdict(list)
-        indicesAll = tMorph.vertexMap.keys()
-        randomIndicesAll = random.sample(indicesAll, min(90, len(indicesAll)) )
-        randomVertices = []
-        for tVertexIndex in randomIndicesAll:
-            # Get the correspondent Urho vertex buffer and vertex index (there can be more than one)
-            vbviSet = modelIndexMap[tVertexIndex]
-            # For each corresponding vertex buffer
-            for uVertexBufferIndex, uVertexIndex in vbviSet:
-                guessingIndices[uVertexBufferIndex].append(len(randomVertices))
-                randomVertices.append(tMorph.vertexMap[tVertexIndex])
-                
-        # Try to guess the most complete element mask for each vertex buffer
-        guessedElementMasks = {}
-        for bufferIndex, randomIndices in guessingIndices.items():
-            elementMask = GetMaxElementMask(randomIndices, randomVertices)
-            if elementMask:
-                guessedElementMasks[bufferIndex] = elementMask
-                        
-        # For each vertex affected by the morph
-        for tVertexIndex, tMorphVertex in tMorph.vertexMap.items():
-            # Get the correspondent Urho vertex buffer and vertex index (there can be more than one)
-            vbviSet = modelIndexMap[tVertexIndex]
-            # For each corresponding vertex buffer
-            for uVertexBufferIndex, uVertexIndex in vbviSet:
-                # Search for the vertex buffer in the morph, if not present add it
-                try:
-                    uMorphVertexBuffer = uMorph.vertexBufferMap[uVertexBufferIndex]
-                except KeyError:
-                    uMorphVertexBuffer = UrhoVertexBuffer()
-                    uMorph.vertexBufferMap[uVertexBufferIndex] = uMorphVertexBuffer
-                
-                if uMorphVertexBuffer.elementMask is None and uVertexBufferIndex in guessedElementMasks:
-                    uMorphVertexBuffer.elementMask = guessedElementMasks[uVertexBufferIndex]
-                    
-                # Create the morphed vertex
-                uMorphVertex = UrhoVertex(tMorphVertex)
-                try:
-                    uMorphVertexBuffer.updateMask(uMorphVertex.mask)
-                except VertexMaskError as e:
-                    if not tVertex.blenderIndex is None:
-                        errorsMorphIndices = errorsMem.Get("morph element mask " + str(e), set() )
-                        errorsMorphIndices.add(tMorphVertex.blenderIndex)
-                    log.warning("Incompatible vertex elements in morph {:s} of object {:s}, {!s}"
-                                .format(uMorph.name, uModel.name, e))
-
-                # Get the original vertex
-                uVertexBuffer = uModel.vertexBuffers[uVertexBufferIndex]
-                uVertex = uVertexBuffer.vertices[uVertexIndex]
-                
-                # Calculate morph values (pos, normal, tangent) relative to the original vertex
-                uMorphVertex.subtract(uVertex, uMorphVertexBuffer.elementMask)
-                    
-                # Add the vertex to the morph buffer
-                uMorphVertex.index = uVertexIndex
-                uMorphVertexBuffer.vertices.append(uMorphVertex)
-
-                # Update min and max morphed vertex index in the vertex buffer
-                if uVertexBuffer.morphMinIndex is None:
-                    uVertexBuffer.morphMinIndex = uVertexIndex
-                    uVertexBuffer.morphMaxIndex = uVertexIndex
-                elif uVertexIndex < uVertexBuffer.morphMinIndex:
-                    uVertexBuffer.morphMinIndex = uVertexIndex
-                elif uVertexIndex > uVertexBuffer.morphMaxIndex:
-                    uVertexBuffer.morphMaxIndex = uVertexIndex
+        randomPositions = random.sample(range(len(tMorph.indices)), min(90, len(tMorph.indices)) )
+
+        # For each vertex buffer with vertices affected by the morph
+        for uVertexBufferIndex, (oldIndices, newIndices) in sorted(modelIndexMap.items()):
+            # Get the correspondent Urho vertex indices of each morphed vertex (there can be more than one)
+            left = np.searchsorted(oldIndices, tMorph.indices, side="left")
+            counts = np.searchsorted(oldIndices, tMorph.indices, side="right") - left
+            if not counts.any():
+                continue
+            morphRows = np.repeat(np.arange(len(tMorph.indices)), counts)
+            offsets = np.arange(len(morphRows)) - np.repeat(np.cumsum(counts) - counts, counts)
+            uVertexIndices = newIndices[np.repeat(left, counts) + offsets]
+
+            uMorphVertexBuffer = UrhoVertexBuffer()
+            uMorph.vertexBufferMap[uVertexBufferIndex] = uMorphVertexBuffer
+
+            # Try to guess the most complete element mask
+            randomIndices = [i for i in randomPositions if counts[i]]
+            uMorphVertexBuffer.elementMask = GetMaxElementMask(randomIndices, morphMasks)
+
+            # Check if the morphed vertices are compatible with the buffer
+            bufferMasks, maskErrors = uMorphVertexBuffer.updateMasks(morphMasks[morphRows])
+            for i, e in maskErrors:
+                if tMorphVertices.blenderIndex is not None:
+                    errorsMorphIndices = errorsMem.Get("morph element mask " + str(e), set() )
+                    errorsMorphIndices.add(tuple(tMorphVertices.blenderIndex[morphRows[i]].tolist()))
+                log.warning("Incompatible vertex elements in morph {:s} of object {:s}, {!s}"
+                            .format(uMorph.name, uModel.name, e))
+
+            # Add the morphed vertices to the morph buffer
+            uMorphVertices = uMorphVertexBuffer.vertices
+            uMorphVertices.append(tMorphVertices, morphRows, names=("pos", "normal", "tangent"), weights=False)
+            uMorphVertices.set("index", 0, uVertexIndices)
+
+            # Calculate morph values (pos, normal, tangent) relative to the original vertex
+            # (see AnimatedModel::ApplyMorph), with the buffer mask when the vertex was added
+            uVertexBuffer = uModel.vertexBuffers[uVertexBufferIndex]
+            uVertices = uVertexBuffer.vertices
+            for name, element in (("pos", ELEMENT_POSITION), ("normal", ELEMENT_NORMAL), ("tangent", ELEMENT_TANGENT)):
+                morphColumn = uMorphVertices.column(name)
+                column = uVertices.column(name)
+                if morphColumn is None or column is None:
+                    continue
+                subtractRows = np.flatnonzero(bufferMasks & element)
+                morphColumn[subtractRows] -= column[uVertexIndices[subtractRows]]
+                # tangent.w it is not modified by morphs (remember, there we
+                # have saved bitangent direction)
+                if name == "tangent":
+                    morphColumn[subtractRows, 3] = 0.0
+
+            # Update min and max morphed vertex index in the vertex buffer
+            minIndex = int(uVertexIndices.min())
+            maxIndex = int(uVertexIndices.max())
+            if uVertexBuffer.morphMinIndex is None:
+                uVertexBuffer.morphMinIndex = minIndex
+                uVertexBuffer.morphMaxIndex = maxIndex
+            else:
+                uVertexBuffer.morphMinIndex = min(uVertexBuffer.morphMinIndex, minIndex)
+                uVertexBuffer.morphMaxIndex = max(uVertexBuffer.morphMaxIndex, maxIndex)
 
     # Set to zero min and max morphed vertex index of buffers with no morphs
     for i, uVertexBuffer in enumerate(uModel.vertexBuffers):
@@ -1220,6 +1642,9 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
         uAnimation = UrhoAnimation()
         uAnimation.name = tAnimation.name
         uAnimation.length = None
+        prunedChannels = 0
+        prunedTracks = 0
+        prunedKeyframes = 0
         
         for tTrack in tAnimation.tracks:
             uTrack = UrhoTrack()
@@ -1239,11 +1664,25 @@ def UrhoExport(tData, uExportOptions, uExportData, errorsMem):
 
             # Add only tracks with keyframes
             if uTrack.keyframes and uTrack.elementMask:
-                uAnimation.tracks.append(uTrack)
                 # Update animation length
                 length = uTrack.keyframes[-1].time
                 if uAnimation.length is None or uAnimation.length < length:
                     uAnimation.length = length
+                # Remove the constant channels, and the track if the bone does not move
+                if uExportOptions.pruneStaticChannels:
+                    channels = bin(uTrack.elementMask).count("1")
+                    keyframes = len(uTrack.keyframes)
+                    kept = PruneStaticChannels(uTrack, tData.bonesMap.get(uTrack.name), uExportOptions)
+                    prunedChannels += channels - bin(uTrack.elementMask).count("1")
+                    prunedKeyframes += keyframes - len(uTrack.keyframes)
+                    if not kept:
+                        prunedTracks += 1
+                        continue
+                uAnimation.tracks.append(uTrack)
+
+        if prunedChannels or prunedKeyframes:
+            log.info("Animation {:s}: {:d} static channels and {:d} tracks removed, {:d} keyframes of constant tracks removed"
+                     .format(uAnimation.name, prunedChannels, prunedTracks, prunedKeyframes))
 
         # Add the triggers for the animation
         for tTrigger in tAnimation.triggers:
@@ -0,0 +1,159 @@
+#
+# This script is licensed as public domain.
+#
+
+# On disk cache of the decomposed meshes (results of ProcessMeshJob).
+# An entry is a folder named with the hash of the job: its options, its arrays and the
+# code of meshops.py. The result arrays are saved as .npy files and loaded memory
+# mapped, the rest of the result in a JSON file. When the cache is bigger than its
+# limit the least recently used entries are deleted.
+
+import os
+import shutil
+import hashlib
+import json
+import logging
+import numpy as np
+
+log = logging.getLogger("ExportLogger")
+
+# Folder of the cache, in the export output path
+CACHE_FOLDER = ".urho_cache"
+# Change this when the format of the entries changes
+CACHE_VERSION = 1
+# File with the result structure, its time is the last use of the entry
+RESULT_FILE = "result.json"
+
+# Hash of the code that computes the results, so entries made by a different
+# version of the add-on are not used
+codeHash = None
+
+def CodeHash():
+    global codeHash
+    if codeHash is None:
+        from . import meshops
+        with open(meshops.__file__, "rb") as file:
+            codeHash = hashlib.sha1(file.read()).hexdigest()
+    return codeHash
+
+# Convert a result to JSON values, the arrays are moved in 'arrays' and replaced with
+# their index
+def ToJson(value, arrays):
+    if isinstance(value, np.ndarray):
+        arrays.append(value)
+        return {"array": len(arrays) - 1}
+    if isinstance(value, dict):
+        return {"dict": [[key, ToJson(item, arrays)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return {"tuple" if isinstance(value, tuple) else "list": [ToJson(item, arrays) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {"set": [ToJson(item, arrays) for item in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def FromJson(value, arrays):
+    if not isinstance(value, dict):
+        return value
+    if "array" in value:
+        return arrays[value["array"]]
+    if "dict" in value:
+        return {key: FromJson(item, arrays) for key, item in value["dict"]}
+    if "list" in value:
+        return [FromJson(item, arrays) for item in value["list"]]
+    if "tuple" in value:
+        return tuple(FromJson(item, arrays) for item in value["tuple"])
+    return set(FromJson(item, arrays) for item in value["set"])
+
+class MeshCache:
+    def __init__(self, path, maxSize):
+        # Folder of the cache
+        self.path = path
+        # Max size in bytes of all the entries
+        self.maxSize = maxSize
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    # Key of a job: hash of its options and arrays
+    def Key(self, job):
+        digest = hashlib.sha1()
+        options = {name: value for name, value in job.items() if name != "arrays"}
+        digest.update(json.dumps([CACHE_VERSION, CodeHash(), options], sort_keys=True).encode())
+        for name, array in sorted(job["arrays"].items()):
+            array = np.ascontiguousarray(array)
+            digest.update("{:s} {:s} {!s}".format(name, array.dtype.str, array.shape).encode())
+            digest.update(memoryview(array).cast("B"))
+        return digest.hexdigest()
+
+    # Load the result of a job, None if not in the cache
+    def Load(self, key):
+        entryPath = os.path.join(self.path, key)
+        resultPath = os.path.join(entryPath, RESULT_FILE)
+        try:
+            with open(resultPath, "r") as file:
+                data = json.load(file)
+            arrays = [np.load(os.path.join(entryPath, "{:d}.npy".format(i)), mmap_mode="r")
+                      for i in range(data["arrays"])]
+            result = FromJson(data["result"], arrays)
+            # Mark the entry as recently used
+            os.utime(resultPath)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError) as ex:
+            log.warning("Cannot read cache entry {:s}: {!s}".format(key, ex))
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    # Save the result of a job, the entry is written in a temporary folder and then renamed
+    def Save(self, key, result):
+        entryPath = os.path.join(self.path, key)
+        tempPath = "{:s}.{:d}.tmp".format(entryPath, os.getpid())
+        arrays = []
+        data = {"result": ToJson(result, arrays), "arrays": len(arrays)}
+        try:
+            os.makedirs(tempPath, exist_ok=True)
+            for i, array in enumerate(arrays):
+                np.save(os.path.join(tempPath, "{:d}.npy".format(i)), array, allow_pickle=False)
+            with open(os.path.join(tempPath, RESULT_FILE), "w") as file:
+                json.dump(data, file)
+            if os.path.isdir(entryPath):
+                shutil.rmtree(tempPath, ignore_errors=True)
+            else:
+                os.replace(tempPath, entryPath)
+        except (OSError, TypeError, ValueError) as ex:
+            log.warning("Cannot save cache entry {:s}: {!s}".format(key, ex))
+            shutil.rmtree(tempPath, ignore_errors=True)
+
+    # Delete the least recently used entries until the cache size is below its limit
+    def Evict(self):
+        if not os.path.isdir(self.path):
+            return
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.path):
+            entryPath = os.path.join(self.path, name)
+            if not os.path.isdir(entryPath):
+                continue
+            try:
+                lastUse = os.path.getmtime(os.path.join(entryPath, RESULT_FILE))
+                size = sum(os.path.getsize(os.path.join(entryPath, fileName)) for fileName in os.listdir(entryPath))
+            except OSError:
+                # Incomplete entry, left by an interrupted export
+                lastUse = 0.0
+                size = 0
+            entries.append((lastUse, size, entryPath))
+            totalSize += size
+        entries.sort()
+        evicted = 0
+        for lastUse, size, entryPath in entries:
+            if totalSize <= self.maxSize:
+                break
+            shutil.rmtree(entryPath, ignore_errors=True)
+            totalSize -= size
+            evicted += 1
+        if evicted:
+            log.info("Mesh cache: {:d} entries evicted, {:.1f} MB used".format(evicted, totalSize / 1048576.0))
@@ -0,0 +1,1341 @@
+#
+# This script is licensed as public domain.
+#
+
+# Mesh processing on NumPy arrays.
+# This module must not import bpy or mathutils: it is also used outside Blender.
+
+import numpy as np
+import heapq
+import importlib
+import logging
+try:
+    # Python 3.8 (Blender 2.83 has 3.7)
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+log = logging.getLogger("ExportLogger")
+
+#--------------------
+# Vertex welding
+#--------------------
+
+# Pack a (rows x n) array of floats in rows of bytes. If tolerance is not zero the
+# values are quantized on a grid of that step, so nearly identical values become equal.
+def PackFloatColumn(column, tolerance):
+    column = column.reshape(len(column), -1)
+    if tolerance > 0.0:
+        return np.rint(column.astype(np.float64) / tolerance).astype(np.int64).view(np.uint8)
+    # +0.0 converts -0.0 to 0.0, they are the same value
+    return np.ascontiguousarray(column + column.dtype.type(0.0)).view(np.uint8)
+
+# Pack a (rows x n) array of integers in rows of bytes
+def PackIntColumn(column):
+    column = column.reshape(len(column), -1)
+    return np.ascontiguousarray(column.astype(np.int32)).view(np.uint8)
+
+# Find the unique rows of the given columns (arrays with the same number of rows,
+# None columns are skipped). Float columns can be merged with a tolerance, integer
+# columns must be equal.
+# Returns:
+# - remap: for each row, the index of its unique row,
+# - firstRows: for each unique row, the index of its first occurrence.
+# Unique rows are numbered in order of first occurrence.
+def WeldVertices(floatColumns, intColumns=(), tolerance=0.0):
+
+    packed = [PackFloatColumn(c, tolerance) for c in floatColumns if c is not None]
+    packed += [PackIntColumn(c) for c in intColumns if c is not None]
+    if not packed:
+        return None, None
+    rowsCount = len(packed[0])
+    if rowsCount == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # One fixed width key for each row
+    keys = np.ascontiguousarray(np.concatenate(packed, axis=1))
+    keys = keys.view(np.dtype((np.void, keys.shape[1]))).reshape(-1)
+
+    # Sort and find equal keys, 'first' is the first occurrence of each unique key
+    unused, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # Renumber the unique keys in order of first occurrence
+    order = np.argsort(first, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    return rank[inverse.reshape(-1)], first[order]
+
+#--------------------
+# Vertex store
+#--------------------
+
+# Vertex elements, these are the same bits of the Urho vertex element mask
+ELEMENT_POSITION    = 0x0001
+ELEMENT_NORMAL      = 0x0002
+ELEMENT_COLOR       = 0x0004
+ELEMENT_UV1         = 0x0008
+ELEMENT_UV2         = 0x0010
+ELEMENT_TANGENT     = 0x0080
+ELEMENT_BLEND       = 0x0300
+
+# Store columns: name to (width, type, element bit). Columns with a zero element bit
+# have no presence flag, they are present if allocated.
+VERTEX_COLUMNS = {
+    # Position of the vertex
+    "pos":          (3, np.float32, ELEMENT_POSITION),
+    # Normal of the vertex
+    "normal":       (3, np.float32, ELEMENT_NORMAL),
+    # Color of the vertex 0..255
+    "color":        (4, np.uint8,   ELEMENT_COLOR),
+    # UV coordinates of the vertex
+    "uv":           (2, np.float32, ELEMENT_UV1),
+    # UV2 coordinates of the vertex
+    "uv2":          (2, np.float32, ELEMENT_UV2),
+    # Tangent of the vertex, w is the bitangent direction
+    "tangent":      (4, np.float32, ELEMENT_TANGENT),
+    # Bitangent of the vertex
+    "bitangent":    (3, np.float32, 0),
+    # Index of the vertex in the Blender buffer: (mesh index, vertex index)
+    "blenderIndex": (2, np.int64,   0),
+    # Only used by morphs, original vertex index in the not morphed vertex buffer
+    "index":        (1, np.int64,   0),
+}
+
+# Vertices stored as columns of arrays (struct of arrays). Each vertex has a mask
+# of the elements it has, an element missing in a vertex is zero in its column.
+# Bones weights are stored in a (vertices x slots) matrix of bone indices and one
+# of weights, unused slots have bone index -1.
+class VertexStore:
+    def __init__(self):
+        # Number of vertices
+        self.count = 0
+        # Allocated rows
+        self.capacity = 0
+        # Mask of the elements present in each vertex (capacity)
+        self.maskArray = np.zeros(0, dtype=np.uint16)
+        # Allocated columns: name to (capacity x width) array
+        self.columns = {}
+        # Bones weights (capacity x slots): bone index, weight, bone index remapped
+        # to the geometry bones (-1 if not remapped)
+        self.bonesArray = None
+        self.weightsArray = None
+        self.remappedArray = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("vertex index out of range")
+        return VertexView(self, index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield VertexView(self, index)
+
+    # Masks of all the vertices
+    @property
+    def masks(self):
+        return self.maskArray[:self.count]
+
+    # Return a column of all the vertices, None if the column was never set
+    def column(self, name):
+        array = self.columns.get(name)
+        if array is None:
+            return None
+        return array[:self.count]
+
+    pos = property(lambda self: self.column("pos"))
+    normal = property(lambda self: self.column("normal"))
+    color = property(lambda self: self.column("color"))
+    uv = property(lambda self: self.column("uv"))
+    uv2 = property(lambda self: self.column("uv2"))
+    tangent = property(lambda self: self.column("tangent"))
+    bitangent = property(lambda self: self.column("bitangent"))
+    blenderIndex = property(lambda self: self.column("blenderIndex"))
+    index = property(lambda self: self.column("index"))
+
+    @property
+    def bones(self):
+        if self.bonesArray is None:
+            return None
+        return self.bonesArray[:self.count]
+
+    @property
+    def weights(self):
+        if self.weightsArray is None:
+            return None
+        return self.weightsArray[:self.count]
+
+    @property
+    def remapped(self):
+        if self.remappedArray is None:
+            return None
+        return self.remappedArray[:self.count]
+
+    # Number of bones weights slots
+    @property
+    def weightsSlots(self):
+        if self.bonesArray is None:
+            return 0
+        return self.bonesArray.shape[1]
+
+    # Resize all the arrays to a new capacity
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        # Grow geometrically to keep appends linear
+        capacity = max(capacity, 2 * self.capacity, 16)
+        def Resize(array, fill):
+            newArray = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            newArray[:self.count] = array[:self.count]
+            return newArray
+        self.maskArray = Resize(self.maskArray, 0)
+        for name, array in self.columns.items():
+            self.columns[name] = Resize(array, 0)
+        if self.bonesArray is not None:
+            self.bonesArray = Resize(self.bonesArray, -1)
+            self.weightsArray = Resize(self.weightsArray, 0.0)
+            self.remappedArray = Resize(self.remappedArray, -1)
+        self.capacity = capacity
+
+    # Add 'count' empty vertices (no elements), returns the index of the first one
+    def add(self, count):
+        start = self.count
+        self.reserve(start + count)
+        self.count += count
+        return start
+
+    # Allocate a column if missing
+    def allocate(self, name):
+        array = self.columns.get(name)
+        if array is None:
+            width, dtype, unused = VERTEX_COLUMNS[name]
+            array = np.zeros((self.capacity, width), dtype=dtype)
+            self.columns[name] = array
+        return array
+
+    # Set a column for some vertices and mark the element as present. 'rows' can be the
+    # index of the first vertex or an array of vertex indices.
+    def set(self, name, rows, values):
+        array = self.allocate(name)
+        values = np.asarray(values)
+        if np.isscalar(rows) or isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + len(values))
+        array[:self.count][rows] = values.reshape(len(values), -1)
+        element = VERTEX_COLUMNS[name][2]
+        if element:
+            self.maskArray[:self.count][rows] |= element
+
+    # Mark an element as not present for some vertices (and zero it)
+    def clear(self, name, rows):
+        array = self.columns.get(name)
+        if array is not None:
+            array[:self.count][rows] = 0
+        element = VERTEX_COLUMNS[name][2]
+        if element:
+            self.maskArray[:self.count][rows] &= ~np.uint16(element)
+
+    # Allocate or widen the bones weights matrices
+    def allocateWeights(self, slots):
+        if self.bonesArray is not None and self.bonesArray.shape[1] >= slots:
+            return
+        oldSlots = self.weightsSlots
+        bones = np.full((self.capacity, slots), -1, dtype=np.int32)
+        weights = np.zeros((self.capacity, slots), dtype=np.float64)
+        remapped = np.full((self.capacity, slots), -1, dtype=np.int32)
+        if oldSlots:
+            bones[:, :oldSlots] = self.bonesArray
+            weights[:, :oldSlots] = self.weightsArray
+            remapped[:, :oldSlots] = self.remappedArray
+        self.bonesArray = bones
+        self.weightsArray = weights
+        self.remappedArray = remapped
+
+    # Set the bones weights of some vertices (vertices x slots arrays, bone -1 for unused
+    # slots) and mark them as present
+    def setWeights(self, rows, bones, weights, remapped=None):
+        bones = np.asarray(bones)
+        slots = bones.shape[1]
+        self.allocateWeights(slots)
+        if np.isscalar(rows) or isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + len(bones))
+        self.bonesArray[:self.count][rows] = -1
+        self.weightsArray[:self.count][rows] = 0.0
+        self.remappedArray[:self.count][rows] = -1
+        self.bonesArray[:self.count, :slots][rows] = bones
+        self.weightsArray[:self.count, :slots][rows] = weights
+        if remapped is not None:
+            self.remappedArray[:self.count, :slots][rows] = remapped
+        self.maskArray[:self.count][rows] |= ELEMENT_BLEND
+
+    # Append vertices of another store (all or only 'rows'), returns the index of the
+    # first new vertex. 'names' limits the columns copied, weights are copied only
+    # if 'weights' is True.
+    def append(self, other, rows=None, names=None, weights=True):
+        if rows is None:
+            rows = np.arange(len(other))
+        count = len(rows)
+        start = self.add(count)
+        copiedMask = 0
+        for name, array in other.columns.items():
+            if names is not None and name not in names:
+                continue
+            self.allocate(name)[start:start + count] = array[:other.count][rows]
+            copiedMask |= VERTEX_COLUMNS[name][2]
+        if weights and other.bonesArray is not None:
+            self.allocateWeights(other.weightsSlots)
+            slots = other.weightsSlots
+            self.bonesArray[start:start + count, :slots] = other.bones[rows]
+            self.weightsArray[start:start + count, :slots] = other.weights[rows]
+            self.remappedArray[start:start + count, :slots] = other.remapped[rows]
+            copiedMask |= ELEMENT_BLEND
+        self.maskArray[start:start + count] = other.masks[rows] & copiedMask
+        return start
+
+# Lightweight view of one vertex of a VertexStore, elements are returned as
+# rows of the store arrays (None if the vertex doesn't have them)
+class VertexView:
+    __slots__ = ("store", "i")
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    @property
+    def mask(self):
+        return int(self.store.maskArray[self.i])
+
+    def element(self, name):
+        array = self.store.columns.get(name)
+        if array is None:
+            return None
+        element = VERTEX_COLUMNS[name][2]
+        if element and not (self.store.maskArray[self.i] & element):
+            return None
+        return array[self.i]
+
+    pos = property(lambda self: self.element("pos"))
+    normal = property(lambda self: self.element("normal"))
+    color = property(lambda self: self.element("color"))
+    uv = property(lambda self: self.element("uv"))
+    uv2 = property(lambda self: self.element("uv2"))
+    tangent = property(lambda self: self.element("tangent"))
+    bitangent = property(lambda self: self.element("bitangent"))
+
+    @property
+    def blenderIndex(self):
+        value = self.element("blenderIndex")
+        if value is None:
+            return None
+        return tuple(value.tolist())
+
+    @property
+    def index(self):
+        value = self.element("index")
+        if value is None:
+            return None
+        return int(value[0])
+
+    # List of tuple(boneIndex, weight), None if the vertex has no weights
+    @property
+    def weights(self):
+        store = self.store
+        if store.bonesArray is None or not (store.maskArray[self.i] & ELEMENT_BLEND):
+            return None
+        bones = store.bonesArray[self.i]
+        weights = store.weightsArray[self.i]
+        return [(int(b), float(w)) for b, w in zip(bones, weights) if b >= 0]
+
+#--------------------
+# Vector math
+#--------------------
+
+# These functions work on arrays of 3D vectors (... x 3) of float32 and round the
+# results exactly like mathutils does: single precision products, summed in double
+# precision starting from zero and then rounded to single precision.
+
+# Dot product (same as Vector.dot)
+def Dot3(a, b):
+    d = np.zeros(np.broadcast(a[..., 0], b[..., 0]).shape, dtype=np.float64)
+    # mathutils sums from the last component
+    for i in (2, 1, 0):
+        d += a[..., i] * b[..., i]
+    return d.astype(np.float32)
+
+# Cross product (same as Vector.cross)
+def Cross3(a, b):
+    r = np.empty(np.broadcast(a, b).shape, dtype=np.float32)
+    r[..., 0] = a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1]
+    r[..., 1] = a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2]
+    r[..., 2] = a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+    return r
+
+# Unit vectors (same as Vector.normalized), null vectors become zero
+def Normalize3(a):
+    d = Dot3(a, a).astype(np.float64)
+    valid = d > 1.0e-35
+    length = np.sqrt(np.where(valid, d, 1.0)).astype(np.float32)
+    inverse = np.float32(1.0) / length
+    return np.where(valid[..., None], a * inverse[..., None], np.float32(0.0)).astype(np.float32)
+
+# Transform an array of 3D points with a 4x4 matrix (same as "matrix @ vector": w = 1,
+# products in single precision, sums in double precision)
+def TransformPoints(matrix, points):
+    m = np.array(matrix, dtype=np.float32)
+    result = np.empty(points.shape, dtype=np.float32)
+    for row in range(3):
+        dot = np.zeros(len(points), dtype=np.float64)
+        for i in range(3):
+            dot += points[:, i] * m[row, i]
+        dot += m[row, 3]
+        result[:, row] = dot
+    return result
+
+# Transform an array of 3D vectors with a 4x4 matrix and swap Y and Z. The result is
+# exactly the same as "matrix @ vector" in mathutils
+def TransformArray(matrix, vectors):
+    return TransformPoints(matrix, vectors)[:, (0, 2, 1)]
+
+# Normals of triangles (same as MeshLoopTriangle.normal: all operations in single
+# precision), degenerate triangles have a zero normal
+def TriangleNormals(p0, p1, p2):
+    n = Cross3((p0 - p1).astype(np.float32), (p1 - p2).astype(np.float32))
+    d = n[..., 0] * n[..., 0] + n[..., 1] * n[..., 1] + n[..., 2] * n[..., 2]
+    valid = d > 1.0e-35
+    inverse = np.float32(1.0) / np.sqrt(np.where(valid, d, np.float32(1.0)))
+    return np.where(valid[..., None], n * inverse[..., None], np.float32(0.0)).astype(np.float32)
+
+FLT_EPSILON = np.finfo(np.float32).eps
+
+# Rows of 'a' equal to the rows of 'b' (same as Vector equality): each component differs
+# less than FLT_EPSILON or by one ULP
+def EqualRows(a, b):
+    a = np.ascontiguousarray(a, dtype=np.float32)
+    b = np.ascontiguousarray(b, dtype=np.float32)
+    close = np.abs(a - b) <= FLT_EPSILON
+    ia = a.view(np.int32).astype(np.int64)
+    ib = b.view(np.int32).astype(np.int64)
+    steps = ((ia < 0) == (ib < 0)) & (np.abs(ia - ib) <= 1)
+    return (close | steps).all(axis=-1)
+
+#--------------------
+# Bones weights
+#--------------------
+
+# Build the (vertices x slots) matrices of bone indices and weights of 'count' vertices
+# from a flat list of weights: vertex index, bone index and weight of each entry. The
+# entries of a vertex keep their order in its row, unused slots have bone index -1.
+def WeightsMatrix(entryVertices, entryBones, entryWeights, count):
+    order = np.argsort(entryVertices, kind="stable")
+    entryVertices = entryVertices[order]
+    # Slot of each entry: its position after the first entry of the same vertex
+    entrySlots = np.arange(len(entryVertices)) - np.searchsorted(entryVertices, entryVertices)
+    slots = int(entrySlots.max()) + 1 if len(entrySlots) else 1
+    bones = np.full((count, slots), -1, dtype=np.int32)
+    weights = np.zeros((count, slots), dtype=np.float64)
+    bones[entryVertices, entrySlots] = entryBones[order]
+    weights[entryVertices, entrySlots] = entryWeights[order]
+    return bones, weights
+
+# Select the 'count' heavier weights of each row sorted by decreasing weight, between
+# equal weights the first slot wins (same as a stable sort). Unused slots (bone -1) go
+# last. Returns the selected slots (rows x min(count, slots)).
+def TopWeights(bones, weights, count):
+    keys = np.where(bones >= 0, -weights, np.inf)
+    if keys.shape[1] <= count:
+        return np.argsort(keys, axis=1, kind="stable")
+    # Partition to find the 'count' smaller keys, then sort them by key and slot
+    selected = np.sort(np.argpartition(keys, count - 1, axis=1)[:, :count], axis=1)
+    selectedKeys = np.take_along_axis(keys, selected, axis=1)
+    selected = np.take_along_axis(selected, np.argsort(selectedKeys, axis=1, kind="stable"), axis=1)
+    # With ties on the last selected key the partition can choose a later slot, sort
+    # these rows completely
+    lastKeys = np.take_along_axis(keys, selected[:, -1:], axis=1)
+    ties = np.count_nonzero(keys == lastKeys, axis=1) != np.count_nonzero(selectedKeys == lastKeys, axis=1)
+    tiedRows = np.flatnonzero(ties)
+    if len(tiedRows):
+        selected[tiedRows] = np.argsort(keys[tiedRows], axis=1, kind="stable")[:, :count]
+    return selected
+
+#--------------------
+# “Computing Tangent Space Basis Vectors for an Arbitrary Mesh” by Lengyel, Eric. 
+# Terathon Software 3D Graphics Library, 2001.
+# http://www.terathon.com/code/tangent.html
+#--------------------
+        
+def GenerateTangents(tLodLevels, vertices, errorsMem):
+
+    if not len(vertices):
+        log.warning("No vertices, tangent generation cancelled.")
+        return
+
+    nullUvIndices = None
+    incompleteUvIndices = None
+    if errorsMem:
+        nullUvIndices = errorsMem.Get("null UV area", set() )
+        incompleteUvIndices = errorsMem.Get("incomplete UV", set() )
+
+    masks = vertices.masks
+    blenderIndices = vertices.blenderIndex
+
+    # Check the values
+    lodsIndices = []
+    for tLodLevel in reversed(tLodLevels):
+        if not tLodLevel.indexSet or not len(tLodLevel.triangleList):
+            log.warning("Empty LOD, tangent generation skipped.")
+            tLodLevels.remove(tLodLevel)
+            continue
+        lodIndices = np.fromiter(tLodLevel.indexSet, dtype=np.int64, count=len(tLodLevel.indexSet))
+        lodsIndices.append(lodIndices)
+
+        # Check if we have all the needed data to do the calculations
+        neededMask = ELEMENT_POSITION | ELEMENT_NORMAL | ELEMENT_UV1
+        missing = np.flatnonzero((masks[lodIndices] & neededMask) != neededMask)
+        if len(missing):
+            vertexIndex = lodIndices[missing[0]]
+            blenderIndex = tuple(blenderIndices[vertexIndex].tolist())
+            if incompleteUvIndices is not None:
+                incompleteUvIndices.add(blenderIndex)
+            for element, name in ((ELEMENT_POSITION, "position"), (ELEMENT_NORMAL, "normal"), (ELEMENT_UV1, "UV")):
+                if not (masks[vertexIndex] & element):
+                    log.warning("Missing {:s} on vertex {:d}, tangent generation cancelled.".format(name, blenderIndex[1]))
+                    return
+    if not lodsIndices:
+        return
+
+    # Vertices used by the LODs, tangent and bitangent are summed in these local arrays
+    rows = np.unique(np.concatenate(lodsIndices))
+
+    # Check if the tangent was already calculated for some vertices and we're overwriting it
+    tangentOverwritten = np.count_nonzero(masks[rows] & ELEMENT_TANGENT)
+    if tangentOverwritten:
+        log.warning("Overwriting {:d} tangents".format(tangentOverwritten))
+
+    # Calculate tangent and bitangent
+    # For each triangle, we have 3 vertices vertex1, vertex2, vertex3, each of the have their UV coordinates, we want to 
+    # find two unit orthogonal vectors (tangent and bitangent) such as we can express each vertex position as a function
+    # of the vertex UV: 
+    #  VertexPosition = Tangent * f'(VertexUV) + BiTangent * f"(VertexUV)
+    # Actually we are going to express them relatively to a vertex chosen as origin (vertex1):
+    #  vertex - vertex1 = Tangent * (vertex.u - vertex1.u) + BiTangent * (vertex.v - vertex1.v)
+    # We have two equations, one for vertex2-vertex1 and one for vertex3-vertex1, if we put them in a system and solve it
+    # we can obtain Tangent and BiTangent:
+    #  [T; B] = [u1, v1; u2, v2]^-1 * [V2-V1; V3-V1]
+    # All the triangles of all the LODs are solved at once, in double precision like the Python floats.
+    triangles = np.concatenate([np.array(tLodLevel.triangleList, dtype=np.int64).reshape(-1, 3)
+                                for tLodLevel in tLodLevels])
+    positions = vertices.pos[triangles].astype(np.float64)
+    uvs = vertices.uv[triangles].astype(np.float64)
+
+    # First equation: [x1, y1, z1] = Tangent * u1 + BiTangent * v1
+    p1 = positions[:, 1] - positions[:, 0]
+    u1 = uvs[:, 1, 0] - uvs[:, 0, 0]
+    v1 = uvs[:, 1, 1] - uvs[:, 0, 1]
+
+    # Second equation: [x2, y2, z2] = Tangent * u2 + BiTangent * v2
+    p2 = positions[:, 2] - positions[:, 0]
+    u2 = uvs[:, 2, 0] - uvs[:, 0, 0]
+    v2 = uvs[:, 2, 1] - uvs[:, 0, 1]
+
+    # Determinant of the matrix [u1 v1; u2 v2]
+    d = u1 * v2 - u2 * v1
+
+    # If the determinant is zero then the points (0,0), (u1,v1), (u2,v2) are in line, this means
+    # the area on the UV map of this triangle is null. This is an error, we must skip this triangle.
+    invalid = (d == 0)
+    invalidUV = bool(invalid.any())
+    if invalidUV and nullUvIndices is not None:
+        nullUvIndices.update(map(tuple, blenderIndices[triangles[invalid].reshape(-1)].tolist()))
+    valid = ~invalid
+    triangles = triangles[valid]
+    d = d[valid, None]
+    p1 = p1[valid]
+    p2 = p2[valid]
+    t = ((v2[valid, None] * p1 - v1[valid, None] * p2) / d).astype(np.float32)
+    b = ((u1[valid, None] * p2 - u2[valid, None] * p1) / d).astype(np.float32)
+
+    # Sum the values of each triangle to its vertices, in triangles order
+    localIndices = np.searchsorted(rows, triangles).reshape(-1)
+    tangents = np.zeros((len(rows), 3), dtype=np.float32)
+    bitangents = np.zeros((len(rows), 3), dtype=np.float32)
+    np.add.at(tangents, localIndices, np.repeat(t, 3, axis=0))
+    np.add.at(bitangents, localIndices, np.repeat(b, 3, axis=0))
+
+    if invalidUV:
+        log.error("Invalid UV, the area in the UV map is too small.")
+
+    # Gram-Schmidt orthogonalize normal, tangent and bitangent
+    normals = vertices.normal[rows]
+    # Unit vector perpendicular to normal and in the same plane of normal and tangent
+    tOrtho = Normalize3( tangents - normals * Dot3(normals, tangents)[:, None] )
+    # Unit vector perpendicular to the plane of normal and tangent
+    bOrtho = Normalize3( Cross3(normals, tangents) )
+
+    # Calculate handedness: if bOrtho and bitangent have the different directions, save the verse
+    # in tangent.w, so we can reconstruct bitangent by: tangent.w * normal.cross(tangent)
+    w = np.where(Dot3(bOrtho, bitangents) >= 0.0, np.float32(1.0), np.float32(-1.0))
+
+    vertices.set("bitangent", rows, bOrtho)
+    vertices.set("tangent", rows, np.concatenate((tOrtho, w[:, None]), axis=1))
+
+#--------------------
+# Vertex cache optimization
+#--------------------
+
+# "Linear-Speed Vertex Cache Optimisation" by Tom Forsyth
+#  https://tomforsyth1000.github.io/papers/fast_vert_cache_opt.html
+# We sort the triangles so that the GPU finds their vertices in its post-transform
+# cache. Each vertex has a score, higher if it is in the (LRU) cache and if only a
+# few triangles still use it; the score of a triangle is the sum of its vertices
+# scores. At each step we output the best triangle among the ones using a vertex
+# in the cache, then we update only the scores of the vertices in the cache.
+
+# These are the constants used in the algorithm:
+VERTEX_CACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+# Returns the new order of the triangles (triangles x 3 array of vertex indices)
+def OptimizeVertexCache(triangles, cacheSize=VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    trianglesCount = len(triangles)
+    if trianglesCount == 0:
+        return np.zeros(0, dtype=np.int64)
+    cacheSize = max(int(cacheSize), 4)
+
+    # Vertices numbered from 0, and the number of triangles using each vertex
+    unused, indices = np.unique(triangles, return_inverse=True)
+    indices = indices.reshape(-1)
+    verticesCount = len(unused)
+    valences = np.bincount(indices, minlength=verticesCount)
+
+    # Triangles of each vertex (CSR): adjacency[offsets[v]:offsets[v]+liveCount[v]] are
+    # the triangles of vertex v not yet in the output
+    offsets = np.zeros(verticesCount + 1, dtype=np.int64)
+    np.cumsum(valences, out=offsets[1:])
+    adjacency = (np.argsort(indices, kind="stable") // 3).tolist()
+    offsets = offsets.tolist()
+    liveCount = valences.tolist()
+    indices = indices.tolist()
+
+    # Score tables by cache position and by number of triangles still to use the vertex
+    cacheScores = [LAST_TRI_SCORE] * 3
+    for position in range(3, cacheSize):
+        cacheScores.append((1.0 - (position - 3) / (cacheSize - 3)) ** CACHE_DECAY_POWER)
+    valenceScores = [-1.0] + [VALENCE_BOOST_SCALE * count ** -VALENCE_BOOST_POWER
+                              for count in range(1, int(valences.max()) + 1)]
+
+    vertexScores = [valenceScores[count] for count in liveCount]
+    cachePositions = [-1] * verticesCount
+
+    corners0 = indices[0::3]
+    corners1 = indices[1::3]
+    corners2 = indices[2::3]
+
+    def TriangleScore(t):
+        return vertexScores[corners0[t]] + vertexScores[corners1[t]] + vertexScores[corners2[t]]
+
+    # Heap of the triangles not in the cache, to find the best one when the cache has no
+    # more triangles. An entry is valid if its score is still the triangle score.
+    heap = [(-TriangleScore(t), t) for t in range(trianglesCount)]
+    heapq.heapify(heap)
+
+    emitted = bytearray(trianglesCount)
+    order = []
+    cache = []
+    bestTriangle = heapq.heappop(heap)[1]
+    while bestTriangle >= 0:
+        order.append(bestTriangle)
+        emitted[bestTriangle] = 1
+        triangleVertices = indices[3 * bestTriangle:3 * bestTriangle + 3]
+
+        # Remove the triangle from the live triangles of its vertices
+        for v in triangleVertices:
+            start = offsets[v]
+            end = start + liveCount[v] - 1
+            i = adjacency.index(bestTriangle, start, end + 1)
+            adjacency[i] = adjacency[end]
+            adjacency[end] = bestTriangle
+            liveCount[v] -= 1
+
+        # Move the triangle vertices to the front of the cache
+        newCache = []
+        for v in triangleVertices:
+            if v not in newCache:
+                newCache.append(v)
+        newCache += [v for v in cache if v not in triangleVertices]
+        cache = newCache[:cacheSize]
+
+        # Update the scores of the vertices out of the cache, their triangles have a new
+        # score in the heap
+        for v in newCache[cacheSize:]:
+            cachePositions[v] = -1
+            vertexScores[v] = valenceScores[liveCount[v]]
+            start = offsets[v]
+            for t in adjacency[start:start + liveCount[v]]:
+                heapq.heappush(heap, (-TriangleScore(t), t))
+
+        # Update the scores of the vertices in the cache
+        for position, v in enumerate(cache):
+            cachePositions[v] = position
+            count = liveCount[v]
+            vertexScores[v] = (cacheScores[position] + valenceScores[count]) if count else -1.0
+
+        # Best triangle using a vertex in the cache
+        bestTriangle = -1
+        bestScore = -1.0
+        for v in cache:
+            start = offsets[v]
+            for t in adjacency[start:start + liveCount[v]]:
+                score = vertexScores[corners0[t]] + vertexScores[corners1[t]] + vertexScores[corners2[t]]
+                if score > bestScore:
+                    bestScore = score
+                    bestTriangle = t
+
+        # Otherwise the best triangle in the heap
+        if bestTriangle < 0:
+            while heap:
+                score, t = heapq.heappop(heap)
+                if not emitted[t] and -score == TriangleScore(t):
+                    bestTriangle = t
+                    break
+
+    return np.array(order, dtype=np.int64)
+
+# Returns ACMR (average cache miss ratio, vertices loaded per triangle) and ATVR (average
+# transformed vertex ratio, vertices loaded per vertex) of the triangles drawn in order,
+# with a FIFO cache of 'cacheSize' vertices
+def VertexCacheStatistics(triangles, cacheSize=VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    if len(triangles) == 0:
+        return 0.0, 0.0
+    unused, indices = np.unique(triangles, return_inverse=True)
+    misses = TriangleCacheMisses(indices.reshape(-1, 3), cacheSize).sum()
+    return misses / len(triangles), misses / len(unused)
+
+# Returns the number of vertices loaded by each triangle with a FIFO cache of 'cacheSize'
+# vertices (the vertices must be numbered from 0)
+def TriangleCacheMisses(triangles, cacheSize=VERTEX_CACHE_SIZE):
+    indices = np.asarray(triangles, dtype=np.int64).reshape(-1)
+    misses = np.zeros(len(indices), dtype=np.int64)
+    if not len(indices):
+        return misses.reshape(-1, 3)
+    # A vertex is in the cache if it was loaded less than 'cacheSize' misses ago
+    loadTimes = [-cacheSize] * (int(indices.max()) + 1)
+    time = 0
+    for i, v in enumerate(indices.tolist()):
+        if time - loadTimes[v] >= cacheSize:
+            loadTimes[v] = time
+            time += 1
+            misses[i] = 1
+    return misses.reshape(-1, 3).sum(axis=1)
+
+# Optimize the triangles of a LOD (any object with a 'triangleList'), logs the ACMR and ATVR
+# before and after
+def OptimizeIndices(lodLevel, cacheSize=VERTEX_CACHE_SIZE):
+
+    triangles = np.array(lodLevel.triangleList, dtype=np.int64).reshape(-1, 3)
+    if not len(triangles):
+        return
+
+    oldAcmr, oldAtvr = VertexCacheStatistics(triangles, cacheSize)
+    triangles = triangles[OptimizeVertexCache(triangles, cacheSize)]
+    newAcmr, newAtvr = VertexCacheStatistics(triangles, cacheSize)
+
+    # ACMR: vertices transformed per triangle (0.5 is the best for a regular grid, 3 the worst)
+    # ATVR: vertices transformed per vertex (1 is the best)
+    log.info("Vertex cache {:d}: ACMR {:.3f} -> {:.3f}, ATVR {:.3f} -> {:.3f}"
+            .format(cacheSize, oldAcmr, newAcmr, oldAtvr, newAtvr) )
+
+    # Rewrite the index data now
+    lodLevel.triangleList = list(map(tuple, triangles.tolist()))
+
+#--------------------
+# Overdraw and vertex fetch optimization
+#--------------------
+
+# "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw" by Pedro V. Sander,
+#  Diego Nehab, Joshua Barczak
+# The triangles (already sorted for the vertex cache) are split in clusters where the
+# cache is loaded again (all the vertices of a triangle are misses); these clusters
+# are split again where the ACMR of the part is not worse than the ACMR of the whole
+# cluster multiplied by 'threshold'. The clusters are then sorted so that the ones
+# facing out of the mesh center are drawn first: they are more likely to hide the
+# others, whatever the view direction.
+
+# Triangles order with overdraw reduced, 'positions' are the positions of the vertices
+# used by the triangles
+def OptimizeOverdraw(triangles, positions, threshold=1.05, cacheSize=VERTEX_CACHE_SIZE):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    trianglesCount = len(triangles)
+    if trianglesCount < 2:
+        return np.arange(trianglesCount, dtype=np.int64)
+    unused, indices = np.unique(triangles, return_inverse=True)
+    indices = indices.reshape(-1, 3)
+
+    # Hard clusters: where all the triangle vertices are not in the cache
+    misses = TriangleCacheMisses(indices, cacheSize)
+    hardStarts = np.flatnonzero(misses == 3)
+    if not len(hardStarts) or hardStarts[0] != 0:
+        hardStarts = np.concatenate(([0], hardStarts))
+    hardEnds = np.append(hardStarts[1:], trianglesCount)
+    hardMisses = np.add.reduceat(misses, hardStarts)
+
+    # Soft clusters: split a hard cluster when the ACMR of the part (starting with an
+    # empty cache) reaches the ACMR of the cluster
+    starts = []
+    loadTimes = [-cacheSize] * (int(indices.max()) + 1)
+    time = 0
+    triangleVertices = indices.tolist()
+    for start, end, clusterMisses in zip(hardStarts.tolist(), hardEnds.tolist(), hardMisses.tolist()):
+        clusterThreshold = threshold * clusterMisses / (end - start)
+        starts.append(start)
+        clusterStarts = len(starts)
+        time += cacheSize + 1
+        runningMisses = 0
+        runningTriangles = 0
+        for i in range(start, end):
+            for v in triangleVertices[i]:
+                if time - loadTimes[v] >= cacheSize:
+                    loadTimes[v] = time
+                    time += 1
+                    runningMisses += 1
+            runningTriangles += 1
+            if runningMisses <= clusterThreshold * runningTriangles:
+                starts.append(i + 1)
+                time += cacheSize + 1
+                runningMisses = 0
+                runningTriangles = 0
+        # The last part of the cluster is merged with the previous one (it never reached
+        # the cluster ACMR or it is empty)
+        if len(starts) > clusterStarts:
+            starts.pop()
+    starts = np.array(starts, dtype=np.int64)
+
+    # Triangles area (length of the cross product) weighted centers and normals
+    p = np.asarray(positions, dtype=np.float64)[triangles]
+    normals = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    areas = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+    centers = p.sum(axis=1) * (areas / 3.0)[:, None]
+    meshCenter = p.reshape(-1, 3).mean(axis=0)
+
+    # Cluster sort key: distance of the cluster center from the mesh center along the
+    # cluster normal
+    clusterAreas = np.add.reduceat(areas, starts)
+    clusterCenters = np.add.reduceat(centers, starts, axis=0)
+    clusterNormals = np.add.reduceat(normals, starts, axis=0)
+    clusterCenters /= np.where(clusterAreas > 0.0, clusterAreas, 1.0)[:, None]
+    lengths = np.sqrt(np.einsum("ij,ij->i", clusterNormals, clusterNormals))
+    clusterNormals /= np.where(lengths > 0.0, lengths, 1.0)[:, None]
+    keys = np.einsum("ij,ij->i", clusterCenters - meshCenter, clusterNormals)
+
+    # Clusters with the greatest key first
+    clusterOrder = np.argsort(-keys, kind="stable")
+    clusters = np.zeros(trianglesCount, dtype=np.int64)
+    clusters[starts[1:]] = 1
+    clusters = np.cumsum(clusters)
+    ranks = np.empty_like(clusterOrder)
+    ranks[clusterOrder] = np.arange(len(clusterOrder))
+    return np.argsort(ranks[clusters], kind="stable")
+
+# Vertices used by the triangles in order of first use. Numbering the vertices in this
+# order, the GPU reads the vertex buffer almost sequentially.
+def VertexFetchOrder(triangles):
+    unique, firstUse = np.unique(np.asarray(triangles, dtype=np.int64).reshape(-1), return_index=True)
+    return unique[np.argsort(firstUse)]
+
+# Size of the vertex fetch cache simulated for the statistics, like a small mobile GPU
+FETCH_CACHE_LINE = 64
+FETCH_CACHE_SIZE = 16 * 1024
+
+# Returns the overfetch (bytes read from the vertex buffer divided by the size of the
+# vertices used, 1 is the best), 'indexes' are the vertex buffer indices in draw order
+def VertexFetchStatistics(indexes, vertexSize):
+    indexes = np.asarray(indexes, dtype=np.int64).reshape(-1)
+    used = len(np.unique(indexes))
+    if not used or vertexSize <= 0:
+        return 0.0
+    # Direct mapped cache of lines, a tag is the line address + 1
+    cache = [0] * (FETCH_CACHE_SIZE // FETCH_CACHE_LINE)
+    linesCount = len(cache)
+    fetched = 0
+    for index in indexes.tolist():
+        startTag = index * vertexSize // FETCH_CACHE_LINE
+        endTag = ((index + 1) * vertexSize + FETCH_CACHE_LINE - 1) // FETCH_CACHE_LINE
+        for tag in range(startTag, endTag):
+            line = tag % linesCount
+            if cache[line] != tag + 1:
+                cache[line] = tag + 1
+                fetched += FETCH_CACHE_LINE
+    return fetched / (used * vertexSize)
+
+# Resolution of the views rasterized for the overdraw statistics
+OVERDRAW_VIEWPORT = 256
+# Max number of pixels tested at once
+OVERDRAW_BATCH = 1 << 22
+
+# Returns the overdraw (pixels drawn divided by the pixels covered, 1 is the best) of
+# the triangles drawn in order, looking at the mesh from the 6 axis directions with
+# back face culling and depth test
+def OverdrawStatistics(triangles, positions):
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    p = np.asarray(positions, dtype=np.float64)[triangles]
+    if not len(p):
+        return 0.0
+    # Fit the mesh in the viewport
+    low = p.reshape(-1, 3).min(axis=0)
+    extent = float((p.reshape(-1, 3).max(axis=0) - low).max())
+    p = (p - low) / (extent if extent > 0.0 else 1.0)
+
+    covered = 0
+    drawn = 0
+    for axis in range(3):
+        u, v = [i for i in range(3) if i != axis]
+        for side in (1.0, -1.0):
+            # Screen coordinates in pixels and depth (0 is the nearest)
+            x = p[:, :, u] * (OVERDRAW_VIEWPORT - 1)
+            y = p[:, :, v] * (OVERDRAW_VIEWPORT - 1)
+            z = (1.0 - p[:, :, axis]) if side > 0.0 else p[:, :, axis]
+            # Back face culling, the visible triangles are counter-clockwise
+            area = ((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])) * side
+            visible = np.flatnonzero(area > 0.0)
+            depths = np.full(OVERDRAW_VIEWPORT * OVERDRAW_VIEWPORT, np.inf)
+            drawn += RasterizeDepth(depths, x[visible], y[visible], z[visible], area[visible] * side)
+            covered += int(np.count_nonzero(depths < np.inf))
+    return drawn / covered if covered else 0.0
+
+# Draws the triangles (in order) in the depth buffer, returns the number of pixels which
+# passed the depth test
+def RasterizeDepth(depths, x, y, z, area):
+    if not len(x):
+        return 0
+    # Pixels in the bounding rectangle of each triangle
+    x0 = np.clip(np.ceil(x.min(axis=1) - 0.5), 0, OVERDRAW_VIEWPORT - 1).astype(np.int64)
+    x1 = np.clip(np.floor(x.max(axis=1) - 0.5), 0, OVERDRAW_VIEWPORT - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(y.min(axis=1) - 0.5), 0, OVERDRAW_VIEWPORT - 1).astype(np.int64)
+    y1 = np.clip(np.floor(y.max(axis=1) - 0.5), 0, OVERDRAW_VIEWPORT - 1).astype(np.int64)
+    widths = np.maximum(x1 - x0 + 1, 0)
+    counts = widths * np.maximum(y1 - y0 + 1, 0)
+    ends = np.cumsum(counts)
+
+    drawn = 0
+    first = 0
+    while first < len(x):
+        # Batch of triangles with a limited number of pixels
+        last = max(int(np.searchsorted(ends, ends[first] - counts[first] + OVERDRAW_BATCH, side="right")), first + 1)
+        batchCounts = counts[first:last]
+        t = np.repeat(np.arange(first, last), batchCounts)
+        offsets = np.arange(len(t)) - np.repeat(np.cumsum(batchCounts) - batchCounts, batchCounts)
+        px = x0[t] + offsets % widths[t] + 0.5
+        py = y0[t] + offsets // widths[t] + 0.5
+        first = last
+        # Barycentric coordinates of the pixel centers
+        w0 = (x[t, 1] - px) * (y[t, 2] - py) - (x[t, 2] - px) * (y[t, 1] - py)
+        w1 = (x[t, 2] - px) * (y[t, 0] - py) - (x[t, 0] - px) * (y[t, 2] - py)
+        w2 = area[t] - w0 - w1
+        inside = (w0 * area[t] >= 0.0) & (w1 * area[t] >= 0.0) & (w2 * area[t] > 0.0)
+        t = t[inside]
+        pixels = (py[inside].astype(np.int64) * OVERDRAW_VIEWPORT + px[inside].astype(np.int64))
+        pz = (w0[inside] * z[t, 0] + w1[inside] * z[t, 1] + w2[inside] * z[t, 2]) / area[t]
+        if not len(t):
+            continue
+        # Sort the pixels by position keeping the drawing order, a pixel passes the depth
+        # test if it is nearer than the depth buffer and the previous pixels in the batch.
+        # The minimum of the previous pixels is a cumulative minimum on depths shifted by
+        # position, so that every position starts lower than all the previous ones.
+        order = np.argsort(pixels, kind="stable")
+        pixels = pixels[order]
+        pz = pz[order]
+        groups = np.cumsum(np.concatenate(([0], pixels[1:] != pixels[:-1])))
+        shifted = np.minimum.accumulate(pz - 2.0 * groups)
+        previous = np.full(len(pz), np.inf)
+        sameGroup = np.flatnonzero(groups[1:] == groups[:-1]) + 1
+        previous[sameGroup] = shifted[sameGroup - 1] + 2.0 * groups[sameGroup]
+        passed = pz < np.minimum(previous, depths[pixels])
+        drawn += int(np.count_nonzero(passed))
+        np.minimum.at(depths, pixels, pz)
+    return drawn
+
+#--------------------
+# Geometry split
+#--------------------
+
+# Max number of vertices addressable with 16 bits indices
+MAX_VERTICES_16BIT = 65535
+
+# Split the triangles of a geometry in parts using at most 'maxVertices' different
+# vertices each (with all their LODs). 'lods' is a list of (triangles x 3) arrays of
+# vertex indices, one for each LOD, 'positions' the positions of the vertices (None to
+# split in order). The space is split recursively in half at the median of the first LOD
+# triangles centers along their longest axis, so each part is compact (it can be culled)
+# and has some triangles of the first LOD; the other LODs follow the same planes. When
+# a part has a single triangle of the first LOD, the next LOD with more triangles gives
+# the planes (the part can then lack the first LOD).
+# Returns a list of parts, a part is a list with the sorted triangle indices of each LOD.
+def SpatialSplit(lods, positions, maxVertices=MAX_VERTICES_16BIT):
+    if positions is None:
+        centers = [triangles.mean(axis=1)[:, None] for triangles in lods]
+    else:
+        centers = [positions[triangles].mean(axis=1) for triangles in lods]
+    parts = []
+    SplitPart([np.arange(len(triangles)) for triangles in lods], lods, centers, maxVertices, parts)
+    return parts
+
+def SplitPart(part, lods, centers, maxVertices, parts):
+    partVertices = np.concatenate([lods[i][rows].reshape(-1) for i, rows in enumerate(part)])
+    verticesCount = len(np.unique(partVertices))
+    if verticesCount <= maxVertices:
+        parts.append(part)
+        return
+    # LOD giving the split planes: the first one with triangles to split
+    splitLod = next((i for i, rows in enumerate(part) if len(rows) >= 2), None)
+    if splitLod is None:
+        log.warning("Cannot split a geometry part with {:d} vertices (limit {:d})".format(verticesCount, maxVertices))
+        parts.append(part)
+        return
+    splitRows = part[splitLod]
+    splitCenters = centers[splitLod][splitRows]
+    axis = int(np.argmax(splitCenters.max(axis=0) - splitCenters.min(axis=0)))
+    # Split value between the two middle centers
+    order = np.argsort(splitCenters[:, axis], kind="stable")
+    half = len(order) // 2
+    value = splitCenters[order[half], axis]
+    leftPart = [rows[centers[i][rows, axis] < value] for i, rows in enumerate(part)]
+    rightPart = [rows[centers[i][rows, axis] >= value] for i, rows in enumerate(part)]
+    if not len(leftPart[splitLod]):
+        # Many centers with the split value, split the LOD in order
+        leftPart[splitLod] = np.sort(splitRows[order[:half]])
+        rightPart[splitLod] = np.sort(splitRows[order[half:]])
+    SplitPart(leftPart, lods, centers, maxVertices, parts)
+    SplitPart(rightPart, lods, centers, maxVertices, parts)
+
+#--------------------
+# Mesh jobs
+#--------------------
+
+# The part of the decomposition of a mesh that doesn't need Blender: welding of the
+# triangles corners, tangents, vertex cache optimization and shape keys. It runs on the
+# main thread or in a worker process, so jobs and results are dicts of built-in types
+# and NumPy arrays.
+# Job options:
+#  objectName       name of the object, for the log
+#  meshIndex        mesh index saved in the vertices 'blenderIndex'
+#  tolerance        welding tolerance
+#  doTangents       generate tangents
+#  doOptimize       optimize the triangles for the vertex cache of size 'cacheSize'
+#  doMorphNor, doMorphUV, doMorphTan    shape keys elements
+#  autoSmooth       shape keys normals are split normals (of the loops)
+#  morphs           shapes to decompose: dicts with 'name', 'vertices' (count) and
+#                   'index' in the key arrays (-1 if the vertex count doesn't match)
+# Job arrays ('arrays'):
+#  triVertices      Blender vertex indices of the valid triangles (triangles x 3)
+#  triLoops         Blender loop indices of the valid triangles (triangles x 3)
+#  triGeometries    geometry index of the valid triangles
+#  triSmooth        smooth shading of the valid triangles
+#  validTriangles   Blender index of the valid triangles
+#  invalidTriangles, invalidVertices    triangles without 3 unique vertices (for errors)
+#  pos, normal, uv, uv2, color          elements of the triangles corners, missing if
+#                   not exported
+#  posMatrix, normalMatrix              4x4 transforms of the shape keys
+#  keyPositions, keyNormals             shape keys positions and normals (keys x n x 3)
+
+# Errors collected by a job, same Get() of utils.ErrorsMem
+class JobErrors:
+    def __init__(self):
+        self.errors = {}
+
+    def Get(self, name, defaultValue = None):
+        if defaultValue is not None:
+            return self.errors.setdefault(name, defaultValue)
+        return self.errors.get(name)
+
+# Triangles of a geometry in a job, with the fields of TLodLevel used by
+# GenerateTangents and OptimizeIndices
+class JobLodLevel:
+    def __init__(self, geometryIndex, triangles):
+        self.geometryIndex = geometryIndex
+        self.indexSet = set(np.unique(triangles).tolist())
+        self.triangleList = triangles
+
+# Plain arrays of a VertexStore (without bones weights)
+def VertexStoreArrays(store):
+    return {"masks": store.masks.copy(),
+            "columns": {name: array[:store.count].copy() for name, array in store.columns.items()} }
+
+def VertexStoreFromArrays(arrays):
+    store = VertexStore()
+    store.add(len(arrays["masks"]))
+    store.maskArray[:store.count] = arrays["masks"]
+    for name, array in arrays["columns"].items():
+        store.allocate(name)[:store.count] = array
+    return store
+
+def ProcessMeshJob(job):
+
+    arrays = job["arrays"]
+    objectName = job["objectName"]
+    meshIndex = job["meshIndex"]
+    errors = JobErrors()
+
+    triVertices = arrays["triVertices"]
+    cornerVertices = triVertices.reshape(-1)
+    cornersCount = len(cornerVertices)
+    cornerPos = arrays.get("pos")
+    cornerNormal = arrays.get("normal")
+    cornerUv = arrays.get("uv")
+    cornerColor = arrays.get("color")
+
+    # Weld corners with the same position, normal, UV and color, only the first corner of
+    # each group becomes a new vertex
+    remap, firstCorners = WeldVertices((cornerPos, cornerNormal, cornerUv), (cornerColor,),
+                                       job["tolerance"])
+    if remap is None:
+        # No elements to compare, all the corners are the same vertex
+        remap = np.zeros(cornersCount, dtype=np.int64)
+        firstCorners = np.zeros(min(cornersCount, 1), dtype=np.int64)
+
+    # New vertices, numbered from 0
+    vertices = VertexStore()
+    vertexCount = len(firstCorners)
+    vertices.add(vertexCount)
+    firstVertices = cornerVertices[firstCorners]
+    vertices.set("blenderIndex", 0, np.stack((np.full(vertexCount, meshIndex), firstVertices), axis=1))
+    for name in ("pos", "normal", "uv", "uv2", "color"):
+        column = arrays.get(name)
+        if column is not None:
+            vertices.set(name, 0, column[firstCorners])
+
+    # Triangles of each geometry
+    cornerIndices = remap.reshape(-1, 3)
+    triangles = cornerIndices[:, (0, 2, 1)]
+    triGeometries = arrays["triGeometries"]
+    lodLevels = []
+    for geometryIndex in np.unique(triGeometries).tolist():
+        lodLevels.append(JobLodLevel(geometryIndex, triangles[triGeometries == geometryIndex]))
+
+    # Generate tangents for the triangles of every geometry
+    if job["doTangents"]:
+        for lodLevel in lodLevels:
+            log.info("Generating tangents on {:d} indices for {:s} Geometry{:d}"
+                    .format(len(lodLevel.indexSet), objectName, lodLevel.geometryIndex) )
+        GenerateTangents(list(lodLevels), vertices, errors)
+
+    # Optimize vertex index buffer of every geometry
+    if job["doOptimize"]:
+        for lodLevel in lodLevels:
+            log.info("Optimizing {:d} indices for {:s} Geometry{:d}"
+                    .format(len(lodLevel.indexSet), objectName, lodLevel.geometryIndex) )
+            OptimizeIndices(lodLevel, job["cacheSize"])
+
+    morphs = []
+    morphHasNewNormals = False
+    if job["morphs"]:
+        # Not morphed vertices of the corners of the valid triangles
+        morphCorners = remap
+        morphMasks = vertices.masks[morphCorners]
+        basePos = vertices.pos[morphCorners] if vertices.pos is not None else None
+        baseNormal = vertices.normal[morphCorners] if vertices.normal is not None else None
+        cornerLoops = arrays["triLoops"].reshape(-1)
+        triSmooth = arrays["triSmooth"]
+        validTriangles = arrays["validTriangles"]
+        invalidTriangles = list(zip(arrays["invalidTriangles"].tolist(), arrays["invalidVertices"].tolist()))
+        posMatrix = arrays["posMatrix"]
+        normalMatrix = arrays["normalMatrix"]
+        doMorphNor = job["doMorphNor"]
+
+    for key in job["morphs"]:
+        name = key["name"]
+        log.info("Decomposing shape: {:s} ({:d} vertices)".format(name, key["vertices"]) )
+
+        # Check if vertex counts match
+        if key["index"] < 0:
+            log.error("Vertex count mismatch on shape {:s}.".format(name))
+            continue
+
+        for triangleIndex, triangleVertices in invalidTriangles:
+            for vertexIndex in triangleVertices:
+                log.error("Cannot find vertex {:d} of triangle {:d} of shape {:s}."
+                        .format(vertexIndex, triangleIndex, name) )
+
+        # The shape key has its own normals, the flat triangles normals are computed from
+        # the shape positions
+        keyPositions = arrays["keyPositions"][key["index"]]
+        cornerPos = TransformArray(posMatrix, keyPositions)[cornerVertices]
+        if doMorphNor:
+            keyNormals = TransformArray(normalMatrix, arrays["keyNormals"][key["index"]])
+            if job["autoSmooth"]:
+                # if using Data->Normals->Auto Smooth, use split normal vector
+                cornerNormal = keyNormals[cornerLoops]
+            else:
+                # if triangle is smooth, use vertex normal, otherwise triangle normal
+                p = keyPositions[triVertices]
+                triNormals = TransformArray(normalMatrix, TriangleNormals(p[:, 0], p[:, 1], p[:, 2]))
+                cornerNormal = np.where(triSmooth[:, None, None], keyNormals[triVertices],
+                                        triNormals[:, None, :]).reshape(-1, 3)
+
+        # Check if the morph has effect on each corner (the UV are not morphed and we
+        # cannot use tangents, they are not calculated yet)
+        morphed = (morphMasks & ELEMENT_POSITION) == 0
+        if basePos is not None:
+            morphed |= ~EqualRows(cornerPos, basePos)
+        if doMorphNor:
+            morphed |= (morphMasks & ELEMENT_NORMAL) == 0
+            if baseNormal is not None:
+                morphed |= ~EqualRows(cornerNormal, baseNormal)
+
+        # Add the corners of the triangles with at least one vertex morphed
+        corners = np.flatnonzero(np.repeat(morphed.reshape(-1, 3).any(axis=1), 3))
+        cornersVertex = morphCorners[corners]
+        # A vertex is added to the morph at its first corner, 'rows' is the index of the
+        # morphed vertex of each corner
+        unused, firstUse, rows = np.unique(cornersVertex, return_index=True, return_inverse=True)
+        order = np.argsort(firstUse)
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        rows = ranks[rows.reshape(-1)]
+        firstCorners = corners[firstUse[order]]
+
+        # A vertex can be morphed different by different triangles
+        firstOfCorners = firstCorners[rows]
+        differentPos = ~EqualRows(cornerPos[corners], cornerPos[firstOfCorners])
+        different = differentPos
+        if doMorphNor:
+            differentNormal = ~EqualRows(cornerNormal[corners], cornerNormal[firstOfCorners])
+            different = differentPos | differentNormal
+            if differentNormal.any():
+                morphHasNewNormals = True
+        for corner in corners[different].tolist():
+            log.error('Different vertex {:d} of triangle {:d} of shape {:s}.'
+                .format(int(cornerVertices[corner]), int(validTriangles[corner // 3]), name) )
+
+        # Save the morphed vertices
+        indices = cornersVertex[firstUse[order]]
+        morphVertices = VertexStore()
+        count = len(indices)
+        morphVertices.add(count)
+        morphVertices.set("blenderIndex", 0, np.stack((np.full(count, meshIndex), cornerVertices[firstCorners]), axis=1))
+        morphVertices.set("pos", 0, cornerPos[firstCorners])
+        if doMorphNor:
+            morphVertices.set("normal", 0, cornerNormal[firstCorners])
+        # If we have UV, copy them, we only need them to calculate tangents
+        if job["doMorphUV"] and vertices.uv is not None:
+            uvRows = np.flatnonzero(vertices.masks[indices] & ELEMENT_UV1)
+            if len(uvRows):
+                morphVertices.set("uv", uvRows, vertices.uv[indices[uvRows]])
+
+        # Create triangles (for tangents calculation), a triangle is skipped if its last
+        # vertex is different
+        keepTriangles = ~different.reshape(-1, 3)[:, 2]
+        triangleRows = rows.reshape(-1, 3)[keepTriangles][:, (0, 2, 1)]
+
+        if job["doMorphTan"]:
+            log.info("Generating morph tangents {:s}".format(name) )
+            # Morph triangles with the indices of the vertices in the morph store
+            morphLodLevel = JobLodLevel(None, triangleRows)
+            morphLodLevel.indexSet = set(range(count))
+            GenerateTangents([morphLodLevel], morphVertices, None)
+
+        # If valid add the morph to the model list
+        if count:
+            morphs.append({"name": name, "indices": indices, "triangles": indices[triangleRows],
+                           "vertices": VertexStoreArrays(morphVertices)})
+        else:
+            log.warning('Empty shape {:s}.'.format(name))
+
+    # We can have "Different vertex" errors when some vertices are merged in the base morph because 
+    # positions and normals are the same, but in other morphs, the normals can diverge and this require 
+    # separated vertices. We could do a prepass on the shapes to find and avoid merging these vertices.
+    if morphHasNewNormals:
+        log.info("To solve the shapes errors try setting the faces to smooth")
+
+    return {"vertices": VertexStoreArrays(vertices),
+            "firstVertices": firstVertices,
+            "cornerIndices": remap,
+            "geometries": [(lodLevel.geometryIndex, np.array(lodLevel.triangleList, dtype=np.int64).reshape(-1, 3))
+                           for lodLevel in lodLevels],
+            "morphs": morphs,
+            "errors": errors.errors }
+
+#--------------------
+# Worker processes
+#--------------------
+
+# Worker processes are plain Python interpreters: they cannot import the add-on package
+# (its __init__ needs bpy), they import this file as the top level module 'meshops'.
+WORKER_MODULE = "meshops"
+
+# Reference to a function of this module to send to the workers, it is unpickled as the
+# function of the worker 'meshops' module
+class WorkerFunction:
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args):
+        return globals()[self.name](*args)
+
+    def __reduce__(self):
+        return (getattr, (WorkerModule(), self.name))
+
+class WorkerModule:
+    def __reduce__(self):
+        return (importlib.import_module, (WORKER_MODULE,))
+
+# Copy arrays in a new block of shared memory, returns the block and the layout of
+# the arrays in it (name to offset, type, shape). The caller must unlink the block.
+def ShareArrays(arrays):
+    layout = {}
+    size = 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        layout[name] = (size, array.dtype.str, array.shape)
+        # Keep the arrays aligned
+        size += (array.nbytes + 63) & ~63
+    memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        offset, dtype, shape = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)[...] = array
+    return memory, layout
+
+# Read a copy of the arrays in a block of shared memory
+def ReadSharedArrays(memoryName, layout):
+    memory = shared_memory.SharedMemory(name=memoryName)
+    try:
+        return {name: np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset).copy()
+                for name, (offset, dtype, shape) in layout.items()}
+    finally:
+        memory.close()
+
+# Log handler that saves the messages, the worker returns them to the main process
+class RecordsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+# Process a job saving a copy of its log messages in the result 'records' as (level, message)
+def RecordMeshJob(job):
+    handler = RecordsHandler()
+    log.addHandler(handler)
+    try:
+        result = ProcessMeshJob(job)
+    finally:
+        log.removeHandler(handler)
+    result["records"] = handler.records
+    return result
+
+# Process a job in a worker, the job arrays are in shared memory. The messages are only
+# recorded, the main process logs them.
+def ProcessSharedMeshJob(job, memoryName, layout):
+    job = dict(job)
+    job["arrays"] = ReadSharedArrays(memoryName, layout)
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+    return RecordMeshJob(job)
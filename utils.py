@@ -6,25 +6,32 @@
 # http://docs.python.org/2/library/struct.html
 
 from xml.etree import ElementTree as ET
-from xml.dom import minidom
 import os,shutil
+import io
+import sys
 import struct
 import array
+import hashlib
+import json
+import numpy as np
 import logging
 import bpy
 import re
 from queue import Queue
 from threading import current_thread,main_thread
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from math import degrees
 from mathutils import Vector
 import traceback
 from .addon_jsonnodetree import JSONNodetree
+from .meshcache import CACHE_FOLDER
 from pathlib import Path
 
 try:
     from PIL import Image,ImageDraw
 except:
-    import bpy,subprocess,sys
+    import bpy,subprocess
     pybin = sys.executable
     subprocess.check_call([pybin, '-m', 'ensurepip'])
     subprocess.check_call([pybin, '-m', 'pip', 'install', 'Pillow'])
@@ -226,14 +233,276 @@ def Vector3ToString(vector):
 def Vector4ToString(vector):
     return "{:g} {:g} {:g} {:g}".format(vector[0], vector[1], vector[2], vector[3])
 
+# Escape XML text and attribute values (as minidom.toprettyxml)
+def XmlEscape(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if '"' in text and not XML_ESCAPE_ATTRIBUTES:
+        text = text.replace('"', "&quot;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def XmlEscapeAttribute(text):
+    text = XmlEscape(text)
+    if XML_ESCAPE_ATTRIBUTES:
+        text = text.replace('"', "&quot;").replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#9;")
+    return text
+
+# Since Python 3.13 minidom escapes quotes and control characters only in attributes
+XML_ESCAPE_ATTRIBUTES = sys.version_info >= (3, 13)
+# Before Python 3.8 the attributes were sorted by name
+XML_SORT_ATTRIBUTES = sys.version_info < (3, 8)
+
+# Write an ElementTree element indented with tabs, with the same format of
+# minidom.toprettyxml (without the XML declaration and the last new line).
+# 'write' is the write function of a text stream.
+def WriteXmlElement(elem, write, indent=""):
+    if elem.tag is ET.Comment:
+        write("{:s}<!--{:s}-->".format(indent, elem.text or ""))
+        return
+    write(indent + "<" + elem.tag)
+    items = elem.attrib.items()
+    if XML_SORT_ATTRIBUTES:
+        items = sorted(items)
+    for name, value in items:
+        write(' {:s}="{:s}"'.format(name, XmlEscapeAttribute(value)))
+    # Children nodes: text, elements and their tails
+    if len(elem) == 0:
+        if elem.text:
+            write(">" + XmlEscape(elem.text) + "</" + elem.tag + ">")
+        else:
+            write("/>")
+        return
+    write(">\n")
+    childIndent = indent + "\t"
+    if elem.text:
+        write(childIndent + XmlEscape(elem.text) + "\n")
+    for child in elem:
+        WriteXmlElement(child, write, childIndent)
+        write("\n")
+        if child.tail:
+            write(childIndent + XmlEscape(child.tail) + "\n")
+    write(indent + "</" + elem.tag + ">")
+
 def XmlToPrettyString(elem):
-    rough = ET.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough)
-    pretty = reparsed.toprettyxml(indent="\t")
-    i = pretty.rfind("?>")
-    if i >= 0:
-        pretty = pretty[i+2:]
-    return pretty.strip()
+    stream = io.StringIO()
+    WriteXmlElement(elem, stream.write)
+    return stream.getvalue().strip()
+
+
+#--------------------
+# File writes
+#--------------------
+
+# File in the cache folder of the output path with the size, time and hash of the files
+# we wrote, by their path relative to the output path. It is not in the resource folders:
+# it would be packaged and seen by the file watchers.
+WRITE_INDEX_FILE = "write_index.json"
+
+# Index of the written files, to skip writing files with the same content, and
+# statistics of the writes
+class WriteIndex:
+    def __init__(self):
+        # Output path, the index is saved in its cache folder (None: index not saved)
+        self.rootPath = None
+        # File key (see Key) to [size, mtime in ns, hash]
+        self.files = {}
+        # The index was modified
+        self.modified = False
+        # Statistics
+        self.written = 0
+        self.skipped = 0
+        # Files are written by more threads
+        self.lock = threading.Lock()
+
+    # Reset the statistics and load the index of the output path 'rootPath'
+    def Reset(self, rootPath=None):
+        self.written = 0
+        self.skipped = 0
+        self.rootPath = os.path.normpath(rootPath) if rootPath else None
+        self.files = {}
+        self.modified = False
+        if self.rootPath:
+            try:
+                with open(self.IndexPath(), "r") as file:
+                    self.files = json.load(file)
+            except (OSError, ValueError):
+                pass
+
+    def IndexPath(self):
+        return os.path.join(self.rootPath, CACHE_FOLDER, WRITE_INDEX_FILE)
+
+    # Key of a file: its path relative to the output path, the absolute path if outside
+    def Key(self, filepath):
+        filepath = os.path.abspath(filepath)
+        if self.rootPath:
+            try:
+                relPath = os.path.relpath(filepath, self.rootPath)
+                if relPath != os.pardir and not relPath.startswith(os.pardir + os.sep):
+                    filepath = relPath
+            except ValueError:
+                # Different drive
+                pass
+        return filepath.replace(os.sep, "/")
+
+    # Returns True if the file exists with the same size and hash. The hash of the file
+    # is read from the index if the file was not modified after we wrote it.
+    def IsUnchanged(self, filepath, size, digest):
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            return False
+        key = self.Key(filepath)
+        with self.lock:
+            entry = self.files.get(key)
+        if entry and entry[0] == size and entry[1] == stat.st_mtime_ns:
+            return entry[2] == digest
+        try:
+            with open(filepath, "rb") as file:
+                fileDigest = FileDigest(file.read())
+        except OSError:
+            return False
+        with self.lock:
+            self.files[key] = [size, stat.st_mtime_ns, fileDigest]
+            self.modified = True
+        return fileDigest == digest
+
+    def Update(self, filepath, size, digest):
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            return
+        key = self.Key(filepath)
+        with self.lock:
+            self.files[key] = [size, mtime, digest]
+            self.modified = True
+            self.written += 1
+
+    def Skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    # Save the index if modified
+    def Save(self):
+        if not self.modified or not self.rootPath:
+            return
+        indexPath = self.IndexPath()
+        try:
+            os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+            with open(indexPath, "w") as file:
+                json.dump(self.files, file)
+        except OSError as e:
+            log.warning("Cannot save files index {:s} {!s}".format(indexPath, e))
+        self.modified = False
+
+writeIndex = WriteIndex()
+
+def FileDigest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Write the bytes of a file. If the file already has the same content it is not touched,
+# so its time does not change and the file watchers do not reload it. Otherwise the data
+# is written in a temporary file then renamed, readers never see a partially written file.
+# Returns True if the file was written.
+def WriteFileDataNow(data, filepath):
+    digest = FileDigest(data)
+    if writeIndex.IsUnchanged(filepath, len(data), digest):
+        writeIndex.Skip()
+        return False
+    tempPath = filepath + ".tmp"
+    try:
+        with open(tempPath, "wb") as file:
+            file.write(data)
+        os.replace(tempPath, filepath)
+    except OSError as e:
+        log.error("Cannot write to file {:s} {!s}".format(filepath, e))
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        return False
+    writeIndex.Update(filepath, len(data), digest)
+    return True
+
+# Max size in bytes of the data waiting to be written by the writer threads
+WRITER_MAX_PENDING = 256 * 1024 * 1024
+
+# Threads writing the files while the main thread continues the export. The main thread
+# waits when the data not yet written is over the limit. Without threads (not started)
+# the files are written immediately.
+class WriterPool:
+    def __init__(self):
+        self.executor = None
+        self.maxPendingSize = WRITER_MAX_PENDING
+        # Size of the data not yet written
+        self.pendingSize = 0
+        self.condition = threading.Condition()
+        # File path to the future of its last write
+        self.futures = {}
+
+    def Start(self, threads, maxPendingSize=WRITER_MAX_PENDING):
+        self.Finish()
+        if threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="UrhoWriter")
+            self.maxPendingSize = maxPendingSize
+
+    # Call function(*args) to write the file 'filepath' with 'size' bytes of data
+    def Submit(self, filepath, size, function, *args):
+        if self.executor is None:
+            function(*args)
+            return
+        # Writes of the same file are in order
+        previous = self.futures.get(filepath)
+        if previous:
+            previous.result()
+        with self.condition:
+            while self.pendingSize and self.pendingSize + size > self.maxPendingSize:
+                self.condition.wait()
+            self.pendingSize += size
+        self.futures[filepath] = self.executor.submit(self.Run, filepath, size, function, args)
+
+    def Run(self, filepath, size, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            log.error("Cannot write file {:s} {!s}".format(filepath, e))
+        finally:
+            with self.condition:
+                self.pendingSize -= size
+                self.condition.notify_all()
+
+    # Wait for all the writes to complete and stop the threads
+    def Finish(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.futures.clear()
+
+writerPool = WriterPool()
+
+# Write the bytes of a file (see WriteFileDataNow), in a writer thread if started
+def WriteFileData(data, filepath):
+    writerPool.Submit(filepath, len(data), WriteFileDataNow, data, filepath)
+
+# Copy a file, in a writer thread if started
+def CopyFile(srcFilename, filepath):
+    writerPool.Submit(filepath, 0, CopyFileNow, srcFilename, filepath)
+
+def CopyFileNow(srcFilename, filepath):
+    try:
+        shutil.copyfile(src = srcFilename, dst = filepath)
+    except OSError as e:
+        log.error("Cannot copy texture to {:s} {!s}".format(filepath, e))
+
+# Log the written and skipped files and save the index
+def LogWriteStats():
+    log.info("Files: {:d} written, {:d} unchanged".format(writeIndex.written, writeIndex.skipped))
+    writeIndex.Save()
 
 
 #--------------------
@@ -246,18 +515,14 @@ def ensure_dir(file_path):
         os.makedirs(directory)
 
 
+# Write a text file (UTF-8, with the platform line endings)
 def WriteStringFile(stringContent, filepath, fOptions):
     try:
         ensure_dir(filepath)
-        file = open(filepath, "w")
     except Exception as e:
-        log.error("Cannot open file {:s} {:s}".format(filepath, e))
+        log.error("Cannot open file {:s} {!s}".format(filepath, e))
         return
-    try:
-        file.write(stringContent)
-    except Exception as e:
-        log.error("Cannot write to file {:s} {:s}".format(filepath, e))
-    file.close()
+    WriteFileData(stringContent.replace("\n", os.linesep).encode("utf-8"), filepath)
 
 
 # Write XML to a text file
@@ -272,10 +537,8 @@ def WriteXmlFile(xmlContent, filepath, fOptions):
 
 class BinaryFileWriter:
 
-    # We try to write the file with a single API call to avoid
+    # We write the file with a single API call (see WriteFileData) to avoid
     # the Editor crashing while reading a not completed file.
-    # We set the buffer to 1Mb (if unspecified is 64Kb, and it is
-    # 8Kb with multiple file.write calls)
 
     # Constructor.
     def __init__(self):
@@ -289,16 +552,7 @@ class BinaryFileWriter:
         return True
 
     def close(self):
-        try:
-            file = open(self.filename, "wb", 1024 * 1024)
-        except Exception as e:
-            log.error("Cannot open file {:s} {:s}".format(self.filename, e))
-            return
-        try:
-            self.buffer.tofile(file)
-        except Exception as e:
-            log.error("Cannot write to file {:s} {:s}".format(self.filename, e))
-        file.close()
+        WriteFileData(self.buffer.tobytes(), self.filename)
 
     # Writes an ASCII string without terminator
     def writeAsciiStr(self, v):
@@ -330,6 +584,12 @@ class BinaryFileWriter:
     def writeFloat(self, v):
         self.buffer.extend(struct.pack("<f", v))
 
+    # Writes all the values of an array with one copy, 'dtype' (little endian) converts
+    # the values before writing. Structured arrays write their fields interleaved.
+    def writeArray(self, values, dtype=None):
+        values = np.ascontiguousarray(values, dtype=dtype)
+        self.buffer.frombytes(values.reshape(-1).view(np.uint8))
+
 # --------------------------
 # Hash - Function (like StringHash in Urho3D)
 # --------------------------